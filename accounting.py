@@ -0,0 +1,148 @@
+# Per-request latency and dependency accounting.
+#
+# start_request and finish_request wrap every Flask request. While it runs, db_pool
+# reports each statement with its duration and the rows fetched, and every new MySQL
+# connection. run_command and the Twilio transport report their time through track().
+# At the end of the request the totals go to the /metrics histograms and counters.
+# Requests that were slow (SLOW_REQUEST_MS) or ran many statements (MAX_REQUEST_QUERIES,
+# or one statement MAX_REPEATED_QUERIES times, the usual N+1 sign) are logged with
+# their statement list.
+#
+# Work outside a request (build jobs, SMS workers) still feeds the per-call dependency
+# histogram; there is just no request to charge it to. The bookkeeping is a few
+# additions on a thread-local object per statement, cheap enough to leave on.
+import time
+import threading
+import contextlib
+import logging
+
+from decouple import config
+from flask import request
+
+import metrics
+
+logger = logging.getLogger()
+
+SLOW_REQUEST_MS = config('SLOW_REQUEST_MS', default=500, cast=float)
+MAX_REQUEST_QUERIES = config('MAX_REQUEST_QUERIES', default=25, cast=int)
+MAX_REPEATED_QUERIES = config('MAX_REPEATED_QUERIES', default=5, cast=int)
+# Statements kept per request for the log, the counts cover all of them.
+QUERY_LOG_LIMIT = 100
+
+_current = threading.local()
+
+
+class Account(object):
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = []
+        self.query_count = 0
+        self.rows = 0
+        self.seconds = {}
+        self.calls = {}
+
+    def add(self, dependency, seconds):
+        self.seconds[dependency] = self.seconds.get(dependency, 0) + seconds
+        self.calls[dependency] = self.calls.get(dependency, 0) + 1
+
+def current():
+    return getattr(_current, "account", None)
+
+def _record(dependency, seconds):
+    metrics.DEPENDENCY_CALL_SECONDS.observe(seconds, dependency=dependency)
+    account = current()
+    if account is not None:
+        account.add(dependency, seconds)
+    return account
+
+# Times a call to a dependency: "mysql", "mysql_connect", "subprocess" or "twilio".
+@contextlib.contextmanager
+def track(dependency):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(dependency, time.perf_counter() - started)
+
+# Records one statement. Returns the entry fetched rows are added to, or None.
+def query(sql, seconds):
+    account = _record("mysql", seconds)
+    if account is None:
+        return None
+    account.query_count += 1
+    entry = [sql, seconds, 0]
+    if len(account.queries) < QUERY_LOG_LIMIT:
+        account.queries.append(entry)
+    return entry
+
+def rows(entry, count):
+    account = current()
+    if account is not None:
+        account.rows += count
+        if entry is not None:
+            entry[2] += count
+
+def start_request():
+    _current.account = Account()
+
+# The statements grouped by SQL, in the order each statement first ran:
+# {sql: [count, seconds, rows]}.
+def _group_queries(account):
+    grouped = {}
+    for sql, seconds, row_count in account.queries:
+        summary = grouped.setdefault(sql, [0, 0, 0])
+        summary[0] += 1
+        summary[1] += seconds
+        summary[2] += row_count
+    return grouped
+
+def _log_request(account, duration, reasons, grouped):
+    lines = ["  {0:>3}x {1:8.1f} ms {2:>5} rows  {3}".format(count, seconds * 1000, row_count, " ".join(sql.split()))
+        for sql, (count, seconds, row_count) in grouped.items()]
+    if account.query_count > len(account.queries):
+        lines.append("  ... {0} more statements".format(account.query_count - len(account.queries)))
+    logger.warning("{0} {1} ({2}): {3:.1f} ms, {4} statements, {5} rows, {6} new connections; {7}\n{8}".format(
+        request.method, request.path, ", ".join(reasons), duration * 1000, account.query_count, account.rows,
+        account.calls.get("mysql_connect", 0),
+        ", ".join("{0} {1:.1f} ms".format(dependency, seconds * 1000) for dependency, seconds in sorted(account.seconds.items())),
+        "\n".join(lines)))
+
+def _finish(status_code):
+    account = current()
+    if account is None:
+        return
+    _current.account = None
+    duration = time.perf_counter() - account.started
+    endpoint = request.endpoint or "unmatched"
+
+    metrics.REQUEST_SECONDS.observe(duration, endpoint=endpoint, method=request.method, status=status_code)
+    metrics.REQUEST_DB_QUERIES.observe(account.query_count, endpoint=endpoint)
+    if account.rows:
+        metrics.REQUEST_DB_ROWS.inc(account.rows, endpoint=endpoint)
+    if account.calls.get("mysql_connect"):
+        metrics.REQUEST_DB_CONNECTIONS.inc(account.calls["mysql_connect"], endpoint=endpoint)
+    for dependency, seconds in account.seconds.items():
+        metrics.REQUEST_DEPENDENCY_SECONDS.inc(seconds, endpoint=endpoint, dependency=dependency)
+
+    grouped = _group_queries(account)
+    reasons = []
+    if duration * 1000 >= SLOW_REQUEST_MS:
+        reasons.append("slow")
+    if account.query_count >= MAX_REQUEST_QUERIES:
+        reasons.append("many_queries")
+    if grouped and max(summary[0] for summary in grouped.values()) >= MAX_REPEATED_QUERIES:
+        reasons.append("repeated_query")
+    for reason in reasons:
+        metrics.FLAGGED_REQUESTS.inc(endpoint=endpoint, reason=reason)
+    if reasons:
+        _log_request(account, duration, reasons, grouped)
+
+# Registered with app.after_request, before db_pool.finish_request so that it runs
+# after it (Flask runs them in reverse) and the commit is included.
+def finish_request(response):
+    _finish(response.status_code)
+    return response
+
+# Registered with app.teardown_request for requests that failed before after_request.
+def teardown_request(exception=None):
+    _finish(500)
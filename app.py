@@ -1,25 +1,63 @@
-from flask import Flask, request
+from flask import Flask, Response, request, g
 from flask_restful import Resource, Api, reqparse
 from flask_cors import CORS
 import uuid
+import base64
+import hashlib
 import mysql.connector
+import db_pool
+import build_jobs
+import workspaces
+import deploy
+import profile_cache
+import profile_renderer
+import notifications
+import metrics
+import accounting
+import profiler
 import os
 import subprocess
-from twilio.rest import Client
 import random
 import jwt
 import datetime
 import logging
 from decouple import config
 import re
+from typing import TypedDict, List, Optional
+import shutil
+import threading
+import time
+import functools
 
 app = Flask(__name__)
 CORS(app)
 api = Api(app)
 
+# Time each request and what it spent in MySQL, subprocesses and Twilio. after_request
+# functions run in reverse order, so registering it first includes the commit below.
+app.before_request(accounting.start_request)
+app.after_request(accounting.finish_request)
+app.teardown_request(accounting.teardown_request)
+
+# Sample the requests claimed by a profiling session started with /debug/profile.
+app.before_request(profiler.start_request)
+app.teardown_request(profiler.finish_request)
+
+# Each request is one unit of work: commit its writes once the handler returned,
+# then give the pooled DB connection back.
+app.after_request(db_pool.finish_request)
+app.teardown_appcontext(db_pool.release_request_connection)
+
+# Make sure this worker process is running its build queue and workspace sweeper threads.
+app.before_request(build_jobs.start_workers)
+app.before_request(workspaces.start_sweeper)
+
 APP_NAME = config('APP_NAME')
 JWT_SECRET = config('JWT_SECRET')
 BASE_URL = config('BASE_URL')
+AUTH_CODE_EXPIRY_MINUTES = config('AUTH_CODE_EXPIRY_MINUTES', default=15, cast=int)
+BLOG_POSTS_PAGE_SIZE = config('BLOG_POSTS_PAGE_SIZE', default=20, cast=int)
+BLOG_POSTS_MAX_PAGE_SIZE = config('BLOG_POSTS_MAX_PAGE_SIZE', default=100, cast=int)
 
 # Set up a logger with a more readable format
 logger = logging.getLogger()
@@ -28,6 +66,26 @@ if logger.handlers:
         logger.removeHandler(handler)
 logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s',level=logging.INFO)
 
+# Base class for resources that take an access token. The token is decoded once per
+# request and the resolved identity is shared by everything handling that request.
+class AuthenticatedResource(Resource):
+    def authenticate(self, token, require_verified=False):
+        return getAuthContext(token, require_verified)
+
+# Answers 403 unless the request is signed with PROFILER_SECRET, see profiler.py.
+def requireSignature(method):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if not profiler.authorized():
+            return {"error": "This endpoint is disabled or the signature is invalid"}, 403
+        return method(*args, **kwargs)
+    return wrapper
+
+# Base class for the operational endpoints (queue, pool, cache and disk stats). They
+# show job errors and server state, so calls must be signed like /debug/*.
+class SignedResource(Resource):
+    method_decorators = [requireSignature]
+
 #Todo: Enable proper logging
 #Todo: Escape single quotes
 class Register(Resource):
@@ -55,15 +113,15 @@ class Register(Resource):
                 "error": "Phone number is not valid"
             }
        
-        # Check if a verified user exists with the phone number.
-        verified_phone_exists = checkPhoneNumberExistsAndVerified(json_data["phone"])
-        if verified_phone_exists:
-            return {"error": "A user exists with this phone number. Please use a different phone number"}
-        
         # Create a verification code and save it into the phone_auth table.
+        # No code is created if a verified user exists with the phone number.
         auth_code = createAuthCode("PHONE", json_data["phone"])
+        if auth_code is None:
+            return {"error": "A user exists with this phone number. Please use a different phone number"}
 
-        # Send phone verification message with auth code
+        # Send phone verification message with auth code. Commit first so the code can
+        # be verified as soon as it arrives.
+        db_pool.commit()
         sendAuthCodeSMS(auth_code, json_data["phone"])
        
         return {"data": {
@@ -92,23 +150,18 @@ class Verify(Resource):
             "phone": json_data["phone"]
         }
         
-        # Verify if the user entered the correct code.
-        phone = verifyPhone(json_data["phone"], json_data["auth_code"])
+        # Verify the code and mark the phone as verified. A phone that is already registered
+        # keeps its user_id (the user is trying to login), otherwise the new user_id is stored.
+        user_id = verifyPhone(json_data["phone"], json_data["auth_code"], str(uuid.uuid4()))
 
-        if phone:
+        if user_id:
             response["status"] = "Verification Successful"
-            user_id = phone[1]
-            if user_id: # If user id exists it means the user is already registered and trying to login
-                response["user_id"] =  user_id
-            else:
-                # Generate a new user_id
-                response["user_id"] =  str(uuid.uuid4())
-           
-            # Set the is_verified flag and user_id
-            updatePhoneVerifyFieldAndUserID(json_data["phone"], response["user_id"])
+            response["user_id"] = user_id
 
             # Generate a access token for the user
-            access_token = generateJwtToken(response).decode("utf-8")
+            access_token = generateJwtToken(response)
+            if isinstance(access_token, bytes): # PyJWT < 2 returns bytes
+                access_token = access_token.decode("utf-8")
             response["access_token"] = str(access_token)
         else:
             return {
@@ -121,7 +174,7 @@ class Verify(Resource):
 
 api.add_resource(Verify, '/verify-phone')
 
-class Profile(Resource):
+class Profile(AuthenticatedResource):
     def __init__(self):
         self.reqparse = reqparse.RequestParser()
         self.reqparse.add_argument('token', type = str, required = True, help = 'No access token was provided', location = 'json')
@@ -138,19 +191,16 @@ class Profile(Resource):
         self.reqparse.parse_args()
         json_data = request.get_json()
 
-        jwt_payload = decodeJwttoken(json_data["token"])
+        jwt_payload = self.authenticate(json_data["token"], require_verified=True)
 
         if "error" in jwt_payload:
             return jwt_payload
 
-        user = getUser(jwt_payload["sub"])
-        if user is None:
+        if not jwt_payload["user_exists"]:
             return {"error": "Token provided is invalid. Please login"}
         
         # Only proceed with user creation if the phone number is verified
-        verified_phone_exists = checkPhoneNumberExistsAndVerified(jwt_payload["phone"])
-        
-        if not verified_phone_exists:
+        if not jwt_payload["is_verified"]:
             return {"error": "This phone number needs to be verified before creating the account"}
 
         if not json_data["first_name"]:
@@ -168,6 +218,10 @@ class Profile(Resource):
         if not json_data["current_employer"]:
             return {"error": "Current employer cannot be empty"}
 
+        # Check the profile can be built before writing anything.
+        if not json_data["top_skills"]:
+            return {"error": "Missing top skills"}, 400
+
         # Save the incoming information.
         json_data["user_id"] = jwt_payload["sub"]
         json_data["first_name"] = cleanData(json_data["first_name"]).replace(" ", "-").lower()
@@ -176,44 +230,26 @@ class Profile(Resource):
         json_data["profession"] = cleanData(json_data["profession"])
         json_data["current_employer"] = cleanData(json_data["current_employer"])
         
-        # Check if user exists
-        user_info = getUserProfile(json_data["user_id"])
+        # Load the existing profile, skills and directory in one query
+        user_info = loadUserProfile(json_data["user_id"])
         if user_info:
             updateUserProfile(json_data)
         else:
             createUserProfile(json_data)
 
         # Save top skills
-        top_skills = getUserTopSkills(json_data["user_id"])
-        if top_skills is None:
-            addUserTopSkills(json_data["user_id"], json_data["top_skills"])
-        else:
-            removeUserTopSkills(json_data["user_id"])
-            addUserTopSkills(json_data["user_id"], json_data["top_skills"])
+        replaceUserTopSkills(json_data["user_id"], json_data["top_skills"])
 
         # Check if the user already has a directory created.
-        directory = getUserDirectory(json_data["user_id"])
+        directory = user_info["directory_id"] if user_info else None
         if directory is None:
             directory = generateUserDirectoryID(json_data["user_id"], json_data["first_name"], json_data["last_name"])
 
-        # Start building profile.
-        result = loadFullProfile(json_data["user_id"])
-        if "error" in result:
-            return result
-        
-        user_profile = result["data"]
-
-        # Get all blog posts for user
-        blog_posts = getAllBlogPostsForUser(json_data["user_id"])
-        if blog_posts:
-            startBuildingBlogPosts(blog_posts, user_profile)
-        else:
-            # Start the build process. # Todo: Track build stages
-            startBuildingProfilePage(user_profile)
-
-        # Notify that the build is completed.
+        # Queue the build. The build worker sends the SMS once the site is deployed.
+        # It reads the profile on its own connection, so commit before queueing.
+        db_pool.commit()
         url = BASE_URL + "/" + directory
-        sendBuildCompletedSMS(jwt_payload["phone"], "Profile", url)
+        json_data["job_id"] = queueSiteBuild(json_data["user_id"], directory, jwt_payload["phone"], "Profile", url)
 
         return {"data": json_data}, 200
 api.add_resource(Profile, '/create-profile')
@@ -234,22 +270,20 @@ class Login(Resource):
             }
         json_data["phone"] = cleanData(json_data["phone"])
 
-        # Only proceed with user login if the phone number is verified
-        verified_phone_exists = checkPhoneNumberExistsAndVerified(json_data["phone"])
-        
-        if not verified_phone_exists:
+        # Create a verification code. Only proceed with user login if the phone number is verified
+        auth_code = createLoginAuthCode(json_data["phone"])
+        if auth_code is None:
             return {"error": "This phone number needs to be registered and verified before login"}
-        
-        # Create a verification code and save it into the phone_auth table.
-        auth_code = createAuthCode("PHONE", json_data["phone"])
 
-        # Send phone verification message with auth code
+        # Send phone verification message with auth code. Commit first so the code can
+        # be verified as soon as it arrives.
+        db_pool.commit()
         sendAuthCodeSMS(auth_code, json_data["phone"])
 
         return {"data": json_data, "message": "Verification Code Sent"}
 api.add_resource(Login, '/login')
 
-class CreateBlogPost(Resource):
+class CreateBlogPost(AuthenticatedResource):
     def __init__(self):
         self.reqparse = reqparse.RequestParser()
         self.reqparse.add_argument('token', type = str, required = True, help = 'No access token was provided', location = 'json')
@@ -261,7 +295,7 @@ class CreateBlogPost(Resource):
         self.reqparse.parse_args()
         json_data = request.get_json()
 
-        jwt_payload = decodeJwttoken(json_data["token"])
+        jwt_payload = self.authenticate(json_data["token"])
 
         if "error" in jwt_payload:
             return jwt_payload
@@ -289,18 +323,6 @@ class CreateBlogPost(Resource):
                 "error": "Error creating your blog post"
             }
 
-        # Get all blog posts for user
-        blog_posts = getAllBlogPostsForUser(user_id)
-        if blog_posts is None:
-            return {
-                "error": "Error fetching your blog posts"
-            }
-
-        # Start building the blog posts. # Todo: Track build stages and errors
-        # Todo: This rebuilds all the blog posts and profile.
-        # Should track the changed blog in /var/www/about-me.website/<user_directory> and move only the changed files
-        startBuildingBlogPosts(blog_posts, user_profile_result['data'])
-
         # Get the current blog post
         current_blog_post = getMostRecentBlogPostForUser(user_id)
         if current_blog_post is None:
@@ -312,15 +334,17 @@ class CreateBlogPost(Resource):
         blog_post_name = current_blog_post["title"].replace(" ", "-").lower() + "-" + str(current_blog_post["post_id"])
         url = BASE_URL + "/" + user_profile_result['data']['directory_id'] + "/blog/" + blog_post_name
 
-        # Notify that the build is completed
-        sendBuildCompletedSMS(jwt_payload["phone"], "blog post", url)
+        # Queue the build. The build worker sends the SMS once the site is deployed.
+        db_pool.commit()
+        job_id = queueSiteBuild(user_id, user_profile_result['data']['directory_id'], jwt_payload["phone"], "blog post", url)
 
         return {"data": {
-            "status" : "Build Started"
+            "status" : "Build Started",
+            "job_id": job_id
         }}, 200
 api.add_resource(CreateBlogPost, '/create-blog-post')
 
-class Directory(Resource):
+class Directory(AuthenticatedResource):
     def __init__(self):
         self.reqparse = reqparse.RequestParser()
         self.reqparse.add_argument('token', type = str, required = True, help = 'No access token was provided', location = 'json')
@@ -333,7 +357,7 @@ class Directory(Resource):
         json_data = request.get_json()
 
         # Validate the JWT token.
-        jwt_payload = decodeJwttoken(json_data["token"])
+        jwt_payload = self.authenticate(json_data["token"])
         if "error" in jwt_payload:
             return jwt_payload
         
@@ -345,227 +369,537 @@ class Directory(Resource):
         }}, 200
 api.add_resource(Directory, '/get-user-directory')
 
+# Published blog posts of a site, newest first. Pass the returned next_cursor to get
+# the following page; it is null on the last page.
+class BlogPosts(Resource):
+    def __init__(self):
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('limit', type = int, default = BLOG_POSTS_PAGE_SIZE, location = 'args')
+        self.reqparse.add_argument('cursor', type = str, location = 'args')
+        super(BlogPosts, self).__init__()
+
+    def get(self, directory_id):
+        args = self.reqparse.parse_args()
+
+        if args["limit"] < 1 or args["limit"] > BLOG_POSTS_MAX_PAGE_SIZE:
+            return {"error": "limit must be between 1 and {0}".format(BLOG_POSTS_MAX_PAGE_SIZE)}, 400
+
+        after = None
+        if args["cursor"]:
+            after = decodeBlogPostCursor(args["cursor"])
+            if after is None:
+                return {"error": "Invalid cursor"}, 400
+
+        user_id = getUserIdForDirectory(directory_id)
+        if user_id is None:
+            return {"error": "No site found with this directory"}, 404
+
+        blog_posts, next_cursor = getBlogPostsPage(user_id, args["limit"], after)
+        return {"data": {
+            "blog_posts": blog_posts,
+            "next_cursor": next_cursor
+        }}, 200
+api.add_resource(BlogPosts, '/blog-posts/<string:directory_id>')
+
+# State of one of the caller's builds.
+class BuildStatus(AuthenticatedResource):
+    def __init__(self):
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('token', type = str, required = True, help = 'No access token was provided', location = 'json')
+        super(BuildStatus, self).__init__()
+
+    def get(self, job_id):
+        self.reqparse.parse_args()
+        json_data = request.get_json()
+
+        jwt_payload = self.authenticate(json_data["token"])
+        if "error" in jwt_payload:
+            return jwt_payload
+
+        # Other users' builds are reported as missing.
+        payload = build_jobs.get_payload(job_id)
+        if payload is None or payload.get("user_id") != jwt_payload["sub"]:
+            return {"error": "No build found with this id"}, 404
+        return {"data": build_jobs.get_job(job_id)}, 200
+api.add_resource(BuildStatus, '/build-status/<string:job_id>')
+
+class BuildQueueStats(SignedResource):
+    def get(self):
+        return {"data": dict(build_jobs.queue_stats(), build_cache=buildCacheStats())}, 200
+api.add_resource(BuildQueueStats, '/build-queue-stats')
+
+# Disk used by source workspaces, build outputs and profile renderers against WORKSPACE_DISK_BUDGET_MB.
+class WorkspaceStats(SignedResource):
+    def get(self):
+        return {"data": workspaces.disk_usage()}, 200
+api.add_resource(WorkspaceStats, '/workspace-stats')
+
+# Profile cache hit/miss/eviction counters of the worker that answered.
+class CacheStats(SignedResource):
+    def get(self):
+        return {"data": profile_cache.stats()}, 200
+api.add_resource(CacheStats, '/cache-stats')
+
+# Outbound SMS queue counters of the worker that answered.
+class SmsQueueStats(SignedResource):
+    def get(self):
+        return {"data": notifications.stats()}, 200
+api.add_resource(SmsQueueStats, '/sms-queue-stats')
+
+# Per-worker connection pool counters, used to size DB_POOL_SIZE against the uwsgi process count.
+class PoolStats(SignedResource):
+    def get(self):
+        return {"data": dict(db_pool.get_pool().stats(), requests=db_pool.request_stats())}, 200
+api.add_resource(PoolStats, '/db-pool-stats')
+
+# Build metrics of all uwsgi workers in the Prometheus text format.
+class Metrics(Resource):
+    def get(self):
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+api.add_resource(Metrics, '/metrics')
+
+# Sampling profiler of the worker that answered. Calls must be signed, see profiler.py.
+class Profiler(Resource):
+    def __init__(self):
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('requests', type = int, location = 'json')
+        self.reqparse.add_argument('seconds', type = float, location = 'json')
+        super(Profiler, self).__init__()
+
+    def get(self):
+        if not profiler.authorized():
+            return {"error": "Profiler is disabled or the signature is invalid"}, 403
+        return {"data": profiler.status()}, 200
+
+    # Starts a session for the next `requests` requests or for `seconds` seconds.
+    def post(self):
+        if not profiler.authorized():
+            return {"error": "Profiler is disabled or the signature is invalid"}, 403
+        args = self.reqparse.parse_args()
+        if (args["requests"] is None) == (args["seconds"] is None):
+            return {"error": "Pass either requests or seconds"}, 400
+        if (args["requests"] is not None and args["requests"] < 1) or (args["seconds"] is not None and args["seconds"] <= 0):
+            return {"error": "requests and seconds must be positive"}, 400
+        session = profiler.start(requests=args["requests"], seconds=args["seconds"])
+        if session is None:
+            return {"error": "A profiling session is already running in this worker"}, 409
+        return {"data": session}, 201
+
+    def delete(self):
+        if not profiler.authorized():
+            return {"error": "Profiler is disabled or the signature is invalid"}, 403
+        profiler.stop()
+        return {"data": profiler.status()}, 200
+api.add_resource(Profiler, '/debug/profile')
+
+# Allocation hotspots of the worker that answered, by file and line. Calls must be signed.
+class MemorySnapshot(Resource):
+    def __init__(self):
+        self.reqparse = reqparse.RequestParser()
+        self.reqparse.add_argument('frames', type = int, default = 1, location = 'json')
+        self.report_reqparse = reqparse.RequestParser()
+        self.report_reqparse.add_argument('limit', type = int, default = 20, location = 'args')
+        super(MemorySnapshot, self).__init__()
+
+    def get(self):
+        if not profiler.authorized():
+            return {"error": "Profiler is disabled or the signature is invalid"}, 403
+        report = profiler.allocation_report(self.report_reqparse.parse_args()["limit"])
+        if report is None:
+            return {"error": "tracemalloc is not running in this worker, POST to start it"}, 409
+        return {"data": report}, 200
+
+    def post(self):
+        if not profiler.authorized():
+            return {"error": "Profiler is disabled or the signature is invalid"}, 403
+        profiler.start_tracemalloc(self.reqparse.parse_args()["frames"])
+        return {"data": {"pid": os.getpid(), "tracing": True}}, 201
+
+    def delete(self):
+        if not profiler.authorized():
+            return {"error": "Profiler is disabled or the signature is invalid"}, 403
+        profiler.stop_tracemalloc()
+        return {"data": {"pid": os.getpid(), "tracing": False}}, 200
+api.add_resource(MemorySnapshot, '/debug/tracemalloc')
+
 # Helper methods
 def saveBlogPost(user_id, title, description):
     # Save the blog post to the user blog post table
     # Todo: Add a try catch block to return error if one occurs
     try:
-        db = mysql.connector.connect(
-            host=config('DB_HOST'),
-            user=config('DB_USER'),
-            password=config('DB_PASSWORD'),
-            database=config('DB_NAME')
-        )
-
-        cursor = db.cursor()
-        sql = "INSERT INTO `user_blog_post` (user_id, title, description) VALUES \
-            (%s, %s, %s)"
-
-        val = (user_id, title, description)
-
-        cursor.execute(sql, val)
-        db.commit()
-        cursor.close()
-        db.close()
-        return True
+        with db_pool.connection() as db:
+            cursor = db.cursor()
+            sql = "INSERT INTO `user_blog_post` (user_id, title, description) VALUES \
+                (%s, %s, %s)"
+
+            val = (user_id, title, description)
+
+            cursor.execute(sql, val)
+            db.commit()
+            invalidateProfileCache(user_id)
+            cursor.close()
+            return True
     except mysql.connector.Error as err:
         print("Something went wrong: {}".format(err))
         return False
     
 def getMostRecentBlogPostForUser(user_id):
     try:
-        db = mysql.connector.connect(
-            host=config('DB_HOST'),
-            user=config('DB_USER'),
-            password=config('DB_PASSWORD'),
-            database=config('DB_NAME')
-        )
+        with db_pool.connection() as db:
+            cursor = db.cursor()
+            sql = "SELECT post_id, user_id, title, created_at, description FROM `user_blog_post` WHERE user_id = %s \
+                ORDER BY created_at DESC, post_id DESC LIMIT 1"
+            val = (user_id, )
+            cursor.execute(sql, val)
+
+            result = cursor.fetchall()
+            if len(result) == 0:
+                return None
         
+            record = result[0]
+            return {
+                "post_id": record[0],
+                "user_id": record[1],
+                "title": record[2],
+                "created_at": str(record[3]),
+                "description": record[4]
+            }
+    except mysql.connector.Error as err:
+        print("Something went wrong: {}".format(err))
+        return None
+
+@profile_cache.cached("blog_posts")
+def getAllBlogPostsForUser(user_id):
+    try:
+        with db_pool.connection() as db:
+            cursor = db.cursor()
+            sql = "SELECT post_id, user_id, title, created_at, description FROM `user_blog_post` WHERE user_id = %s \
+                ORDER BY created_at DESC, post_id DESC LIMIT 10"
+            val = (user_id, )
+            cursor.execute(sql, val)
+
+            result = cursor.fetchall()
+            if len(result) == 0:
+                return None
+        
+            blog_posts = []
+            for post in result:
+                blog_post = {}
+                blog_post["post_id"] = post[0]
+                blog_post["user_id"] = post[1]
+                blog_post["title"] = post[2]
+                blog_post["created_at"] = str(post[3])
+                blog_post["description"] = post[4]
+                blog_posts.append(blog_post)
+
+            return blog_posts
+    except mysql.connector.Error as err:
+        print("Something went wrong: {}".format(err))
+        return None
+
+# Keyset pagination over a user's posts, newest first. `after` is the (created_at, post_id)
+# of the last post of the previous page. The query walks the (user_id, created_at)
+# index from that point, so every page costs the same however many posts the user has.
+# Returns (blog_posts, next_cursor).
+def getBlogPostsPage(user_id, limit, after=None):
+    with db_pool.connection() as db:
         cursor = db.cursor()
-        sql = "SELECT * FROM `user_blog_post` WHERE user_id = %s ORDER BY created_at DESC LIMIT 1"
-        val = (user_id, )
+        if after is None:
+            sql = "SELECT post_id, title, created_at, description FROM `user_blog_post` WHERE user_id = %s \
+                ORDER BY created_at DESC, post_id DESC LIMIT %s"
+            val = (user_id, limit + 1)
+        else:
+            sql = "SELECT post_id, title, created_at, description FROM `user_blog_post` WHERE user_id = %s \
+                AND (created_at < %s OR (created_at = %s AND post_id < %s)) \
+                ORDER BY created_at DESC, post_id DESC LIMIT %s"
+            val = (user_id, after[0], after[0], after[1], limit + 1)
+        cursor.execute(sql, val)
+        result = cursor.fetchall()
+        cursor.close()
+
+        blog_posts = []
+        for post in result[:limit]:
+            blog_posts.append({
+                "post_id": post[0],
+                "title": post[1],
+                "created_at": str(post[2]),
+                "description": post[3]
+            })
+
+        # The extra row only tells whether there is another page.
+        next_cursor = None
+        if len(result) > limit:
+            next_cursor = encodeBlogPostCursor(blog_posts[-1]["created_at"], blog_posts[-1]["post_id"])
+        return blog_posts, next_cursor
+
+def encodeBlogPostCursor(created_at, post_id):
+    return base64.urlsafe_b64encode("{0}|{1}".format(created_at, post_id).encode('utf-8')).decode('utf-8')
+
+# Returns (created_at, post_id) or None if the cursor was not made by encodeBlogPostCursor.
+def decodeBlogPostCursor(value):
+    try:
+        created_at, post_id = base64.urlsafe_b64decode(value.encode('utf-8')).decode('utf-8').split("|")
+        return datetime.datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S"), int(post_id)
+    except ValueError:
+        return None
+
+def getUserIdForDirectory(directory_id):
+    with db_pool.connection() as db:
+        cursor = db.cursor()
+        sql = "SELECT user_id FROM user_directory WHERE directory_id = %s LIMIT 1"
+        val = (directory_id,)
         cursor.execute(sql, val)
 
         result = cursor.fetchall()
+        cursor.close()
         if len(result) == 0:
             return None
-        
+        return result[0][0]
+
+def getBlogPost(post_id, user_id):
+    with db_pool.connection() as db:
+        cursor = db.cursor()
+        sql = "SELECT * FROM `user_blog_post` WHERE post_id = %s AND user_id = %s LIMIT 1"
+        val = (post_id, user_id)
+        cursor.execute(sql, val)
+
+        result = cursor.fetchall()
+        if len(result) == 0:
+            return None
+    
         record = result[0]
         return {
             "post_id": record[0],
             "user_id": record[1],
             "title": record[2],
             "created_at": str(record[3]),
-            "description": record[4]
+            "descritpion": record[4]
         }
-    except mysql.connector.Error as err:
-        print("Something went wrong: {}".format(err))
-        return None
 
-def getAllBlogPostsForUser(user_id):
-    try:
-        db = mysql.connector.connect(
-            host=config('DB_HOST'),
-            user=config('DB_USER'),
-            password=config('DB_PASSWORD'),
-            database=config('DB_NAME')
-        )
-        
+# Loads every site's profile, top skills and newest blog posts in three queries for fleet rebuilds.
+# Returns a list of (user_profile, blog_posts) in the same shape as loadFullProfile and getAllBlogPostsForUser.
+def loadAllSitesForRebuild():
+    with db_pool.connection() as db:
         cursor = db.cursor()
-        sql = "SELECT * FROM `user_blog_post` WHERE user_id = %s ORDER BY created_at DESC LIMIT 10"
-        val = (user_id, )
+        cursor.execute("SELECT u.user_id, u.first_name, u.last_name, u.email, u.current_employer, u.description, \
+            u.profession, u.profile_pic, d.directory_id FROM user u JOIN user_directory d ON d.user_id = u.user_id \
+            ORDER BY d.directory_id")
+        users = cursor.fetchall()
+
+        cursor.execute("SELECT user_id, skill_name FROM user_top_skill ORDER BY skill_id")
+        top_skills = {}
+        for user_id, skill_name in cursor.fetchall():
+            top_skills.setdefault(user_id, []).append(skill_name)
+
+        # The 10 newest posts of each user, in the order getAllBlogPostsForUser returns them.
+        cursor.execute("SELECT post_id, user_id, title, created_at, description FROM ( \
+            SELECT post_id, user_id, title, created_at, description, \
+                ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY created_at DESC, post_id DESC) AS post_rank \
+            FROM user_blog_post) ranked WHERE post_rank <= 10 ORDER BY user_id, post_rank")
+        blog_posts = {}
+        for post in cursor.fetchall():
+            blog_posts.setdefault(post[1], []).append({
+                "post_id": post[0],
+                "user_id": post[1],
+                "title": post[2],
+                "created_at": str(post[3]),
+                "description": post[4]
+            })
+        cursor.close()
+
+    sites = []
+    for user_record in users:
+        user_profile = {
+            "user_id": user_record[0],
+            "first_name": user_record[1],
+            "last_name": user_record[2],
+            "email": user_record[3],
+            "current_employer": user_record[4],
+            "description": user_record[5],
+            "profession": user_record[6],
+            "profile_pic": user_record[7],
+            "directory_id": user_record[8],
+            "top_skills": top_skills.get(user_record[0], [])[:3]
+        }
+        sites.append((user_profile, blog_posts.get(user_record[0], [])))
+    return sites
+
+# A user row with its directory and top skills, as returned by loadUserProfile.
+class UserProfile(TypedDict):
+    user_id: str
+    first_name: str
+    last_name: str
+    email: Optional[str]
+    current_employer: Optional[str]
+    description: Optional[str]
+    profession: Optional[str]
+    profile_pic: Optional[str]
+    directory_id: Optional[str]
+    top_skills: List[str]
+
+# Loads the user row, directory_id and top skills in a single round trip.
+# Returns None if the user has no profile yet.
+@profile_cache.cached("full_profile")
+def loadUserProfile(user_id) -> Optional[UserProfile]:
+    with db_pool.connection() as db:
+        cursor = db.cursor()
+        sql = "SELECT u.user_id, u.first_name, u.last_name, u.email, u.current_employer, u.description, u.profession, \
+            u.profile_pic, (SELECT directory_id FROM user_directory WHERE user_id = u.user_id LIMIT 1), s.skill_name \
+            FROM user u LEFT JOIN user_top_skill s ON s.user_id = u.user_id \
+            WHERE u.user_id = %s ORDER BY s.skill_id LIMIT 3"
+        val = (user_id,)
         cursor.execute(sql, val)
 
         result = cursor.fetchall()
+        cursor.close()
         if len(result) == 0:
             return None
-        
-        blog_posts = []
-        for post in result:
-            blog_post = {}
-            blog_post["post_id"] = post[0]
-            blog_post["user_id"] = post[1]
-            blog_post["title"] = post[2]
-            blog_post["created_at"] = str(post[3])
-            blog_post["description"] = post[4]
-            blog_posts.append(blog_post)
-
-        return blog_posts
-    except mysql.connector.Error as err:
-        print("Something went wrong: {}".format(err))
-        return None
 
-def getBlogPost(post_id, user_id):
-    db = mysql.connector.connect(
-        host=config('DB_HOST'),
-        user=config('DB_USER'),
-        password=config('DB_PASSWORD'),
-        database=config('DB_NAME')
-    )
-    
-    cursor = db.cursor()
-    sql = "SELECT * FROM `user_blog_post` WHERE post_id = %s user_id = %s LIMIT 1"
-    val = (post_id, user_id)
-    cursor.execute(sql, val)
-
-    result = cursor.fetchall()
-    if len(result) == 0:
-        return None
-    
-    record = result[0]
-    return {
-        "post_id": record[0],
-        "user_id": record[1],
-        "title": record[2],
-        "created_at": str(record[3]),
-        "descritpion": record[4]
-    }
+        user_record = result[0]
+        return UserProfile(
+            user_id=user_record[0],
+            first_name=user_record[1],
+            last_name=user_record[2],
+            email=user_record[3],
+            current_employer=user_record[4],
+            description=user_record[5],
+            profession=user_record[6],
+            profile_pic=user_record[7],
+            directory_id=user_record[8],
+            top_skills=[record[9] for record in result if record[9] is not None]
+        )
 
 def loadFullProfile(user_id):
+    user_profile = loadUserProfile(user_id)
+
     # Check if profile is created
-    user_profile = getUserProfile(user_id)
     if user_profile is None:
         return {
             "error": "You must create a profile before I can build your profile page"
         }
     
     # Check if the user directory is created
-    directory_id = getUserDirectory(user_profile["user_id"])
-    if directory_id is None:
+    if user_profile["directory_id"] is None:
         return {
             "error": "No directory was generated"
         }
-    user_profile["directory_id"] = directory_id
 
     # Check if the user has top skills
-    top_skills = getUserTopSkills(user_profile["user_id"])
-    if top_skills is None:
+    if not user_profile["top_skills"]:
         return {
             "error": "Missing top skills"
         }
     
-    user_profile["top_skills"] = top_skills
     return {
         "data": user_profile
     }
 
+@profile_cache.cached("directory")
 def getUserDirectory(user_id):
-    db = mysql.connector.connect(
-        host=config('DB_HOST'),
-        user=config('DB_USER'),
-        password=config('DB_PASSWORD'),
-        database=config('DB_NAME')
-    )
-    
-    cursor = db.cursor()
-    sql = "SELECT directory_id FROM user_directory WHERE user_id = %s LIMIT 1"
-    val = (user_id,)
-    cursor.execute(sql, val)
+    with db_pool.connection() as db:
+        cursor = db.cursor()
+        sql = "SELECT directory_id FROM user_directory WHERE user_id = %s LIMIT 1"
+        val = (user_id,)
+        cursor.execute(sql, val)
 
-    result = cursor.fetchall()
-    if len(result) == 0:
-        return None
-    return result[0][0]
+        result = cursor.fetchall()
+        if len(result) == 0:
+            return None
+        return result[0][0]
 
 def generateUserDirectoryID(user_id, first_name, last_name):
     directory_id = first_name + "-" + last_name
-    db = mysql.connector.connect(
-        host=config('DB_HOST'),
-        user=config('DB_USER'),
-        password=config('DB_PASSWORD'),
-        database=config('DB_NAME')
-    )
-    
-    cursor = db.cursor()
-    sql = "SELECT count(directory_id) as total_count FROM user_directory WHERE directory_id = %s LIMIT 1"
-    val = (directory_id,)
-    cursor.execute(sql, val)
-
-    result = cursor.fetchall()
-    if len(result) == 0:
-        saveUserDirectory(user_id, directory_id)
-    else:
-        total_count = result[0][0]
-        if total_count > 0:
-            directory_id = directory_id + "-" + str(total_count)
-        saveUserDirectory(user_id, directory_id)
-    return directory_id
+    with db_pool.connection() as db:
+        cursor = db.cursor()
+        sql = "SELECT count(directory_id) as total_count FROM user_directory WHERE directory_id = %s LIMIT 1"
+        val = (directory_id,)
+        cursor.execute(sql, val)
+
+        result = cursor.fetchall()
+        if len(result) == 0:
+            saveUserDirectory(user_id, directory_id)
+        else:
+            total_count = result[0][0]
+            if total_count > 0:
+                directory_id = directory_id + "-" + str(total_count)
+            saveUserDirectory(user_id, directory_id)
+        return directory_id
 
 def saveUserDirectory(user_id, directory_id):
     # Save the number to the user_auth table
-    db = mysql.connector.connect(
-        host=config('DB_HOST'),
-        user=config('DB_USER'),
-        password=config('DB_PASSWORD'),
-        database=config('DB_NAME')
-    )
-
-    cursor = db.cursor()
-    sql = "INSERT INTO `user_directory` (directory_id, user_id) VALUES \
-        (%s, %s)"
+    with db_pool.connection() as db:
+        cursor = db.cursor()
+        sql = "INSERT INTO `user_directory` (directory_id, user_id) VALUES \
+            (%s, %s)"
 
-    val = (directory_id, user_id)
+        val = (directory_id, user_id)
 
-    cursor.execute(sql, val)
-    db.commit()
+        cursor.execute(sql, val)
+        db.commit()
+        invalidateProfileCache(user_id)
 
 # Build Section Helpers
+class CommandFailed(Exception):
+    def __init__(self, command, returncode):
+        super(CommandFailed, self).__init__("Command \"{0}\" failed with exit status {1}".format(command, returncode))
+        self.returncode = returncode
+
 # Runs a shell command. Throws an exception if fails.
 def run_command(command):
     command_list = command.split(" ")
     try:
         logger.info("Running shell command: \"{0}\"".format(command))
-        result = subprocess.run(command_list, stdout=subprocess.PIPE)
+        with accounting.track("subprocess"):
+            result = subprocess.run(command_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
         logger.info("Command output:\n---\n{0}\n---".format(result.stdout.decode('UTF-8')))
     except Exception as e:
         logger.error("Exception: {0}".format(e))
         raise e
+    if result.returncode != 0:
+        raise CommandFailed(command, result.returncode)
+    return True
+
+# Files written by the current build, only tracked when debug logging is on.
+_build_manifest = threading.local()
+
+def record_written_file(file_path):
+    if logger.isEnabledFor(logging.DEBUG):
+        if not hasattr(_build_manifest, "files"):
+            _build_manifest.files = []
+        _build_manifest.files.append(file_path)
+
+# Logs the files written by this build with their sizes and resets the list.
+def log_build_manifest(local_source_dir, local_build_dir):
+    files = getattr(_build_manifest, "files", [])
+    _build_manifest.files = []
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    lines = ["{0} ({1} bytes)".format(path, os.path.getsize(path)) for path in files if os.path.exists(path)]
+    output_count = sum(len(names) for _, _, names in os.walk(local_build_dir))
+    logger.debug("Build manifest for {0}:\n{1}\n{2} files in {3}".format(local_source_dir, "\n".join(lines),
+        output_count, local_build_dir))
+
+# Writes content to file_path unless the file already holds exactly that content.
+# Returns True if the file was written.
+def write_file_if_changed(file_path, content):
+    if os.path.exists(file_path):
+        with open(file_path, 'r') as file:
+            if file.read() == content:
+                logger.info('{0} is unchanged'.format(file_path))
+                return False
+    with open(file_path, 'w') as file:
+        file.write(content)
+    metrics.BUILD_FILES_WRITTEN.inc(step="generate")
     return True
 
 def build_blog_post_file(blog_post, local_source_dir, user_profile):
     # Todo: Add relavant meta tags in description
     # Todo: Escape single quote
-    current_datetime = datetime.datetime.now()
+    # Date the post by its creation time so an unchanged post renders to the same file on every build.
+    if blog_post.get("created_at"):
+        current_datetime = datetime.datetime.fromisoformat(blog_post["created_at"])
+    else:
+        current_datetime = datetime.datetime.now()
     iso_formated_dt = current_datetime.strftime('%Y-%m-%dT%H:%M:%S.%f%z')
     author = user_profile["first_name"] + " " + user_profile["last_name"]
     image_path = "images/blog/default-blog-post-image.jpg"
@@ -575,15 +909,27 @@ def build_blog_post_file(blog_post, local_source_dir, user_profile):
     blog_post_name = blog_post["title"].replace(" ", "-")
     blog_post_file_path = local_source_dir + "/content/blog/" + blog_post_name + "-" +str(blog_post["post_id"]) + ".md"
     
-    if os.path.exists(blog_post_file_path):
-        os.remove(blog_post_file_path)
-        logger.info('Removing old blog post file')
-    file = open(blog_post_file_path, 'w')
-    file.write(blog_post_content)
-    file.close()
-    run_command("cat {0}".format(blog_post_file_path))
+    if write_file_if_changed(blog_post_file_path, blog_post_content):
+        record_written_file(blog_post_file_path)
     logger.info('Done generating blog post file')
-        
+    return blog_post_file_path
+
+# Deletes the post files of the persistent workspace that are not in blog_post_file_paths,
+# so deleted or renamed posts are not published again. Posts shipped with the template stay.
+def prune_blog_post_files(local_source_dir, template_home, blog_post_file_paths):
+    blog_dir = os.path.join(local_source_dir, "content", "blog")
+    if not os.path.isdir(blog_dir):
+        return
+    keep = set(os.path.normpath(path) for path in blog_post_file_paths)
+    for name in os.listdir(blog_dir):
+        file_path = os.path.join(blog_dir, name)
+        if not name.endswith(".md") or os.path.normpath(file_path) in keep:
+            continue
+        if os.path.exists(os.path.join(template_home, "content", "blog", name)):
+            continue
+        os.remove(file_path)
+        logger.info('Removed stale blog post file {0}'.format(file_path))
+
 
 def build_config(user_profile, user_directory, local_source_dir):
     config_data = 'baseURL = "https://about-me.website/{0}"\n\
@@ -644,13 +990,8 @@ def build_config(user_profile, user_directory, local_source_dir):
     address = "{4}"'.format(user_directory, user_profile["first_name"].title(), user_profile["email"], "N/A", "N/A")
 
     config_file_path = local_source_dir +"/config.toml"
-    if os.path.exists(config_file_path):
-        os.remove(config_file_path)
-        logger.info('Removing old config file')
-    file = open(config_file_path, 'w')
-    file.write(config_data)
-    file.close()
-    run_command("cat {0}".format(config_file_path))
+    if write_file_if_changed(config_file_path, config_data):
+        record_written_file(config_file_path)
     logger.info('Done generating config file')
     
 def build_user_fields_yaml(user_profile, user_directory):
@@ -703,34 +1044,17 @@ def build_skills_yaml(user_profile):
     return REFERENCE_TEMPLATE_SKILLS_YAML
 
 
-# Copies template from ~/hugo-templates/default-templates to /tmp/hugo_source
-def copy_template_to_temp_dir(local_template_home, local_source_dir):
-    if os.path.isdir(local_source_dir):
-        run_command("rm -rd {0}".format(local_source_dir))
-    run_command("mkdir {0}".format(local_source_dir))
-    logger.info('Starting copying template folder to {0}'.format(local_source_dir))
-    run_command("cp -a {0} {1}".format(local_template_home+"/.", local_source_dir+"/"))
-    run_command("ls -l {0}".format(local_source_dir))
-    logger.info('Done copying template folder to {0}'.format(local_source_dir))
-
 # Build about-me template
 def generate_about_me_page(local_source_dir, reference_template):
     logger.info('Generating about me page')
 
     # Write the string REFERENCE_TEMPLATE to file.
     about_page_dir = local_source_dir + "/content/about/"
-    if not os.path.isdir(about_page_dir):
-        run_command("mkdir {0}".format(about_page_dir))
+    os.makedirs(about_page_dir, exist_ok=True)
     about_page_file_path = about_page_dir + "_index.md"
     
-    if os.path.exists(about_page_file_path):
-        os.remove(about_page_file_path)
-        logger.info('Removing old files')
-    #run_command('touch {0}'.format(about_page_file_path))
-    file = open(about_page_file_path, 'w')
-    file.write(reference_template)
-    file.close()
-    run_command("cat {0}".format(about_page_file_path))
+    if write_file_if_changed(about_page_file_path, reference_template):
+        record_written_file(about_page_file_path)
     logger.info('Done generating about me page')
 
 def generate_about_me_section_yaml(local_source_dir, reference_template_yaml):
@@ -738,18 +1062,11 @@ def generate_about_me_section_yaml(local_source_dir, reference_template_yaml):
 
     # Write the string REFERENCE_TEMPLATE to file.
     about_info_data_dir = local_source_dir + "/data/"
-    if not os.path.isdir(about_info_data_dir):
-        run_command("mkdir {0}".format(about_info_data_dir))
+    os.makedirs(about_info_data_dir, exist_ok=True)
     about_info_file_path = about_info_data_dir + "aboutinfo.yml"
     
-    if os.path.exists(about_info_file_path):
-        os.remove(about_info_file_path)
-        logger.info('Removing old files')
-    #run_command('touch {0}'.format(about_info_file_path))
-    file = open(about_info_file_path, 'w')
-    file.write(reference_template_yaml)
-    file.close()
-    run_command("cat {0}".format(about_info_file_path))
+    if write_file_if_changed(about_info_file_path, reference_template_yaml):
+        record_written_file(about_info_file_path)
     logger.info('Done generating about info section yaml')
     
 def generate_skills_section_yaml(user_profile, local_source_dir, reference_template_skills_yaml):
@@ -760,82 +1077,136 @@ def generate_skills_section_yaml(user_profile, local_source_dir, reference_templ
 
     # Write the string REFERENCE_TEMPLATE to file.
     skills_file_path = local_source_dir + "/data/skillsinfo.yml"
-    if os.path.exists(skills_file_path):
-        os.remove(skills_file_path)
-        logger.info('Removing old files')
-    
-    run_command("touch {0}".format(skills_file_path))
-    file = open(skills_file_path, 'w')
-    file.write(reference_template_skills_yaml)
-    file.close()
-    run_command("cat {0}".format(skills_file_path))
+    if write_file_if_changed(skills_file_path, reference_template_skills_yaml):
+        record_written_file(skills_file_path)
     logger.info('Done generating skill info section yaml')
 
 # Builds a hugo website
 def build_hugo(source_dir, destination_dir, debug=False):
     if os.path.isdir(destination_dir):
-        run_command("rm -rd {0}".format(destination_dir))
-    run_command("mkdir {0}".format(destination_dir))
+        shutil.rmtree(destination_dir)
+    os.makedirs(destination_dir)
     logger.info("Building Hugo site")
-    run_command("/usr/local/bin/hugo -s {0} -d {1}".format(source_dir,destination_dir))
-    run_command("ls -l {0}".format(destination_dir))
+    exit_status = "not_started"
+    try:
+        run_command("{0} -s {1} -d {2}".format(config('HUGO_BIN', default='/usr/local/bin/hugo'), source_dir, destination_dir))
+        exit_status = 0
+    except CommandFailed as e:
+        exit_status = e.returncode
+        raise
+    finally:
+        metrics.HUGO_RUNS.inc(exit_status=exit_status)
+    metrics.BUILD_FILES_WRITTEN.inc(sum(len(names) for _, _, names in os.walk(destination_dir)), step="hugo")
+    log_build_manifest(source_dir, destination_dir)
     logger.info('Done building hugo public assets')
 
-def copy_build_to_destination(build_dir, destination_dir):
-    logger.info('Starting copying build folder to destination')
-    if os.path.isdir(destination_dir):
-        run_command("rm -rd {0}".format(destination_dir))
-    run_command("mkdir {0}".format(destination_dir))
-    run_command("cp -a {0} {1}".format(build_dir+"/.", destination_dir+"/"))
-    run_command("ls -l {0}".format(destination_dir))
-    logger.info('Done copying build folder to destination')
+# Build cache counters of this process.
+_build_cache_counters = {"hits": 0, "misses": 0}
+_build_cache_lock = threading.Lock()
+
+# Digest of everything this app generates into the source workspace plus the template
+# version, i.e. every input of the hugo run. The blog folder is hashed as a whole since
+# hugo renders every post file in it.
+def build_input_digest(local_source_dir, template_version):
+    digest = hashlib.sha256(template_version.encode('utf-8'))
+    paths = ["config.toml", "data/aboutinfo.yml", "data/skillsinfo.yml"]
+    blog_dir = os.path.join(local_source_dir, "content", "blog")
+    if os.path.isdir(blog_dir):
+        paths += sorted("content/blog/" + name for name in os.listdir(blog_dir))
+    for relative_path in paths:
+        file_path = os.path.join(local_source_dir, relative_path)
+        if not os.path.isfile(file_path):
+            continue
+        digest.update(relative_path.encode('utf-8') + b"\0")
+        with open(file_path, 'rb') as file:
+            digest.update(hashlib.sha256(file.read()).digest())
+    return digest.hexdigest()
+
+# Runs hugo and deploys a new release, unless the live release was built from
+# exactly these inputs. The digest is stored in the site info with the release it produced,
+# so a rollback to an older release makes the next build run again.
+def build_and_deploy(local_source_dir, local_build_dir, directory_id, template_home):
+    digest = build_input_digest(local_source_dir, workspaces.template_version(template_home))
+    site_info = deploy.read_site_info(directory_id)
+    live_release = deploy.current_release(directory_id)
+    if site_info.get("build_digest") == digest and live_release \
+            and os.path.basename(live_release) == site_info.get("build_release"):
+        with _build_cache_lock:
+            _build_cache_counters["hits"] += 1
+        metrics.BUILD_CACHE.inc(result="hit")
+        logger.info('Inputs of {0} are unchanged, keeping release {1}'.format(directory_id, site_info.get("build_release")))
+        return
+    with _build_cache_lock:
+        _build_cache_counters["misses"] += 1
+    metrics.BUILD_CACHE.inc(result="miss")
+
+    build_jobs.set_stage("hugo")
+    build_hugo(local_source_dir, local_build_dir)
+
+    build_jobs.set_stage("deploy")
+    release_dir = deploy.deploy_release(local_build_dir, directory_id, template_home)
+    deploy.write_site_info(directory_id, build_digest=digest, build_release=os.path.basename(release_dir))
+
+def buildCacheStats():
+    with _build_cache_lock:
+        output = dict(_build_cache_counters)
+    total = output["hits"] + output["misses"]
+    output["hit_rate"] = output["hits"] / total if total else None
+    return output
 
+# Writes the generated source files of a profile-only site. profile_renderer also
+# uses it to compile the theme, so both paths always generate the same inputs.
+def generate_profile_source(user_profile, local_source_dir):
+    build_config(user_profile, user_profile["directory_id"], local_source_dir)
+    generate_about_me_section_yaml(local_source_dir, build_user_fields_yaml(user_profile, user_profile["directory_id"]))
+    generate_skills_section_yaml(user_profile, local_source_dir, build_skills_yaml(user_profile))
 
 def startBuildingProfilePage(user_profile):
     USER_DIRECTORY = user_profile["directory_id"]
     user_profile["phone"] = "N/A"
-    LOCAL_SOURCE_DIR = "/tmp/"+ USER_DIRECTORY + "-hugo-source"
-    LOCAL_BUILD_DIR = "/tmp/" + USER_DIRECTORY + "-hugo-build"
+    LOCAL_BUILD_DIR = workspaces.build_dir(USER_DIRECTORY)
     LOCAL_TEMPLATE_HOME = config('LOCAL_TEMPLATE_HOME')
+
+    # Fast path: render the site in-process from the compiled theme and deploy it.
+    build_jobs.set_stage("render")
+    if profile_renderer.render_profile(user_profile, LOCAL_BUILD_DIR, LOCAL_TEMPLATE_HOME, generate_profile_source, build_hugo):
+        build_jobs.set_stage("deploy")
+        deploy.deploy_release(LOCAL_BUILD_DIR, USER_DIRECTORY, LOCAL_TEMPLATE_HOME)
+        return
     
     # Build workflow.
-    # 1). Copy template to lambda temp directory.
-    copy_template_to_temp_dir(LOCAL_TEMPLATE_HOME, LOCAL_SOURCE_DIR)
-
-    # 2). Build config file.
-    build_config(user_profile, user_profile["directory_id"], LOCAL_SOURCE_DIR)
-
-    # 3). Read from DB and build the user about me fields.
-    REFERENCE_TEMPLATE_YAML = build_user_fields_yaml(user_profile, USER_DIRECTORY)
-    REFERENCE_TEMPLATE_SKILLS_YAML = build_skills_yaml(user_profile)
-
-    # 4). Using the user fields string generate the about me .md file in the LOCAL_SOURCE_DIR directory
-    generate_about_me_section_yaml(LOCAL_SOURCE_DIR, REFERENCE_TEMPLATE_YAML)
-    generate_skills_section_yaml(user_profile, LOCAL_SOURCE_DIR, REFERENCE_TEMPLATE_SKILLS_YAML)
+    # 1). Sync the template into this site's persistent source workspace.
+    build_jobs.set_stage("sync_template")
+    LOCAL_SOURCE_DIR = workspaces.prepare_source_workspace(LOCAL_TEMPLATE_HOME, USER_DIRECTORY)
 
-    # 5). Build the files using hugo available at /var/task/hugo included with the deployment package
-    build_hugo(LOCAL_SOURCE_DIR, LOCAL_BUILD_DIR)
+    # 2). Build config file, the about me fields and the skills.
+    build_jobs.set_stage("generate_data")
+    generate_profile_source(user_profile, LOCAL_SOURCE_DIR)
+    prune_blog_post_files(LOCAL_SOURCE_DIR, LOCAL_TEMPLATE_HOME, [])
 
-    # 6). Copy build to destination /var/www/about-me.website/html
-    DESTINATION_DIRECTORY = config('WWW_ROOT') + USER_DIRECTORY
-    copy_build_to_destination(LOCAL_BUILD_DIR, DESTINATION_DIRECTORY)
+    # 3). Build the files using hugo available at /var/task/hugo included with the deployment package
+    # 4). Deploy the build as a new release of /var/www/about-me.website/html/<user_directory>
+    # Both are skipped when the generated inputs match the live release.
+    build_and_deploy(LOCAL_SOURCE_DIR, LOCAL_BUILD_DIR, USER_DIRECTORY, LOCAL_TEMPLATE_HOME)
 
 def startBuildingBlogPosts(blog_posts, user_profile):
     user_profile["first_name"] = user_profile["first_name"].title()
     user_profile["last_name"] = user_profile["last_name"].title()
     USER_DIRECTORY = user_profile["directory_id"]
-    LOCAL_SOURCE_DIR = "/tmp/"+ USER_DIRECTORY + "-hugo-source"
-    LOCAL_BUILD_DIR = "/tmp/" + USER_DIRECTORY + "-hugo-build"
+    LOCAL_BUILD_DIR = workspaces.build_dir(USER_DIRECTORY)
     LOCAL_TEMPLATE_HOME = config('LOCAL_TEMPLATE_HOME')
     
     # Build workflow.
-    # 1). Copy template to lambda temp directory.
-    copy_template_to_temp_dir(LOCAL_TEMPLATE_HOME, LOCAL_SOURCE_DIR)
+    # 1). Sync the template into this site's persistent source workspace.
+    build_jobs.set_stage("sync_template")
+    LOCAL_SOURCE_DIR = workspaces.prepare_source_workspace(LOCAL_TEMPLATE_HOME, USER_DIRECTORY)
     
     # 2). Build config file.
+    build_jobs.set_stage("build_config")
     build_config(user_profile, USER_DIRECTORY, LOCAL_SOURCE_DIR)
 
     # 3). Read from DB and build the user about me fields.
+    build_jobs.set_stage("generate_data")
     REFERENCE_TEMPLATE_YAML = build_user_fields_yaml(user_profile, USER_DIRECTORY)
     REFERENCE_TEMPLATE_SKILLS_YAML = build_skills_yaml(user_profile)
 
@@ -844,15 +1215,79 @@ def startBuildingBlogPosts(blog_posts, user_profile):
     generate_skills_section_yaml(user_profile, LOCAL_SOURCE_DIR, REFERENCE_TEMPLATE_SKILLS_YAML)
    
     # 4b). Build a new blog post file for each blog post.
-    for blog_post in blog_posts:
-        build_blog_post_file(blog_post, LOCAL_SOURCE_DIR, user_profile)
+    build_jobs.set_stage("generate_blog_posts")
+    blog_post_file_paths = [build_blog_post_file(blog_post, LOCAL_SOURCE_DIR, user_profile) for blog_post in blog_posts]
+    prune_blog_post_files(LOCAL_SOURCE_DIR, LOCAL_TEMPLATE_HOME, blog_post_file_paths)
 
     # 5). Build the files using hugo available at /var/task/hugo included with the deployment package
-    build_hugo(LOCAL_SOURCE_DIR, LOCAL_BUILD_DIR)
-
-    # 6). Copy build to destination /var/www/about-me.website/html
-    DESTINATION_DIRECTORY = config('WWW_ROOT') + USER_DIRECTORY
-    copy_build_to_destination(LOCAL_BUILD_DIR, DESTINATION_DIRECTORY)
+    # 6). Deploy the build as a new release. Output unchanged since the live release is hard-linked, not copied.
+    # Both are skipped when the generated inputs match the live release.
+    build_and_deploy(LOCAL_SOURCE_DIR, LOCAL_BUILD_DIR, USER_DIRECTORY, LOCAL_TEMPLATE_HOME)
+
+# Builds and deploys one site while holding its site lock, then records the template
+# version it was built from so fleet rebuilds can skip it.
+def buildSite(user_profile, blog_posts):
+    kind = "blog" if blog_posts else "profile"
+    result = "failed"
+    started = time.monotonic()
+    metrics.BUILDS_IN_FLIGHT.inc()
+    try:
+        template_version = workspaces.template_version(config('LOCAL_TEMPLATE_HOME'))
+        with workspaces.site_lock(user_profile["directory_id"]):
+            try:
+                if blog_posts:
+                    startBuildingBlogPosts(blog_posts, user_profile)
+                else:
+                    startBuildingProfilePage(user_profile)
+            finally:
+                # The output is in a release now (or the build failed), either way it is not needed.
+                workspaces.remove_build_dir(user_profile["directory_id"])
+            deploy.write_site_info(user_profile["directory_id"], template_version=template_version)
+        result = "succeeded"
+    finally:
+        build_jobs.end_stage()
+        metrics.BUILDS_IN_FLIGHT.dec()
+        metrics.BUILD_SECONDS.observe(time.monotonic() - started, kind=kind, result=result)
+
+# Build Queue Helpers
+# Queues a build of the user's site. Requests for a site that already has a build waiting
+# in the queue are merged into it, so the returned job id may be shared.
+def queueSiteBuild(user_id, directory_id, phone, target, url):
+    return build_jobs.enqueue("site", {
+        "user_id": user_id,
+        "notifications": [{
+            "phone": phone,
+            "target": target,
+            "url": url
+        }]
+    }, coalesce_key=directory_id)
+
+# Keeps every distinct SMS of the merged requests.
+def mergeSiteBuildJobs(queued_payload, new_payload):
+    for notification in new_payload["notifications"]:
+        if notification not in queued_payload["notifications"]:
+            queued_payload["notifications"].append(notification)
+    return queued_payload
+
+# Runs a queued site build against the latest profile and blog posts, then sends the SMS.
+def runSiteBuildJob(payload):
+    build_jobs.set_stage("load_profile")
+    # Another worker may have written since this process cached the user, always build from the database.
+    profile_cache.invalidate(payload["user_id"])
+    result = loadFullProfile(payload["user_id"])
+    if "error" in result:
+        raise Exception(result["error"])
+    user_profile = result["data"]
+
+    blog_posts = getAllBlogPostsForUser(payload["user_id"])
+    buildSite(user_profile, blog_posts)
+
+    # Notify that the build is completed.
+    build_jobs.set_stage("notify")
+    for notification in payload["notifications"]:
+        sendBuildCompletedSMS(notification["phone"], notification["target"], notification["url"])
+
+build_jobs.register("site", runSiteBuildJob, merge=mergeSiteBuildJobs)
 
 # Todo: Add clean to all fields
 def cleanData(data):
@@ -877,7 +1312,7 @@ def generateJwtToken(payload):
 
 def decodeJwttoken(jwtToken):
     try:
-        payload = jwt.decode(jwtToken, JWT_SECRET)
+        payload = jwt.decode(jwtToken, JWT_SECRET, algorithms=['HS256'])
         return {
             "sub" : payload['sub'],
             "phone": payload['phone']
@@ -891,151 +1326,137 @@ def decodeJwttoken(jwtToken):
             "error": "Invalid token. Please log in again."
         }
 
-def checkPhoneNumberExistsAndVerified(phone):
-    db = mysql.connector.connect(
-        host=config('DB_HOST'),
-        user=config('DB_USER'),
-        password=config('DB_PASSWORD'),
-        database=config('DB_NAME')
-    )
-    
-    cursor = db.cursor()
-    sql = "SELECT phone FROM phone_auth WHERE phone = %s AND is_verified = true LIMIT 1"
-    val = (phone,)
-    cursor.execute(sql, val)
+# Positive verification results are reused for AUTH_CACHE_TTL seconds in each worker.
+AUTH_CACHE_TTL = config('AUTH_CACHE_TTL', default=60, cast=float)
+_verified_identities = {}
+_verified_identities_lock = threading.Lock()
+
+# Returns the identity for this request's access token: {"sub", "phone", "user_exists", "is_verified"},
+# or {"error": ...} if the token is invalid. The token is decoded once per request and the user and
+# verification state are only looked up when require_verified is set.
+def getAuthContext(token, require_verified=False):
+    if g.get("auth_token") != token:
+        g.auth_token = token
+        g.auth = decodeJwttoken(token)
+        if "error" not in g.auth:
+            g.auth["user_exists"] = None
+            g.auth["is_verified"] = None
+    auth = g.auth
+
+    if "error" in auth or not require_verified or auth["is_verified"] is not None:
+        return auth
+
+    identity = (auth["sub"], auth["phone"])
+    with _verified_identities_lock:
+        expires_at = _verified_identities.get(identity)
+    if expires_at and expires_at > time.monotonic():
+        auth["user_exists"], auth["is_verified"] = True, True
+        return auth
+
+    auth["user_exists"], auth["is_verified"] = getIdentityState(auth["sub"], auth["phone"])
+    if auth["user_exists"] and auth["is_verified"]:
+        with _verified_identities_lock:
+            if len(_verified_identities) > 10000:
+                _verified_identities.clear()
+            _verified_identities[identity] = time.monotonic() + AUTH_CACHE_TTL
+    return auth
+
+# Checks in one query that the user has a phone_auth record and that the phone is verified.
+def getIdentityState(user_id, phone):
+    with db_pool.connection() as db:
+        cursor = db.cursor()
+        sql = "SELECT EXISTS(SELECT 1 FROM phone_auth WHERE user_id = %s), \
+            EXISTS(SELECT 1 FROM phone_auth WHERE phone = %s AND is_verified = true)"
+        val = (user_id, phone)
+        cursor.execute(sql, val)
 
-    result = cursor.fetchall()
-    if len(result) == 0:
-        return False
-    return True
+        result = cursor.fetchall()
+        cursor.close()
+        return bool(result[0][0]), bool(result[0][1])
 
-def addUserTopSkills(user_id, top_skills):
-    if len(top_skills) > 0:
-        for skill_name in top_skills:
-            addTopSkill(user_id, cleanData(skill_name))
-
-def addTopSkill(user_id, skill_name):
-    db = mysql.connector.connect(
-        host=config('DB_HOST'),
-        user=config('DB_USER'),
-        password=config('DB_PASSWORD'),
-        database=config('DB_NAME')
-    )
-
-    cursor = db.cursor()
-    sql = "INSERT INTO `user_top_skill` (user_id, skill_name) VALUES \
-        (%s, %s)"
-
-    val = (user_id, skill_name)
-
-    cursor.execute(sql, val)
-    db.commit()
-
-def getUserTopSkills(user_id):
-    db = mysql.connector.connect(
-        host=config('DB_HOST'),
-        user=config('DB_USER'),
-        password=config('DB_PASSWORD'),
-        database=config('DB_NAME')
-    )
-    
-    cursor = db.cursor()
-    sql = "SELECT * FROM user_top_skill WHERE user_id = %s LIMIT 3"
-    val = (user_id,)
-    cursor.execute(sql, val)
+def checkPhoneNumberExistsAndVerified(phone):
+    with db_pool.connection() as db:
+        cursor = db.cursor()
+        sql = "SELECT phone FROM phone_auth WHERE phone = %s AND is_verified = true LIMIT 1"
+        val = (phone,)
+        cursor.execute(sql, val)
 
-    result = cursor.fetchall()
-    if len(result) == 0:
-        return None
-    
-    skill_names = []
-    for skill in result:
-        skill_names.append(skill[2])
-
-    return skill_names
-
-def removeUserTopSkills(user_id):
-    db = mysql.connector.connect(
-        host=config('DB_HOST'),
-        user=config('DB_USER'),
-        password=config('DB_PASSWORD'),
-        database=config('DB_NAME')
-    )
-    
-    cursor = db.cursor()
-    sql = "DELETE FROM user_top_skill WHERE user_id = %s"
-    val = (user_id,)
-    cursor.execute(sql, val)
-    db.commit()
+        result = cursor.fetchall()
+        if len(result) == 0:
+            return False
+        return True
+
+# Drops the user's cached profile now, so the rest of this request reads its own
+# writes, and again once they are committed, so no other worker caches the old rows
+# in between.
+def invalidateProfileCache(user_id):
+    profile_cache.invalidate(user_id)
+    db_pool.after_commit(profile_cache.invalidate, user_id)
+
+# Replaces the user's top skills in one transaction. Skills are read back in
+# skill_id order, so the rows that already match the start of the new list are
+# kept and only the rest are deleted and re-inserted. Saving unchanged skills
+# writes nothing.
+def replaceUserTopSkills(user_id, top_skills):
+    skill_names = [cleanData(skill_name) for skill_name in top_skills]
+    with db_pool.connection() as db:
+        cursor = db.cursor()
+        try:
+            sql = "SELECT skill_id, skill_name FROM user_top_skill WHERE user_id = %s ORDER BY skill_id FOR UPDATE"
+            val = (user_id,)
+            cursor.execute(sql, val)
+            existing = cursor.fetchall()
+
+            kept = 0
+            while kept < len(existing) and kept < len(skill_names) and existing[kept][1] == skill_names[kept]:
+                kept += 1
+            if kept == len(existing) and kept == len(skill_names):
+                return
+
+            if kept < len(existing):
+                sql = "DELETE FROM user_top_skill WHERE user_id = %s AND skill_id >= %s"
+                val = (user_id, existing[kept][0])
+                cursor.execute(sql, val)
+            if kept < len(skill_names):
+                sql = "INSERT INTO `user_top_skill` (user_id, skill_name) VALUES (%s, %s)"
+                val = [(user_id, skill_name) for skill_name in skill_names[kept:]]
+                cursor.executemany(sql, val)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            cursor.close()
+        invalidateProfileCache(user_id)
 
 def createUserProfile(userinfo):
-    db = mysql.connector.connect(
-        host=config('DB_HOST'),
-        user=config('DB_USER'),
-        password=config('DB_PASSWORD'),
-        database=config('DB_NAME')
-    )
-
-    cursor = db.cursor()
-    sql = "INSERT INTO `user` (user_id, first_name, last_name, email, current_employer, description, profession) VALUES \
-        (%s, %s, %s, %s, %s, %s, %s)"
-
-    val = (userinfo['user_id'], userinfo['first_name'],
-    userinfo['last_name'], userinfo['email'], userinfo['current_employer'], userinfo['description'], userinfo['profession'])
-
-    cursor.execute(sql, val)
-    db.commit()
-
-
-def getUserProfile(user_id):
-    db = mysql.connector.connect(
-        host=config('DB_HOST'),
-        user=config('DB_USER'),
-        password=config('DB_PASSWORD'),
-        database=config('DB_NAME')
-    )
-    
-    cursor = db.cursor()
-    sql = "SELECT * FROM user WHERE user_id = %s LIMIT 1"
-    val = (user_id,)
-    cursor.execute(sql, val)
+    with db_pool.connection() as db:
+        cursor = db.cursor()
+        sql = "INSERT INTO `user` (user_id, first_name, last_name, email, current_employer, description, profession) VALUES \
+            (%s, %s, %s, %s, %s, %s, %s)"
 
-    result = cursor.fetchall()
-    if len(result) == 0:
-        return None
-    user_record = result[0]
-    output = {
-        "user_id": user_record[0],
-        "first_name": user_record[1],
-        "last_name": user_record[2],
-        "email": user_record[3],
-        "current_employer": user_record[4],
-        "description": user_record[5],
-        "profession": user_record[6],
-        "profile_pic": user_record[7]
-    }
+        val = (userinfo['user_id'], userinfo['first_name'],
+        userinfo['last_name'], userinfo['email'], userinfo['current_employer'], userinfo['description'], userinfo['profession'])
 
-    return output
+        cursor.execute(sql, val)
+        db.commit()
+        invalidateProfileCache(userinfo['user_id'])
 
-def updateUserProfile(userinfo):
-    db = mysql.connector.connect(
-        host=config('DB_HOST'),
-        user=config('DB_USER'),
-        password=config('DB_PASSWORD'),
-        database=config('DB_NAME')
-    )
 
-    cursor = db.cursor()
+def updateUserProfile(userinfo):
+    with db_pool.connection() as db:
+        cursor = db.cursor()
 
-    sql = "UPDATE `user` SET first_name = %s, last_name = %s, email = %s, current_employer = %s, description = %s, profession = %s \
-        WHERE user_id = %s"
+        sql = "UPDATE `user` SET first_name = %s, last_name = %s, email = %s, current_employer = %s, description = %s, profession = %s \
+            WHERE user_id = %s"
 
-    val = (userinfo['first_name'], userinfo['last_name'], 
-    userinfo['email'], userinfo['current_employer'], 
-    userinfo['description'], userinfo['profession'], userinfo["user_id"])
+        val = (userinfo['first_name'], userinfo['last_name'], 
+        userinfo['email'], userinfo['current_employer'], 
+        userinfo['description'], userinfo['profession'], userinfo["user_id"])
 
-    cursor.execute(sql, val)
-    db.commit()
+        cursor.execute(sql, val)
+        db.commit()
+        invalidateProfileCache(userinfo['user_id'])
 
 def isPhoneVerified(user_id):
     # Check if the user phone is already verified
@@ -1046,233 +1467,180 @@ def getUserFromPhone(phone):
 
 # Todo: This phone_auth table could be just an auth table with different modes
 def getUserIDFromPhone(phone):
-    db = mysql.connector.connect(
-        host=config('DB_HOST'),
-        user=config('DB_USER'),
-        password=config('DB_PASSWORD'),
-        database=config('DB_NAME')
-    )
-
-    cursor = db.cursor()
-    sql = "SELECT user_id FROM phone_auth WHERE phone = %s ORDER BY auth_time_stamp DESC LIMIT 1"
-    val = (phone,)
-    cursor.execute(sql, val)
-
-    result = cursor.fetchall()
-    if len(result) == 0:
-        return None
-    return result[0]
+    with db_pool.connection() as db:
+        cursor = db.cursor()
+        sql = "SELECT user_id FROM phone_auth WHERE phone = %s ORDER BY auth_time_stamp DESC LIMIT 1"
+        val = (phone,)
+        cursor.execute(sql, val)
+
+        result = cursor.fetchall()
+        if len(result) == 0:
+            return None
+        return result[0]
 
 def getUser(user_id):
-    db = mysql.connector.connect(
-        host=config('DB_HOST'),
-        user=config('DB_USER'),
-        password=config('DB_PASSWORD'),
-        database=config('DB_NAME')
-    )
-
-    cursor = db.cursor()
-    sql = "SELECT user_id FROM phone_auth WHERE user_id = %s ORDER BY auth_time_stamp DESC LIMIT 1"
-    val = (user_id,)
-    cursor.execute(sql, val)
-
-    result = cursor.fetchall()
-    if len(result) == 0:
-        return None
-    return result[0]
+    with db_pool.connection() as db:
+        cursor = db.cursor()
+        sql = "SELECT user_id FROM phone_auth WHERE user_id = %s ORDER BY auth_time_stamp DESC LIMIT 1"
+        val = (user_id,)
+        cursor.execute(sql, val)
 
-def verifyPhone(phone, auth_code):
-    # Save the number to the user_auth table
-    db = mysql.connector.connect(
-        host=config('DB_HOST'),
-        user=config('DB_USER'),
-        password=config('DB_PASSWORD'),
-        database=config('DB_NAME')
-    )
-
-    cursor = db.cursor()
-
-    # Ignore the expiry for now (Todo: Check the expiration time with the current time)
-    sql = "SELECT phone, user_id FROM phone_auth WHERE phone = %s AND auth_code = %s \
-        ORDER BY auth_time_stamp DESC LIMIT 1"
-    val = (phone, auth_code)
-    cursor.execute(sql, val)
-
-    result = cursor.fetchall()
-    if len(result) == 0:
-        return None
-    return result[0]
-
-def updatePhoneVerifyFieldAndUserID(phone, user_id):
-    db = mysql.connector.connect(
-        host=config('DB_HOST'),
-        user=config('DB_USER'),
-        password=config('DB_PASSWORD'),
-        database=config('DB_NAME')
-    )
-
-    cursor = db.cursor()
-    sql = "UPDATE `phone_auth` SET is_verified = true, user_id = %s WHERE phone = %s"
-    val = (user_id, phone)
-    cursor.execute(sql, val)
-    db.commit()
-    return True
+        result = cursor.fetchall()
+        if len(result) == 0:
+            return None
+        return result[0]
+
+# Checks the code and marks the phone as verified in one statement, so a code can
+# only be used once and only within auth_code_expiry minutes of being sent.
+# new_user_id is stored if the phone has no user yet. Returns the phone's user_id,
+# or None if the code is wrong, expired or already used.
+def verifyPhone(phone, auth_code, new_user_id):
+    with db_pool.connection() as db:
+        cursor = db.cursor()
+        sql = "UPDATE `phone_auth` SET is_verified = true, user_id = COALESCE(user_id, %s), auth_code_expiry = 0 \
+            WHERE phone = %s AND auth_code = %s AND auth_time_stamp > now() - INTERVAL auth_code_expiry MINUTE"
+        val = (new_user_id, phone, auth_code)
+        cursor.execute(sql, val)
+        if cursor.rowcount != 1:
+            return None
+        db.commit()
+
+        sql = "SELECT user_id FROM phone_auth WHERE phone = %s"
+        val = (phone,)
+        cursor.execute(sql, val)
+        result = cursor.fetchall()
+        cursor.close()
+        return result[0][0]
 
 def verifyUser(user_id, auth_code, auth_method):
     # Save the number to the user_auth table
-    db = mysql.connector.connect(
-        host=config('DB_HOST'),
-        user=config('DB_USER'),
-        password=config('DB_PASSWORD'),
-        database=config('DB_NAME')
-    )
-
-    cursor = db.cursor()
-
-    # Ignore the expiry for now (Todo: Check the expiration time with the current time)
-    sql = "SELECT user_id, auth_code FROM user_auth WHERE user_id = %s AND auth_code = %s AND auth_method = %s \
-        ORDER BY auth_time_stamp DESC LIMIT 1"
-    val = (user_id, auth_code, auth_method)
-    cursor.execute(sql, val)
-
-    result = cursor.fetchall()
-    if len(result) == 0:
-        return False
-    return True
+    with db_pool.connection() as db:
+        cursor = db.cursor()
+
+        # Ignore the expiry for now (Todo: Check the expiration time with the current time)
+        sql = "SELECT user_id, auth_code FROM user_auth WHERE user_id = %s AND auth_code = %s AND auth_method = %s \
+            ORDER BY auth_time_stamp DESC LIMIT 1"
+        val = (user_id, auth_code, auth_method)
+        cursor.execute(sql, val)
+
+        result = cursor.fetchall()
+        if len(result) == 0:
+            return False
+        return True
 
 def updateUserVerifyField(user_id, auth_method):
-    db = mysql.connector.connect(
-        host=config('DB_HOST'),
-        user=config('DB_USER'),
-        password=config('DB_PASSWORD'),
-        database=config('DB_NAME')
-    )
-
-    cursor = db.cursor()
-    sql = "UPDATE `user` "
-    if auth_method == "PHONE":
-        sql = sql + " SET is_phone_verified = true "
-    elif auth_method == "EMAIL":
-        sql = sql + " SET is_email_verified = true "
-    else:
-        return False
-    sql = sql + " WHERE user_id = %s"
+    with db_pool.connection() as db:
+        cursor = db.cursor()
+        sql = "UPDATE `user` "
+        if auth_method == "PHONE":
+            sql = sql + " SET is_phone_verified = true "
+        elif auth_method == "EMAIL":
+            sql = sql + " SET is_email_verified = true "
+        else:
+            return False
+        sql = sql + " WHERE user_id = %s"
 
-    val = (user_id, )
-    cursor.execute(sql, val)
-    db.commit()
-    return True
+        val = (user_id, )
+        cursor.execute(sql, val)
+        db.commit()
+        return True
 
 def createAuthCodeForUser(user_id, auth_method):
     # Generate a 4 digit random number
     auth_code = random.randint(1000, 9999)
 
     # Save the number to the user_auth table
-    db = mysql.connector.connect(
-        host=config('DB_HOST'),
-        user=config('DB_USER'),
-        password=config('DB_PASSWORD'),
-        database=config('DB_NAME')
-    )
-
-    cursor = db.cursor()
-    sql = "INSERT INTO `user_auth` (user_id, auth_code, auth_method) VALUES \
-        (%s, %s, %s)"
+    with db_pool.connection() as db:
+        cursor = db.cursor()
+        sql = "INSERT INTO `user_auth` (user_id, auth_code, auth_method) VALUES \
+            (%s, %s, %s)"
 
-    val = (user_id, auth_code, auth_method)
+        val = (user_id, auth_code, auth_method)
 
-    cursor.execute(sql, val)
-    db.commit()
+        cursor.execute(sql, val)
+        db.commit()
 
 
-    return auth_code
+        return auth_code
 
 def phoneRecordExists(phone):
     # Save the number to the user_auth table
-    db = mysql.connector.connect(
-        host=config('DB_HOST'),
-        user=config('DB_USER'),
-        password=config('DB_PASSWORD'),
-        database=config('DB_NAME')
-    )
-
-    cursor = db.cursor()
-
-    # Ignore the expiry for now (Todo: Check the expiration time with the current time)
-    sql = "SELECT phone FROM phone_auth WHERE phone = %s LIMIT 1"
-    val = (phone,)
-    cursor.execute(sql, val)
-
-    result = cursor.fetchall()
-    if len(result) == 0:
-        return False
-    return True
+    with db_pool.connection() as db:
+        cursor = db.cursor()
+
+        # Ignore the expiry for now (Todo: Check the expiration time with the current time)
+        sql = "SELECT phone FROM phone_auth WHERE phone = %s LIMIT 1"
+        val = (phone,)
+        cursor.execute(sql, val)
 
+        result = cursor.fetchall()
+        if len(result) == 0:
+            return False
+        return True
+
+# Creates or replaces the code for a phone or email in one upsert. Every new code
+# restarts its auth_code_expiry window.
+# A verified phone keeps its record untouched and None is returned, so registering
+# can not take over an existing user's number (they login instead).
 def createAuthCode(auth_method, value):
     # Todo: Add a limiter to ensure new codes are not sent within 10 min of creation
-    # Todo: Add expiration as epoch, update timestamp when record is updated
     # Generate a 4 digit random number
     auth_code = random.randint(1000, 9999)
 
-    # Save the number to the user_auth table
-    db = mysql.connector.connect(
-        host=config('DB_HOST'),
-        user=config('DB_USER'),
-        password=config('DB_PASSWORD'),
-        database=config('DB_NAME')
-    )
-
-    cursor = db.cursor()
-
-    sql = ""
-    if auth_method == "PHONE":
-        phone_record_exists = phoneRecordExists(value)
-        if phone_record_exists: # Ensures unique phone record
-            sql = sql + "UPDATE `phone_auth` SET auth_code = %s WHERE phone = %s"
+    with db_pool.connection() as db:
+        cursor = db.cursor()
+        if auth_method == "PHONE":
+            # auth_code_count changes on every new code, so the affected row count is 0
+            # only when the phone is verified and nothing was written.
+            sql = "INSERT INTO `phone_auth` (auth_code, phone, auth_code_expiry, auth_code_count) VALUES (%s, %s, %s, 1) \
+                ON DUPLICATE KEY UPDATE \
+                auth_code = IF(is_verified, auth_code, VALUES(auth_code)), \
+                auth_time_stamp = IF(is_verified, auth_time_stamp, now()), \
+                auth_code_expiry = IF(is_verified, auth_code_expiry, VALUES(auth_code_expiry)), \
+                auth_code_count = IF(is_verified, auth_code_count, auth_code_count + 1)"
         else:
-            sql = sql + "INSERT INTO `phone_auth` (auth_code, phone) VALUES (%s, %s)"
-    else:
-        sql = sql + "INSERT INTO `email_auth` (auth_code, email) VALUES (%s, %s)"
+            sql = "INSERT INTO `email_auth` (auth_code, email, auth_code_expiry) VALUES (%s, %s, %s) \
+                ON DUPLICATE KEY UPDATE auth_code = VALUES(auth_code), auth_time_stamp = now(), \
+                auth_code_expiry = VALUES(auth_code_expiry)"
+        val = (auth_code, value, AUTH_CODE_EXPIRY_MINUTES)
+        cursor.execute(sql, val)
+        if cursor.rowcount == 0:
+            return None
+        db.commit()
 
-    val = (auth_code, value)
+        return auth_code
 
-    cursor.execute(sql, val)
-    db.commit()
+# Creates a new code for a registered and verified phone. Returns None if the phone
+# is not registered or not verified yet.
+def createLoginAuthCode(phone):
+    auth_code = random.randint(1000, 9999)
 
-    return auth_code
+    with db_pool.connection() as db:
+        cursor = db.cursor()
+        sql = "UPDATE `phone_auth` SET auth_code = %s, auth_time_stamp = now(), auth_code_expiry = %s, \
+            auth_code_count = auth_code_count + 1 WHERE phone = %s AND is_verified = true"
+        val = (auth_code, AUTH_CODE_EXPIRY_MINUTES, phone)
+        cursor.execute(sql, val)
+        if cursor.rowcount == 0:
+            return None
+        db.commit()
+
+        return auth_code
 
 # Check if phone number is valid (supports US numbers xxx-yyy-zzzz, xxxyyyzzzz, +1 xxx-yyy-zzzz etc.)
 def isPhoneNumberValid(phone):
     pattern = re.compile(r"^(\+\d{1,2}\s)?\(?\d{3}\)?[\s.-]?\d{3}[\s.-]?\d{4}$")
     return pattern.match(phone)
 
-# Send auth code to the phone. Uses TWILIO API to send the SMS
+# Send auth code to the phone. Queues the SMS for the TWILIO API and returns straight away
 def sendAuthCodeSMS(auth_code, phone_number):
-    account_sid = config('TWILIO_ACCOUNT_SID')
-    auth_token = config('TWILIO_AUTH_TOKEN')
-    client = Client(account_sid, auth_token)
-
-    message_output = client.messages \
-        .create(
-            body="{0}:Your one time code is: {1}. Please say or enter the code in the {2} app to complete verification".format(APP_NAME, auth_code, APP_NAME),
-            from_=config('TWILIO_FROM_PHONE'),
-            to=phone_number
-        )
-    print(message_output)
+    notifications.send_sms(phone_number,
+        "{0}:Your one time code is: {1}. Please say or enter the code in the {2} app to complete verification".format(APP_NAME, auth_code, APP_NAME))
 
-# Send public url of the target to the phone. Uses TWILIO API to send the SMS
+# Send public url of the target to the phone. Queues the SMS for the TWILIO API and returns straight away
 def sendBuildCompletedSMS(phone_number, target, url):
-    account_sid = config('TWILIO_ACCOUNT_SID')
-    auth_token = config('TWILIO_AUTH_TOKEN')
-    client = Client(account_sid, auth_token)
-
-    message_output = client.messages \
-        .create(
-            body="{0}:Your {1} page can be accessed using this link: {2}".format(APP_NAME, target, url),
-            from_=config('TWILIO_FROM_PHONE'),
-            to=phone_number
-        )
-    print(message_output)
+    notifications.send_sms(phone_number,
+        "{0}:Your {1} page can be accessed using this link: {2}".format(APP_NAME, target, url))
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', debug=True)
@@ -0,0 +1,40 @@
+# Files the app reads back and must not take from another local user.
+#
+# The build queue, compiled profile renderers and metric files decide which SMS
+# are sent, what goes into a site and what /metrics reports, so a file planted by
+# someone else could make the app send texts or publish content it never made.
+# They default to directories in the app user's home, and are only used if they
+# belong to that user and nobody else can write to them.
+import os
+import stat
+
+HOME = os.path.expanduser("~")
+
+
+def cache_path(*parts):
+    return os.path.join(HOME, ".cache", "voicemake", *parts)
+
+def data_path(*parts):
+    return os.path.join(HOME, ".local", "share", "voicemake", *parts)
+
+# True if path is not a symlink, belongs to the user running the app and is not
+# writable by anyone else.
+def owned(path):
+    path_stat = os.lstat(path)
+    return (not stat.S_ISLNK(path_stat.st_mode) and path_stat.st_uid == os.geteuid()
+        and not path_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+
+# Raises PermissionError if path exists and is not owned. A missing path is fine.
+def check_owned(path):
+    try:
+        if owned(path):
+            return
+    except FileNotFoundError:
+        return
+    raise PermissionError("{0} is not owned by the app user or is writable by others".format(path))
+
+# Creates directory for the app user only, and checks it if it already exists.
+def private_dir(directory):
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    check_owned(directory)
+    return directory
@@ -0,0 +1,369 @@
+# End-to-end benchmark of the API: register -> verify -> create-profile -> create-blog-post,
+# followed by the site builds those requests queue.
+#
+# Requests go through Flask's test client (--server test-client) or over HTTP to a
+# threaded WSGI server (--server wsgi). SMS go to the fake transport, hugo is a stub
+# that sleeps --hugo-delay-ms, and the data helpers are backed by an in-memory
+# repository (--db memory, with --db-latency-ms per call) or by the MySQL database
+# in the DB_* settings (--db mysql, migrated with migrate.py).
+#
+# Reports p50/p95/p99 per endpoint, requests/sec and per-stage build timings, and
+# writes them as JSON to benchmarks/results/ (ignored by git) unless --output is given.
+# Pass an earlier result file with --compare to print the change.
+# Run from the repo root:
+#
+#   python benchmarks/api_flow.py [--users 50] [--concurrency 8] [--posts 2] [--server wsgi]
+#       [--db memory] [--hugo-delay-ms 50] [--output result.json] [--compare previous.json]
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = tempfile.mkdtemp(prefix="voicemake-bench-")
+TEMPLATE_HOME = os.path.join(ROOT, "template")
+STUB_HUGO = os.path.join(ROOT, "hugo")
+
+os.environ.setdefault("APP_NAME", "Voicemake")
+os.environ.setdefault("JWT_SECRET", "benchmark-secret-at-least-32-bytes-long")
+os.environ.setdefault("BASE_URL", "https://about-me.website")
+os.environ["LOCAL_TEMPLATE_HOME"] = TEMPLATE_HOME
+os.environ["WWW_ROOT"] = os.path.join(ROOT, "www") + "/"
+os.environ["WORKSPACE_ROOT"] = os.path.join(ROOT, "workspaces")
+os.environ["HUGO_BIN"] = STUB_HUGO
+os.environ["BUILD_QUEUE_DB"] = os.path.join(ROOT, "queue.db")
+os.environ["METRICS_DIR"] = os.path.join(ROOT, "metrics")
+os.environ["PROFILE_RENDERER_DIR"] = os.path.join(ROOT, "profile-renderer")
+os.environ["SMS_TRANSPORT"] = "fake"
+os.environ["SMS_MIN_INTERVAL_PER_NUMBER"] = "0"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def percentiles(values):
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+    def rank(p):
+        return round(ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))] * 1000, 2)
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 2),
+        "p50_ms": rank(50),
+        "p95_ms": rank(95),
+        "p99_ms": rank(99),
+    }
+
+def make_template(file_count, hugo_delay_ms):
+    for i in range(file_count):
+        folder = os.path.join(TEMPLATE_HOME, "static", "plugins", "p{0}".format(i % 20))
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, "asset{0}.js".format(i)), "w") as file:
+            file.write("x" * 2048)
+    os.makedirs(os.path.join(TEMPLATE_HOME, "content", "blog"), exist_ok=True)
+    os.makedirs(os.path.join(TEMPLATE_HOME, "data"), exist_ok=True)
+
+    # Stub hugo: wait like a render would, then copy static files, data and content.
+    with open(STUB_HUGO, "w") as file:
+        file.write("#!/bin/sh\nsleep {0}\nmkdir -p \"$4\" && cp -R \"$2/static/.\" \"$2/data\" \"$2/content\" \"$4/\"\n"
+            .format(hugo_delay_ms / 1000.0))
+    os.chmod(STUB_HUGO, 0o755)
+
+
+# Stand-ins for the data helpers in app.py, keeping everything in dictionaries.
+class InMemoryRepository(object):
+    HELPERS = ("createAuthCode", "createLoginAuthCode", "verifyPhone", "getIdentityState", "loadUserProfile",
+        "createUserProfile", "updateUserProfile", "replaceUserTopSkills", "generateUserDirectoryID", "getUserDirectory",
+        "saveBlogPost", "getMostRecentBlogPostForUser", "getAllBlogPostsForUser")
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.phones = {}
+        self.users = {}
+        self.skills = {}
+        self.directories = {}
+        self.posts = {}
+        self.next_post_id = 1
+
+    def install(self, app):
+        for name in self.HELPERS:
+            setattr(app, name, self._timed(getattr(self, name)))
+
+    def _timed(self, helper):
+        def wrapper(*args):
+            if self.latency:
+                time.sleep(self.latency)
+            with self.lock:
+                return helper(*args)
+        return wrapper
+
+    def createAuthCode(self, auth_method, value):
+        record = self.phones.setdefault(value, {"is_verified": False, "user_id": None})
+        if record["is_verified"]:
+            return None
+        record["auth_code"] = random.randint(1000, 9999)
+        return record["auth_code"]
+
+    def createLoginAuthCode(self, phone):
+        record = self.phones.get(phone)
+        if record is None or not record["is_verified"]:
+            return None
+        record["auth_code"] = random.randint(1000, 9999)
+        return record["auth_code"]
+
+    def verifyPhone(self, phone, auth_code, new_user_id):
+        record = self.phones.get(phone)
+        if record is None or str(record.get("auth_code")) != str(auth_code):
+            return None
+        record["auth_code"] = None
+        record["is_verified"] = True
+        record["user_id"] = record["user_id"] or new_user_id
+        return record["user_id"]
+
+    def getIdentityState(self, user_id, phone):
+        record = self.phones.get(phone)
+        return user_id in set(r["user_id"] for r in self.phones.values()), bool(record and record["is_verified"])
+
+    def loadUserProfile(self, user_id):
+        if user_id not in self.users:
+            return None
+        directory_id = next((d for d, owner in self.directories.items() if owner == user_id), None)
+        return dict(self.users[user_id], directory_id=directory_id, top_skills=list(self.skills.get(user_id, []))[:3])
+
+    def createUserProfile(self, userinfo):
+        self.users[userinfo["user_id"]] = dict((key, userinfo.get(key)) for key in ("user_id", "first_name", "last_name",
+            "email", "current_employer", "description", "profession", "profile_pic"))
+
+    def updateUserProfile(self, userinfo):
+        self.createUserProfile(dict(userinfo, profile_pic=self.users[userinfo["user_id"]]["profile_pic"]))
+
+    def replaceUserTopSkills(self, user_id, top_skills):
+        self.skills[user_id] = [skill.replace(".", "") for skill in top_skills]
+
+    def generateUserDirectoryID(self, user_id, first_name, last_name):
+        directory_id = first_name + "-" + last_name
+        if directory_id in self.directories:
+            directory_id = directory_id + "-" + str(sum(1 for d in self.directories if d.startswith(directory_id)))
+        self.directories[directory_id] = user_id
+        return directory_id
+
+    def getUserDirectory(self, user_id):
+        return next((d for d, owner in self.directories.items() if owner == user_id), None)
+
+    def saveBlogPost(self, user_id, title, description):
+        self.posts.setdefault(user_id, []).append({"post_id": self.next_post_id, "user_id": user_id, "title": title,
+            "created_at": time.strftime("%Y-%m-%d %H:%M:%S"), "description": description})
+        self.next_post_id += 1
+        return True
+
+    def getMostRecentBlogPostForUser(self, user_id):
+        posts = self.posts.get(user_id)
+        return dict(posts[-1]) if posts else None
+
+    def getAllBlogPostsForUser(self, user_id):
+        posts = self.posts.get(user_id)
+        return [dict(post) for post in reversed(posts[-10:])] if posts else None
+
+
+class TestClient(object):
+    def __init__(self, app):
+        self.app = app
+
+    def request(self, method, path, body):
+        response = self.app.test_client().open(path, method=method, json=body)
+        return response.status_code, response.get_json()
+
+class WsgiClient(object):
+    def __init__(self, port):
+        self.port = port
+
+    def request(self, method, path, body):
+        connection = http.client.HTTPConnection("127.0.0.1", self.port)
+        try:
+            connection.request(method, path, json.dumps(body), {"Content-Type": "application/json"})
+            response = connection.getresponse()
+            return response.status, json.loads(response.read() or b"null")
+        finally:
+            connection.close()
+
+
+class Recorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.stages = {}
+        self._current = threading.local()
+
+    def call(self, client, name, method, path, body):
+        started = time.perf_counter()
+        status, data = client.request(method, path, body)
+        elapsed = time.perf_counter() - started
+        failed = status >= 400 or not isinstance(data, dict) or "error" in data
+        with self.lock:
+            self.latencies.setdefault(name, []).append(elapsed)
+            if failed:
+                self.errors[name] = self.errors.get(name, 0) + 1
+        if failed:
+            raise Exception("{0} failed with {1}: {2}".format(name, status, data))
+        return data
+
+    # Wraps build_jobs.set_stage so the time between stages is recorded per build thread.
+    def stage(self, name):
+        now = time.perf_counter()
+        previous = getattr(self._current, "stage", None)
+        if previous is not None:
+            with self.lock:
+                self.stages.setdefault(previous[0], []).append(now - previous[1])
+        self._current.stage = (name, now) if name else None
+
+def wait_for_code(notifications, phone, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for to, body in reversed(list(notifications.sms_queue.transport.sent if notifications.sms_queue.transport else [])):
+            match = re.search(r"one time code is: (\d+)", body)
+            if to == phone and match:
+                return match.group(1)
+        time.sleep(0.005)
+    raise Exception("No code was sent to {0}".format(phone))
+
+def user_flow(index, client, recorder, notifications, post_count):
+    phone = "555-555-{0:04d}".format(index)
+    recorder.call(client, "register-phone", "POST", "/register-phone", {"phone": phone})
+    code = wait_for_code(notifications, phone)
+    token = recorder.call(client, "verify-phone", "POST", "/verify-phone", {"phone": phone, "auth_code": code})["data"]["access_token"]
+    job_ids = [recorder.call(client, "create-profile", "POST", "/create-profile", {
+        "token": token, "first_name": "bench", "last_name": "user{0}".format(index), "email": "user{0}@example.com".format(index),
+        "profession": "Engineer", "current_employer": "Example", "description": "Benchmark user",
+        "top_skills": ["Python", "Hugo", "MySQL"]})["data"]["job_id"]]
+    for post in range(post_count):
+        job_ids.append(recorder.call(client, "create-blog-post", "POST", "/create-blog-post", {
+            "token": token, "title": "Post {0}".format(post), "description": "Body of post {0}".format(post)})["data"]["job_id"])
+    return job_ids
+
+def print_comparison(result, previous):
+    print("\nChange against {0}:".format(previous.get("started_at")))
+    for name, stats in result["endpoints"].items():
+        before = previous.get("endpoints", {}).get(name)
+        if before and before.get("p95_ms"):
+            print("  {0:>18}: p95 {1:8.2f} ms -> {2:8.2f} ms ({3:+.1f}%)".format(name, before["p95_ms"], stats["p95_ms"],
+                (stats["p95_ms"] - before["p95_ms"]) * 100 / before["p95_ms"]))
+    if previous.get("requests_per_second"):
+        print("  {0:>18}: {1:8.1f} -> {2:8.1f}".format("requests/sec", previous["requests_per_second"], result["requests_per_second"]))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--posts", type=int, default=2, help="blog posts created per user")
+    parser.add_argument("--server", choices=("test-client", "wsgi"), default="test-client")
+    parser.add_argument("--db", choices=("memory", "mysql"), default="memory")
+    parser.add_argument("--db-latency-ms", type=float, default=0.5, help="delay per data helper call with --db memory")
+    parser.add_argument("--hugo-delay-ms", type=float, default=50)
+    parser.add_argument("--build-workers", type=int, default=2)
+    parser.add_argument("--template-files", type=int, default=100)
+    parser.add_argument("--output", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "results",
+        "api_flow-{0}.json".format(time.strftime("%Y%m%d-%H%M%S"))))
+    parser.add_argument("--compare", help="an earlier result file to compare against")
+    args = parser.parse_args()
+
+    os.environ["BUILD_WORKERS"] = str(args.build_workers)
+    import app
+    import build_jobs
+    import notifications
+    app.logger.setLevel("WARNING")
+
+    recorder = Recorder()
+    set_stage = build_jobs.set_stage
+    def recording_set_stage(stage):
+        recorder.stage(stage)
+        set_stage(stage)
+    build_jobs.set_stage = recording_set_stage
+    def timed_site_build(payload):
+        try:
+            return app.runSiteBuildJob(payload)
+        finally:
+            recorder.stage(None)
+    build_jobs.register("site", timed_site_build, merge=app.mergeSiteBuildJobs)
+
+    if args.db == "memory":
+        InMemoryRepository(args.db_latency_ms / 1000).install(app)
+
+    server = None
+    try:
+        make_template(args.template_files, args.hugo_delay_ms)
+        if args.server == "wsgi":
+            from werkzeug.serving import make_server
+            server = make_server("127.0.0.1", 0, app.app, threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            client = WsgiClient(server.server_port)
+        else:
+            client = TestClient(app.app)
+        build_jobs.start_workers()
+
+        started_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            flows = list(pool.map(lambda index: user_flow(index, client, recorder, notifications, args.posts), range(args.users)))
+        api_seconds = time.perf_counter() - started
+
+        job_ids = set(job_id for flow in flows for job_id in flow)
+        while True:
+            stats = build_jobs.queue_stats()
+            if stats["queued"] == 0 and stats["running"] == 0:
+                break
+            time.sleep(0.05)
+        total_seconds = time.perf_counter() - started
+
+        jobs = [build_jobs.get_job(job_id) for job_id in job_ids]
+        request_count = sum(len(values) for values in recorder.latencies.values())
+        result = {
+            "started_at": started_at,
+            "config": vars(args),
+            "requests": request_count,
+            "requests_per_second": round(request_count / api_seconds, 1),
+            "endpoints": dict((name, dict(percentiles(values), errors=recorder.errors.get(name, 0)))
+                for name, values in recorder.latencies.items()),
+            "builds": {
+                "jobs": len(jobs),
+                "failed": sum(1 for job in jobs if job["state"] == "failed"),
+                "coalesced_requests": sum(job["coalesced_requests"] for job in jobs),
+                "builds_per_second": round(len(jobs) / total_seconds, 2),
+                "queued": percentiles([job["queued_seconds"] for job in jobs]),
+                "duration": percentiles([job["duration_seconds"] for job in jobs if job["duration_seconds"] is not None]),
+                "stages": dict((name, percentiles(values)) for name, values in recorder.stages.items())
+            }
+        }
+    finally:
+        if server is not None:
+            server.shutdown()
+        shutil.rmtree(ROOT, ignore_errors=True)
+
+    print("{0} users, {1} requests in {2:.2f}s: {3} requests/sec ({4} server)".format(
+        args.users, request_count, api_seconds, result["requests_per_second"], args.server))
+    for name, stats in result["endpoints"].items():
+        print("  {0:>18}: p50 {p50_ms:8.2f} ms  p95 {p95_ms:8.2f} ms  p99 {p99_ms:8.2f} ms  errors {errors}".format(name, **stats))
+    builds = result["builds"]
+    print("{0} builds ({1} failed, {2} requests coalesced), {3} builds/sec".format(
+        builds["jobs"], builds["failed"], builds["coalesced_requests"], builds["builds_per_second"]))
+    for name, stats in sorted(builds["stages"].items(), key=lambda item: -item[1]["mean_ms"]):
+        print("  {0:>18}: p50 {p50_ms:8.2f} ms  p95 {p95_ms:8.2f} ms  p99 {p99_ms:8.2f} ms".format(name, **stats))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as file:
+        json.dump(result, file, indent=2)
+    print("Saved {0}".format(args.output))
+    if args.compare:
+        with open(args.compare) as file:
+            print_comparison(result, json.load(file))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# Measures the per-request cost of authenticating /create-profile.
+#
+# "legacy" is the old path: decode the JWT, then getUser and
+# checkPhoneNumberExistsAndVerified as two separate queries. "current" is
+# getAuthContext, cold (verification cache miss) and warm (cache hit). The
+# database is a stand-in that sleeps --db-latency-ms per query. Run from the repo root:
+#
+#   python benchmarks/auth_overhead.py [--requests 2000] [--db-latency-ms 0.5]
+import os
+import sys
+import time
+import argparse
+import datetime
+import contextlib
+
+os.environ.setdefault("APP_NAME", "Voicemake")
+os.environ.setdefault("JWT_SECRET", "benchmark-secret-at-least-32-bytes-long")
+os.environ.setdefault("BASE_URL", "https://about-me.website")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import jwt  # noqa: E402
+import app  # noqa: E402
+import db_pool  # noqa: E402
+
+_queries = [0]
+_latency = [0.0]
+
+class FakeCursor(object):
+    def execute(self, sql, val):
+        _queries[0] += 1
+        time.sleep(_latency[0])
+        self.sql = sql
+
+    def fetchall(self):
+        if "EXISTS" in self.sql:
+            return [(1, 1)]
+        return [("bench-user",)]
+
+    def close(self):
+        pass
+
+class FakeConnection(object):
+    def cursor(self):
+        return FakeCursor()
+
+@contextlib.contextmanager
+def fake_connection():
+    yield FakeConnection()
+
+def make_token(user_id):
+    token = jwt.encode({
+        'exp': datetime.datetime.utcnow() + datetime.timedelta(days=1),
+        'iat': datetime.datetime.utcnow(),
+        'sub': user_id,
+        'phone': '+1 555-555-0100'
+    }, app.JWT_SECRET, algorithm='HS256')
+    return token.decode('utf-8') if isinstance(token, bytes) else token
+
+def legacy_auth(token):
+    payload = app.decodeJwttoken(token)
+    app.getUser(payload["sub"])
+    app.checkPhoneNumberExistsAndVerified(payload["phone"])
+
+def current_auth(token):
+    app.getAuthContext(token, require_verified=True)
+
+def measure(label, authenticate, tokens):
+    _queries[0] = 0
+    elapsed = 0.0
+    for token in tokens:
+        with app.app.test_request_context():
+            started = time.perf_counter()
+            authenticate(token)
+            elapsed += time.perf_counter() - started
+    print("{0:>14}: {1:8.1f} us/request {2:5.2f} queries/request".format(
+        label, elapsed * 1e6 / len(tokens), _queries[0] / len(tokens)))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--db-latency-ms", type=float, default=0.5)
+    args = parser.parse_args()
+
+    _latency[0] = args.db_latency_ms / 1000
+    db_pool.connection = fake_connection
+    tokens = [make_token("bench-user-{0}".format(i)) for i in range(args.requests)]
+
+    measure("legacy", legacy_auth, tokens)
+    app._verified_identities.clear()
+    measure("current (cold)", current_auth, tokens)
+    measure("current (warm)", current_auth, tokens)
+
+if __name__ == "__main__":
+    main()
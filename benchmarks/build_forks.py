@@ -0,0 +1,172 @@
+# Compares the old shell-out build pipeline with the current in-process one.
+#
+# Both pipelines build the same synthetic site from a generated template with a
+# stub hugo binary, and every subprocess started is counted. The stored build digest
+# is cleared before each current build so hugo and the deploy run every time, as in
+# the legacy pipeline. Rebuilds of unchanged inputs, which the build cache skips,
+# are measured and reported on their own line. Run from the repo root:
+#
+#   python benchmarks/build_forks.py [--builds 20] [--template-files 300] [--posts 5]
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+ROOT = tempfile.mkdtemp(prefix="voicemake-bench-")
+TEMPLATE_HOME = os.path.join(ROOT, "template")
+WWW_ROOT = os.path.join(ROOT, "www") + "/"
+STUB_HUGO = os.path.join(ROOT, "hugo")
+
+os.environ.setdefault("APP_NAME", "Voicemake")
+os.environ.setdefault("JWT_SECRET", "benchmark-secret-at-least-32-bytes-long")
+os.environ.setdefault("BASE_URL", "https://about-me.website")
+os.environ["LOCAL_TEMPLATE_HOME"] = TEMPLATE_HOME
+os.environ["WWW_ROOT"] = WWW_ROOT
+os.environ["WORKSPACE_ROOT"] = os.path.join(ROOT, "workspaces")
+os.environ["HUGO_BIN"] = STUB_HUGO
+os.environ["BUILD_QUEUE_DB"] = os.path.join(ROOT, "queue.db")
+os.environ["METRICS_DIR"] = os.path.join(ROOT, "metrics")
+os.environ["PROFILE_RENDERER_DIR"] = os.path.join(ROOT, "profile-renderer")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+import deploy  # noqa: E402
+
+_forks = [0]
+_popen_init = subprocess.Popen.__init__
+
+def _counting_popen_init(self, *args, **kwargs):
+    _forks[0] += 1
+    _popen_init(self, *args, **kwargs)
+
+subprocess.Popen.__init__ = _counting_popen_init
+
+
+def make_template(file_count):
+    for i in range(file_count):
+        folder = os.path.join(TEMPLATE_HOME, "themes", "portfolio-theme", "static", "plugins", "p{0}".format(i % 20))
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, "asset{0}.js".format(i)), "w") as file:
+            file.write("x" * 2048)
+    os.makedirs(os.path.join(TEMPLATE_HOME, "content", "blog"), exist_ok=True)
+    os.makedirs(os.path.join(TEMPLATE_HOME, "data"), exist_ok=True)
+
+    # Stub hugo: copy the source tree's content into the destination like a render would.
+    with open(STUB_HUGO, "w") as file:
+        file.write("#!/bin/sh\nmkdir -p \"$4\" && cp -R \"$2/content\" \"$4/\"\n")
+    os.chmod(STUB_HUGO, 0o755)
+
+def make_profile(directory_id, post_count):
+    profile = {
+        "user_id": "bench-user",
+        "first_name": "jane",
+        "last_name": "doe",
+        "email": "jane@example.com",
+        "current_employer": "Example",
+        "description": "Benchmark profile",
+        "profession": "Engineer",
+        "profile_pic": None,
+        "directory_id": directory_id,
+        "top_skills": ["python", "hugo", "mysql"]
+    }
+    posts = [{
+        "post_id": i,
+        "user_id": "bench-user",
+        "title": "Post {0}".format(i),
+        "created_at": "2020-01-01 00:00:{0:02d}".format(i % 60),
+        "description": "Body of post {0}".format(i)
+    } for i in range(post_count)]
+    return profile, posts
+
+# The pipeline as it was before in-process file operations: every mkdir, rm, cp,
+# touch, cat and ls is a subprocess.
+def legacy_build(blog_posts, user_profile):
+    directory = user_profile["directory_id"]
+    source_dir = os.path.join(ROOT, "legacy", directory + "-hugo-source")
+    build_dir = os.path.join(ROOT, "legacy", directory + "-hugo-build")
+    destination_dir = os.path.join(ROOT, "legacy-www", directory)
+    os.makedirs(os.path.dirname(source_dir), exist_ok=True)
+    os.makedirs(os.path.dirname(destination_dir), exist_ok=True)
+
+    def run(command):
+        subprocess.run(command.split(" "), stdout=subprocess.PIPE)
+
+    if os.path.isdir(source_dir):
+        run("rm -rd {0}".format(source_dir))
+    run("mkdir {0}".format(source_dir))
+    run("cp -a {0} {1}".format(TEMPLATE_HOME + "/.", source_dir + "/"))
+    run("ls -l {0}".format(source_dir))
+
+    generated = [("config.toml", "config"), ("data/aboutinfo.yml", "about"), ("data/skillsinfo.yml", "skills")]
+    generated += [("content/blog/{0}-{1}.md".format(post["title"].replace(" ", "-"), post["post_id"]), post["description"])
+        for post in blog_posts]
+    for relative_path, content in generated:
+        file_path = os.path.join(source_dir, relative_path)
+        if relative_path == "data/skillsinfo.yml":
+            run("touch {0}".format(file_path))
+        with open(file_path, "w") as file:
+            file.write(content)
+        run("cat {0}".format(file_path))
+
+    if os.path.isdir(build_dir):
+        run("rm -rd {0}".format(build_dir))
+    run("mkdir {0}".format(build_dir))
+    run("{0} -s {1} -d {2}".format(STUB_HUGO, source_dir, build_dir))
+    run("ls -l {0}".format(build_dir))
+
+    if os.path.isdir(destination_dir):
+        run("rm -rd {0}".format(destination_dir))
+    run("mkdir {0}".format(destination_dir))
+    run("cp -a {0} {1}".format(build_dir + "/.", destination_dir + "/"))
+    run("ls -l {0}".format(destination_dir))
+
+# Forgets the digest of the last build so the build cache cannot skip hugo and the deploy.
+def current_build(blog_posts, user_profile):
+    deploy.write_site_info(user_profile["directory_id"], build_digest=None)
+    app.startBuildingBlogPosts(blog_posts, dict(user_profile))
+
+def cached_build(blog_posts, user_profile):
+    app.startBuildingBlogPosts(blog_posts, dict(user_profile))
+
+def measure(label, build, builds, post_count):
+    _forks[0] = 0
+    hits_before = app.buildCacheStats()["hits"]
+    started = time.perf_counter()
+    for _ in range(builds):
+        profile, posts = make_profile("bench-site", post_count)
+        build(posts, profile)
+    elapsed = time.perf_counter() - started
+    result = {
+        "pipeline": label,
+        "forks_per_build": _forks[0] / builds,
+        "ms_per_build": elapsed * 1000 / builds,
+        "cache_hits": app.buildCacheStats()["hits"] - hits_before
+    }
+    print("{pipeline:>8}: {forks_per_build:6.1f} forks/build {ms_per_build:9.1f} ms/build {cache_hits:4d} cache hits".format(**result))
+    return result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--builds", type=int, default=20)
+    parser.add_argument("--template-files", type=int, default=300)
+    parser.add_argument("--posts", type=int, default=5)
+    args = parser.parse_args()
+
+    app.logger.setLevel("WARNING")
+    try:
+        make_template(args.template_files)
+        legacy = measure("legacy", legacy_build, args.builds, args.posts)
+        current = measure("current", current_build, args.builds, args.posts)
+        print("   saved: {0:6.1f} forks/build {1:9.1f} ms/build  (every build runs hugo and deploys)".format(
+            legacy["forks_per_build"] - current["forks_per_build"],
+            legacy["ms_per_build"] - current["ms_per_build"]))
+        print("Rebuilds with unchanged inputs, skipped by the build cache:")
+        measure("cached", cached_build, args.builds, args.posts)
+    finally:
+        shutil.rmtree(ROOT, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+# Background build queue for the site builds started by the API.
+#
+# Jobs are stored in a local SQLite file so they survive worker restarts and
+# every uwsgi process sees the same queue. Each process runs a small pool of
+# worker threads that claim queued jobs, run the registered handler for the job
+# kind and record the state (queued/running/succeeded/failed), the current build
+# stage and timings.
+#
+# Jobs enqueued with a coalesce key (the site's directory_id) are merged into a
+# job for the same key that is still waiting in the queue, and a queued job is
+# not started while another job with its key is running. A site is therefore
+# never built twice at the same time and a burst of updates costs one build.
+import os
+import json
+import uuid
+import time
+import sqlite3
+import threading
+import logging
+
+from decouple import config
+
+import app_dirs
+import metrics
+
+logger = logging.getLogger()
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+# Job payloads carry the phone number and text of the SMS sent when the build is done,
+# so the queue must be a file only the app user can write to.
+QUEUE_DB_PATH = config('BUILD_QUEUE_DB', default='') or app_dirs.data_path("build-queue.db")
+WORKER_COUNT = config('BUILD_WORKERS', default=2, cast=int)
+POLL_INTERVAL = config('BUILD_QUEUE_POLL_INTERVAL', default=1, cast=float)
+# A running job whose worker has not touched it for this long is put back in the queue.
+STALE_AFTER = config('BUILD_JOB_STALE_AFTER', default=600, cast=float)
+# How often a worker touches the job it is running, so only the jobs of dead workers go stale.
+HEARTBEAT_INTERVAL = min(30, STALE_AFTER / 3)
+# Finished jobs are deleted this long after they finished.
+RETENTION_DAYS = config('BUILD_JOB_RETENTION_DAYS', default=7, cast=float)
+
+_handlers = {}
+_mergers = {}
+_current = threading.local()
+_wakeup = threading.Condition()
+_workers = []
+_workers_pid = None
+_workers_lock = threading.Lock()
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def _connect():
+    if not _schema_ready:
+        init_queue()
+    db = sqlite3.connect(QUEUE_DB_PATH, timeout=30, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    return db
+
+def init_queue():
+    with _schema_lock:
+        if not _schema_ready:
+            _create_schema()
+
+def _create_schema():
+    global _schema_ready
+    app_dirs.private_dir(os.path.dirname(os.path.abspath(QUEUE_DB_PATH)))
+    for path in (QUEUE_DB_PATH, QUEUE_DB_PATH + "-wal", QUEUE_DB_PATH + "-shm"):
+        app_dirs.check_owned(path)
+    db = sqlite3.connect(QUEUE_DB_PATH, timeout=30, isolation_level=None)
+    try:
+        # Switching to WAL needs an exclusive lock, so only do it once.
+        if db.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+            db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS build_job ( \
+            job_id TEXT PRIMARY KEY, \
+            kind TEXT NOT NULL, \
+            payload TEXT NOT NULL, \
+            state TEXT NOT NULL, \
+            stage TEXT, \
+            error TEXT, \
+            worker TEXT, \
+            created_at REAL NOT NULL, \
+            started_at REAL, \
+            updated_at REAL NOT NULL, \
+            finished_at REAL)")
+        # Columns added after the first release of the queue.
+        columns = [row[1] for row in db.execute("PRAGMA table_info(build_job)")]
+        if "coalesce_key" not in columns:
+            db.execute("ALTER TABLE build_job ADD COLUMN coalesce_key TEXT")
+        if "coalesced" not in columns:
+            db.execute("ALTER TABLE build_job ADD COLUMN coalesced INTEGER NOT NULL DEFAULT 0")
+        db.execute("CREATE INDEX IF NOT EXISTS build_job_state_index ON build_job (state, created_at)")
+        db.execute("CREATE INDEX IF NOT EXISTS build_job_coalesce_index ON build_job (coalesce_key, state)")
+        _schema_ready = True
+    finally:
+        db.close()
+
+# Register the function that runs jobs of the given kind. It is called with the job payload.
+# merge(queued_payload, new_payload) returns the payload of a queued job after another
+# request was coalesced into it. By default the newest payload wins.
+def register(kind, handler, merge=None):
+    _handlers[kind] = handler
+    _mergers[kind] = merge
+
+# Queues a job and returns its id. With a coalesce_key, a job for the same key that is
+# still queued absorbs this request instead, and that job's id is returned.
+def enqueue(kind, payload, coalesce_key=None):
+    job_id = str(uuid.uuid4())
+    now = time.time()
+    db = _connect()
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        queued = None
+        if coalesce_key is not None:
+            queued = db.execute("SELECT job_id, payload FROM build_job WHERE kind = ? AND coalesce_key = ? AND state = ? \
+                ORDER BY created_at LIMIT 1", (kind, coalesce_key, QUEUED)).fetchone()
+        if queued is not None:
+            merge = _mergers.get(kind) or (lambda queued_payload, new_payload: new_payload)
+            job_id = queued["job_id"]
+            db.execute("UPDATE build_job SET payload = ?, coalesced = coalesced + 1, updated_at = ? WHERE job_id = ?",
+                (json.dumps(merge(json.loads(queued["payload"]), payload)), now, job_id))
+        else:
+            db.execute("INSERT INTO build_job (job_id, kind, payload, state, stage, coalesce_key, created_at, updated_at) \
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (job_id, kind, json.dumps(payload), QUEUED, QUEUED, coalesce_key, now, now))
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+    finally:
+        db.close()
+
+    if queued is not None:
+        logger.info("Coalesced {0} build request into queued job {1}".format(kind, job_id))
+        return job_id
+    logger.info("Queued {0} build job {1}".format(kind, job_id))
+    start_workers()
+    with _wakeup:
+        _wakeup.notify()
+    return job_id
+
+def get_job(job_id):
+    db = _connect()
+    try:
+        row = db.execute("SELECT * FROM build_job WHERE job_id = ?", (job_id,)).fetchone()
+    finally:
+        db.close()
+    if row is None:
+        return None
+
+    end = row["finished_at"] or time.time()
+    return {
+        "job_id": row["job_id"],
+        "kind": row["kind"],
+        "state": row["state"],
+        "stage": row["stage"],
+        "error": row["error"],
+        "coalesced_requests": row["coalesced"],
+        "created_at": row["created_at"],
+        "started_at": row["started_at"],
+        "finished_at": row["finished_at"],
+        "queued_seconds": round((row["started_at"] or end) - row["created_at"], 3),
+        "duration_seconds": round(end - row["started_at"], 3) if row["started_at"] else None
+    }
+
+# The payload a job runs with, or None if there is no such job.
+def get_payload(job_id):
+    db = _connect()
+    try:
+        row = db.execute("SELECT payload FROM build_job WHERE job_id = ?", (job_id,)).fetchone()
+    finally:
+        db.close()
+    return json.loads(row["payload"]) if row else None
+
+# Job counts by state and how many build requests were absorbed by already queued jobs.
+def queue_stats():
+    db = _connect()
+    try:
+        counts = dict((row[0], row[1]) for row in db.execute("SELECT state, count(*) FROM build_job GROUP BY state"))
+        coalesced = db.execute("SELECT coalesce(sum(coalesced), 0) FROM build_job").fetchone()[0]
+    finally:
+        db.close()
+    output = dict((state, counts.get(state, 0)) for state in (QUEUED, RUNNING, SUCCEEDED, FAILED))
+    output["coalesced_requests"] = coalesced
+    return output
+
+# Called from inside a running build to record which stage it has reached. The time
+# spent in the previous stage goes to the stage duration histogram. The job row is
+# only updated when the build is running as a queued job.
+def set_stage(stage):
+    end_stage()
+    _current.stage = (stage, time.monotonic())
+    job_id = getattr(_current, "job_id", None)
+    if job_id is None:
+        return
+    db = _connect()
+    try:
+        db.execute("UPDATE build_job SET stage = ?, updated_at = ? WHERE job_id = ?", (stage, time.time(), job_id))
+    finally:
+        db.close()
+
+# Records the duration of the stage this thread is in, if any, and leaves it.
+def end_stage():
+    current = getattr(_current, "stage", None)
+    _current.stage = None
+    if current is not None:
+        metrics.BUILD_STAGE_SECONDS.observe(time.monotonic() - current[1], stage=current[0])
+
+# Atomically move the oldest queued job to running and return it. Jobs whose coalesce
+# key already has a running job are left in the queue until that job finishes.
+def _claim_job(worker_name):
+    db = _connect()
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        db.execute("UPDATE build_job SET state = ?, stage = ?, worker = NULL, updated_at = ? \
+            WHERE state = ? AND updated_at < ?", (QUEUED, QUEUED, now, RUNNING, now - STALE_AFTER))
+        row = db.execute("SELECT job_id, kind, payload FROM build_job WHERE state = ? \
+            AND (coalesce_key IS NULL OR coalesce_key NOT IN \
+                (SELECT coalesce_key FROM build_job WHERE state = ? AND coalesce_key IS NOT NULL)) \
+            ORDER BY created_at LIMIT 1", (QUEUED, RUNNING)).fetchone()
+        if row is None:
+            db.execute("COMMIT")
+            return None
+        db.execute("UPDATE build_job SET state = ?, stage = ?, worker = ?, started_at = ?, updated_at = ? \
+            WHERE job_id = ?", (RUNNING, "starting", worker_name, now, now, row["job_id"]))
+        db.execute("COMMIT")
+        return row["job_id"], row["kind"], json.loads(row["payload"])
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+    finally:
+        db.close()
+
+def _finish_job(job_id, state, error=None):
+    now = time.time()
+    db = _connect()
+    try:
+        if state == SUCCEEDED:
+            db.execute("UPDATE build_job SET state = ?, stage = ?, finished_at = ?, updated_at = ? WHERE job_id = ?",
+                (state, "done", now, now, job_id))
+        else:
+            db.execute("UPDATE build_job SET state = ?, error = ?, finished_at = ?, updated_at = ? WHERE job_id = ?",
+                (state, error, now, now, job_id))
+        # Jobs past the retention period, so the queue file does not grow forever.
+        db.execute("DELETE FROM build_job WHERE finished_at < ? AND state IN (?, ?)",
+            (now - RETENTION_DAYS * 86400, SUCCEEDED, FAILED))
+    finally:
+        db.close()
+
+# Touches the running job until done is set. A job that stays in one stage longer than
+# STALE_AFTER (a slow hugo run) is then not taken for abandoned and run a second time.
+def _heartbeat(job_id, done):
+    while not done.wait(HEARTBEAT_INTERVAL):
+        try:
+            db = _connect()
+            try:
+                db.execute("UPDATE build_job SET updated_at = ? WHERE job_id = ? AND state = ?", (time.time(), job_id, RUNNING))
+            finally:
+                db.close()
+        except Exception:
+            logger.exception("Could not update build job {0}".format(job_id))
+
+def run_job(job_id, kind, payload):
+    handler = _handlers.get(kind)
+    if handler is None:
+        _finish_job(job_id, FAILED, "No handler registered for job kind {0}".format(kind))
+        return
+
+    _current.job_id = job_id
+    done = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job_id, done), name="build-heartbeat-" + job_id, daemon=True).start()
+    try:
+        logger.info("Running {0} build job {1}".format(kind, job_id))
+        handler(payload)
+        _finish_job(job_id, SUCCEEDED)
+        logger.info("Finished {0} build job {1}".format(kind, job_id))
+    except Exception as e:
+        logger.exception("Build job {0} failed".format(job_id))
+        _finish_job(job_id, FAILED, str(e))
+    finally:
+        done.set()
+        end_stage()
+        _current.job_id = None
+        # A job for the same site may have been waiting on this one.
+        with _wakeup:
+            _wakeup.notify_all()
+
+def _worker_loop(worker_name):
+    while True:
+        try:
+            job = _claim_job(worker_name)
+        except Exception:
+            logger.exception("Could not read the build queue")
+            job = None
+        if job is None:
+            with _wakeup:
+                _wakeup.wait(POLL_INTERVAL)
+            continue
+        run_job(*job)
+
+# Start the worker threads for this process. Safe to call repeatedly; workers
+# are (re)started after a fork since threads do not survive it.
+def start_workers():
+    global _workers, _workers_pid
+    if _workers_pid == os.getpid():
+        return
+    with _workers_lock:
+        if _workers_pid == os.getpid():
+            return
+        _workers = []
+        for i in range(WORKER_COUNT):
+            name = "{0}-{1}".format(os.getpid(), i)
+            worker = threading.Thread(target=_worker_loop, args=(name,), name="build-worker-" + name, daemon=True)
+            worker.start()
+            _workers.append(worker)
+        _workers_pid = os.getpid()
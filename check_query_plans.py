@@ -0,0 +1,118 @@
+# Query plan regression check for the SQL in app.py.
+#
+#   python check_query_plans.py [--seed 2000]
+#
+# Every SELECT, UPDATE and DELETE string in app.py is run through EXPLAIN against
+# the database in the DB_* settings (migrated with migrate.py). The check fails
+# when a statement reads a whole table or index (EXPLAIN type ALL or index) or
+# cannot be explained at all, unless its function is listed in ALLOWED below.
+#
+# On a nearly empty database MySQL may pick a full scan because it is cheaper.
+# Run it against a copy with real data, or pass --seed N on a scratch database
+# to insert N synthetic users (with skills, posts and a directory) first.
+import os
+import re
+import ast
+import sys
+import argparse
+
+import db_pool
+
+APP_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+# Functions whose statements are not checked, with the reason.
+ALLOWED = {
+    "loadAllSitesForRebuild": "bulk export of every site for rebuild_sites.py",
+    "verifyUser": "unused, user_auth is not part of the schema",
+    "createAuthCodeForUser": "unused, user_auth is not part of the schema",
+}
+
+FULL_SCAN_TYPES = ("ALL", "index")
+STATEMENT_PATTERN = re.compile(r"(SELECT\s.+\sFROM\s|UPDATE\s+\S+\s+SET\s|DELETE\s+FROM\s)", re.IGNORECASE)
+
+
+# Returns [(function_name, sql)] for every SQL statement string literal in the file.
+def find_statements(path):
+    with open(path) as file:
+        tree = ast.parse(file.read())
+    statements = []
+    for function in ast.walk(tree):
+        if not isinstance(function, ast.FunctionDef):
+            continue
+        for node in ast.walk(function):
+            if isinstance(node, ast.Constant) and isinstance(node.value, str):
+                sql = " ".join(node.value.split())
+                if STATEMENT_PATTERN.match(sql):
+                    statements.append((function.name, sql))
+    return statements
+
+# EXPLAIN needs literal values. LIMIT wants a number, everything else gets a string.
+def with_sample_values(sql):
+    sql = re.sub(r"LIMIT %s", "LIMIT 10", sql, flags=re.IGNORECASE)
+    return sql.replace("%s", "'0'")
+
+def explain(cursor, sql):
+    cursor.execute("EXPLAIN " + with_sample_values(sql))
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+def seed(db, count):
+    cursor = db.cursor()
+    for start in range(0, count, 500):
+        users = ["plan-check-{0}".format(i) for i in range(start, min(start + 500, count))]
+        cursor.executemany("INSERT IGNORE INTO phone_auth (phone, auth_code, is_verified, user_id) VALUES (%s, 1234, true, %s)",
+            [("+1" + user_id, user_id) for user_id in users])
+        cursor.executemany("INSERT IGNORE INTO user (user_id, first_name, last_name, email) VALUES (%s, 'plan', 'check', 'plan@example.com')",
+            [(user_id,) for user_id in users])
+        cursor.executemany("INSERT IGNORE INTO user_directory (directory_id, user_id) VALUES (%s, %s)",
+            [(user_id, user_id) for user_id in users])
+        cursor.executemany("INSERT INTO user_top_skill (user_id, skill_name) VALUES (%s, %s)",
+            [(user_id, "skill-{0}".format(i)) for user_id in users for i in range(3)])
+        cursor.executemany("INSERT INTO user_blog_post (user_id, title, description) VALUES (%s, %s, 'body')",
+            [(user_id, "post-{0}".format(i)) for user_id in users for i in range(5)])
+        db.commit()
+    for table in ("phone_auth", "user", "user_directory", "user_top_skill", "user_blog_post"):
+        cursor.execute("ANALYZE TABLE " + table)
+        cursor.fetchall()
+    cursor.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="EXPLAIN every query in app.py and fail on full scans")
+    parser.add_argument("--seed", type=int, default=0, help="insert this many synthetic users first (scratch databases only)")
+    args = parser.parse_args()
+
+    db = db_pool._connect()
+    try:
+        if args.seed:
+            seed(db, args.seed)
+
+        cursor = db.cursor()
+        failures = 0
+        for function_name, sql in find_statements(APP_SOURCE):
+            if function_name in ALLOWED:
+                print("skip {0}: {1}".format(function_name, ALLOWED[function_name]))
+                continue
+            try:
+                plan = explain(cursor, sql)
+            except Exception as e:
+                failures += 1
+                print("FAIL {0}: could not EXPLAIN ({1})\n     {2}".format(function_name, e, sql))
+                continue
+            scans = [row for row in plan if row.get("type") in FULL_SCAN_TYPES]
+            if scans:
+                failures += 1
+                print("FAIL {0}: full scan of {1}\n     {2}".format(
+                    function_name, ", ".join("{0} ({1})".format(row["table"], row["type"]) for row in scans), sql))
+            else:
+                print("ok   {0}: {1}".format(function_name, ", ".join(
+                    "{0} {1} {2}".format(row["table"], row["type"], row["key"]) for row in plan)))
+        cursor.close()
+    finally:
+        db.close()
+
+    if failures:
+        print("{0} statements need an index or an ALLOWED entry".format(failures))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
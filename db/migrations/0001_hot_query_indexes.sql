@@ -0,0 +1,12 @@
+-- Indexes for the per-user queries the API runs on every profile save, build and listing.
+-- phone_auth lookups by phone and user_directory lookups by directory_id already use
+-- the primary keys, and user_directory by user_id uses its foreign key index (which
+-- includes directory_id), so those tables need nothing new.
+
+-- loadUserProfile and replaceUserTopSkills read a user's skills in
+-- skill_id order; this index answers them without touching the table rows.
+ALTER TABLE `user_top_skill` ADD INDEX `user_top_skill_user_id_skill_index` (`user_id`, `skill_id`, `skill_name`);
+
+-- Newest-first post reads and the keyset pagination in getBlogPostsPage. InnoDB appends
+-- post_id (the primary key), which covers the tie-break.
+ALTER TABLE `user_blog_post` ADD INDEX `user_blog_post_user_id_created_at_index` (`user_id`, `created_at`);
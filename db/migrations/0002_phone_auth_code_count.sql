@@ -0,0 +1,4 @@
+-- Number of codes sent to the phone. createAuthCode and createLoginAuthCode bump it
+-- with every new code, which also tells them from the affected row count whether a
+-- code was written at all.
+ALTER TABLE `phone_auth` ADD COLUMN `auth_code_count` INT UNSIGNED NOT NULL DEFAULT 0;
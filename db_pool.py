@@ -0,0 +1,385 @@
+# Process-wide MySQL connection pool shared by the data helpers in app.py.
+#
+# Every uwsgi worker gets its own pool (size DB_POOL_SIZE), so the database
+# sees at most `processes * DB_POOL_SIZE` connections from the API.
+# Inside a Flask request the same connection is reused by every helper and
+# handed back to the pool when the app context is torn down.
+#
+# That connection is also the request's unit of work: a helper's db.commit() only
+# marks the transaction as having writes, and finish_request() commits once after
+# the handler returned. An exception (or a 4xx or 5xx response) rolls everything back.
+# Code that must publish its writes before a side effect, e.g. queueing a build
+# that another thread reads them in, calls commit() explicitly.
+import os
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+import mysql.connector
+from mysql.connector import errors
+from decouple import config
+from flask import g, has_app_context, request
+
+import accounting
+
+logger = logging.getLogger()
+
+
+class PoolTimeout(errors.PoolError):
+    pass
+
+
+class ConnectionPool(object):
+    def __init__(self, connect, size=5, timeout=10, validate_after=30):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.validate_after = validate_after
+        self._lock = threading.Condition()
+        self._reset()
+
+    # Forget everything inherited from the parent process. The sockets belong to
+    # the parent so they are dropped, not closed (closing would send COM_QUIT).
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = []
+        self._in_use = 0
+        self._counters = {
+            "created": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "validation_failures": 0,
+            "discarded": 0,
+        }
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    # Ping connections that sat idle for a while. Returns False if it is dead.
+    def _validate(self, conn, idle_since):
+        if time.monotonic() - idle_since < self.validate_after:
+            return True
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except errors.Error:
+            self._counters["validation_failures"] += 1
+            return False
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with self._lock:
+            self._check_pid()
+            waited = False
+            while True:
+                while self._idle:
+                    conn, idle_since = self._idle.pop()
+                    if self._validate(conn, idle_since):
+                        self._in_use += 1
+                        self._counters["checkouts"] += 1
+                        return conn
+                    self._close_quietly(conn)
+                if self._in_use < self.size:
+                    # Reserve the slot before connecting outside the lock.
+                    self._in_use += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters["timeouts"] += 1
+                    raise PoolTimeout("No database connection available after {0}s (pool size {1})"
+                        .format(self.timeout, self.size))
+                if not waited:
+                    self._counters["waits"] += 1
+                    waited = True
+                self._lock.wait(remaining)
+
+        try:
+            conn = self.connect()
+        except Exception:
+            with self._lock:
+                self._in_use -= 1
+                self._lock.notify()
+            raise
+        with self._lock:
+            self._counters["created"] += 1
+            self._counters["checkouts"] += 1
+        conn._pool_pid = os.getpid()
+        return conn
+
+    # Returns a connection to the pool. Any open transaction is rolled back so
+    # the next borrower does not inherit a stale snapshot or half-done writes.
+    def release(self, conn, discard=False):
+        if getattr(conn, "_pool_pid", None) != os.getpid():
+            return
+        if not discard:
+            try:
+                conn.rollback()
+            except errors.Error:
+                discard = True
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._in_use -= 1
+            if discard:
+                self._counters["discarded"] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._lock.notify()
+        if discard:
+            self._close_quietly(conn)
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except errors.Error:
+            pass
+
+    def close_all(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    def stats(self):
+        with self._lock:
+            self._check_pid()
+            output = {
+                "pid": self._pid,
+                "size": self.size,
+                "timeout": self.timeout,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+            }
+            output.update(self._counters)
+        return output
+
+
+def _connect():
+    with accounting.track("mysql_connect"):
+        return mysql.connector.connect(
+            host=config('DB_HOST'),
+            user=config('DB_USER'),
+            password=config('DB_PASSWORD'),
+            database=config('DB_NAME')
+        )
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    _connect,
+                    size=config('DB_POOL_SIZE', default=5, cast=int),
+                    timeout=config('DB_POOL_TIMEOUT', default=10, cast=float),
+                    validate_after=config('DB_POOL_VALIDATE_AFTER', default=30, cast=float)
+                )
+    return _pool
+
+_request_counters = {"requests": 0, "statements": 0, "commit_calls": 0, "commits": 0, "rollbacks": 0}
+_request_counters_lock = threading.Lock()
+
+
+class UnitOfWork(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.statements = 0
+        self.commit_calls = 0
+        self.commits = 0
+        self.rollbacks = 0
+        self.dirty = False
+        self.callbacks = []
+
+    def commit(self):
+        if self.dirty:
+            with accounting.track("mysql"):
+                self.conn.commit()
+            self.commits += 1
+            self.dirty = False
+        callbacks, self.callbacks = self.callbacks, []
+        for callback, args in callbacks:
+            callback(*args)
+
+    def rollback(self):
+        with accounting.track("mysql"):
+            self.conn.rollback()
+        self.rollbacks += 1
+        self.dirty = False
+        self.callbacks = []
+
+
+# Reports the duration of every statement and the rows it fetched to accounting.
+class _TimedCursor(object):
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._entry = None
+
+    def execute(self, operation, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(operation, *args, **kwargs)
+        finally:
+            self._entry = accounting.query(operation, time.perf_counter() - started)
+
+    def executemany(self, operation, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._cursor.executemany(operation, *args, **kwargs)
+        finally:
+            self._entry = accounting.query(operation, time.perf_counter() - started)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            accounting.rows(self._entry, 1)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        accounting.rows(self._entry, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        accounting.rows(self._entry, len(rows))
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+
+# Counts statements for the unit of work.
+class _RequestCursor(_TimedCursor):
+    def __init__(self, cursor, unit):
+        super(_RequestCursor, self).__init__(cursor)
+        self._unit = unit
+
+    def execute(self, *args, **kwargs):
+        self._unit.statements += 1
+        return super(_RequestCursor, self).execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._unit.statements += 1
+        return super(_RequestCursor, self).executemany(*args, **kwargs)
+
+
+# A pooled connection used outside a request, e.g. by a build job.
+class _TimedConnection(object):
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self, *args, **kwargs):
+        return _TimedCursor(self._conn.cursor(*args, **kwargs))
+
+    def commit(self):
+        with accounting.track("mysql"):
+            self._conn.commit()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+# Turns commit() into "commit at the end of the request".
+class _RequestConnection(object):
+    def __init__(self, unit):
+        self._unit = unit
+
+    def cursor(self, *args, **kwargs):
+        return _RequestCursor(self._unit.conn.cursor(*args, **kwargs), self._unit)
+
+    def commit(self):
+        self._unit.commit_calls += 1
+        self._unit.dirty = True
+
+    def rollback(self):
+        self._unit.rollback()
+
+    def __getattr__(self, name):
+        return getattr(self._unit.conn, name)
+
+# Borrow a connection. Within a Flask app context the connection is kept on `g`
+# and shared by every helper until the context is torn down.
+@contextmanager
+def connection():
+    pool = get_pool()
+    if has_app_context():
+        unit = g.get("db_unit")
+        if unit is None:
+            unit = UnitOfWork(pool.acquire())
+            g.db_conn = unit.conn
+            g.db_unit = unit
+        yield _RequestConnection(unit)
+        return
+
+    conn = pool.acquire()
+    try:
+        yield _TimedConnection(conn)
+    except Exception:
+        pool.release(conn, discard=not _is_alive(conn))
+        raise
+    pool.release(conn)
+
+def _is_alive(conn):
+    try:
+        return conn.is_connected()
+    except errors.Error:
+        return False
+
+# Commits the request's writes now and runs the after_commit callbacks.
+# Outside a request every helper commits on its own, so this does nothing.
+def commit():
+    unit = g.get("db_unit") if has_app_context() else None
+    if unit is not None:
+        unit.commit()
+
+# Runs callback(*args) once the current writes are committed: straight away
+# outside a request, otherwise when the request's unit of work commits.
+def after_commit(callback, *args):
+    unit = g.get("db_unit") if has_app_context() else None
+    if unit is None:
+        callback(*args)
+    else:
+        unit.callbacks.append((callback, args))
+
+# Registered with app.after_request. Commits the unit of work unless the request failed
+# or was rejected with a 4xx.
+def finish_request(response):
+    unit = g.get("db_unit")
+    if unit is None:
+        return response
+    if response.status_code < 400:
+        unit.commit()
+    elif unit.dirty:
+        unit.rollback()
+    logger.debug("{0} {1}: {2} statements, {3} commit calls, {4} commits".format(
+        request.method, request.path, unit.statements, unit.commit_calls, unit.commits))
+    return response
+
+def request_stats():
+    with _request_counters_lock:
+        return dict(_request_counters)
+
+# Registered with app.teardown_appcontext. Anything still uncommitted here
+# (e.g. the handler raised) is rolled back by pool.release().
+def release_request_connection(exception=None):
+    unit = g.pop("db_unit", None)
+    if unit is not None:
+        with _request_counters_lock:
+            _request_counters["requests"] += 1
+            _request_counters["statements"] += unit.statements
+            _request_counters["commit_calls"] += unit.commit_calls
+            _request_counters["commits"] += unit.commits
+            _request_counters["rollbacks"] += unit.rollbacks + (1 if unit.dirty else 0)
+    conn = g.pop("db_conn", None)
+    if conn is not None:
+        get_pool().release(conn, discard=exception is not None and not _is_alive(conn))
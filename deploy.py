@@ -0,0 +1,282 @@
+# Atomic site deploys using versioned release directories.
+#
+# WWW_ROOT/<directory> is a symlink to the live release under
+# DEPLOY_RELEASES_ROOT/<directory>/<release>. A deploy fills a new release
+# directory (hard-linking files that did not change since the previous release,
+# copying the rest) and then swaps the symlink with a single rename, so the
+# public site never serves a half-written tree. The newest DEPLOY_KEEP_RELEASES
+# releases are kept for rollback and older ones are removed in the background.
+#
+# Files hugo copies verbatim from the template's static directories (bootstrap,
+# jQuery, theme images and CSS) are the same for every site. A deploy stores them
+# once per content hash under DEPLOY_RELEASES_ROOT/.shared-assets and hard-links
+# them into the release, so all sites share one copy on disk and in the page cache.
+# `python deploy.py assets` reports how much that saves.
+import os
+import sys
+import json
+import uuid
+import time
+import datetime
+import shutil
+import filecmp
+import hashlib
+import threading
+import logging
+
+from decouple import config
+
+import metrics
+import workspaces
+
+logger = logging.getLogger()
+
+KEEP_RELEASES = config('DEPLOY_KEEP_RELEASES', default=3, cast=int)
+SITE_INFO_NAME = ".site-info.json"
+ASSET_STORE_NAME = ".shared-assets"
+# Stored assets no release links to any more are removed after this long.
+ASSET_MIN_AGE = 3600
+
+_asset_index = {}
+_asset_index_lock = threading.Lock()
+
+
+# Defaults to a sibling of WWW_ROOT so old releases are not served from the web root.
+def releases_root():
+    return config('DEPLOY_RELEASES_ROOT', default='') or config('WWW_ROOT').rstrip('/') + '-releases'
+
+def site_releases_dir(directory_id):
+    return os.path.join(releases_root(), directory_id)
+
+def asset_store_dir():
+    return os.path.join(releases_root(), ASSET_STORE_NAME)
+
+def site_path(directory_id):
+    return os.path.join(config('WWW_ROOT'), directory_id)
+
+def current_release(directory_id):
+    path = site_path(directory_id)
+    if os.path.islink(path):
+        return os.path.realpath(path)
+    return None
+
+def list_releases(directory_id):
+    releases_dir = site_releases_dir(directory_id)
+    if not os.path.isdir(releases_dir):
+        return []
+    return [os.path.join(releases_dir, name) for name in sorted(os.listdir(releases_dir))
+        if not name.startswith(".")]
+
+# Details about the live build of a site (e.g. the template version), kept next to its releases.
+def read_site_info(directory_id):
+    try:
+        with open(os.path.join(site_releases_dir(directory_id), SITE_INFO_NAME), 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def write_site_info(directory_id, **fields):
+    site_info = read_site_info(directory_id)
+    site_info.update(fields)
+    info_path = os.path.join(site_releases_dir(directory_id), SITE_INFO_NAME)
+    os.makedirs(os.path.dirname(info_path), exist_ok=True)
+    with open(info_path + ".tmp", 'w') as file:
+        json.dump(site_info, file)
+    os.replace(info_path + ".tmp", info_path)
+
+def _new_release_path(directory_id):
+    name = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f') + "-" + uuid.uuid4().hex[:8]
+    return os.path.join(site_releases_dir(directory_id), name)
+
+# {output path: size} of the files hugo copies verbatim from static/ of the template and
+# of its themes. Only these go to the shared store, so pages of one site never do.
+def _template_assets(template_home):
+    snapshot = workspaces.scan_template(template_home)
+    with _asset_index_lock:
+        cached = _asset_index.get(template_home)
+        if cached and cached[0] is snapshot:
+            return cached[1]
+    theme_assets = {}
+    site_assets = {}
+    for relative_path, stat in snapshot.items():
+        if stat == "dir":
+            continue
+        parts = relative_path.split(os.sep)
+        if len(parts) > 3 and parts[0] == "themes" and parts[2] == "static":
+            theme_assets[os.path.join(*parts[3:])] = stat[0]
+        elif len(parts) > 1 and parts[0] == "static":
+            site_assets[os.path.join(*parts[1:])] = stat[0]
+    # A file in the site's static/ replaces the theme's file at the same path.
+    theme_assets.update(site_assets)
+    with _asset_index_lock:
+        _asset_index[template_home] = (snapshot, theme_assets)
+    return theme_assets
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Hard-links target_file to the stored copy of source_file's content, storing it first
+# if needed. Returns False when the file has to be copied instead, e.g. when the stored
+# copy reached the filesystem's hard link limit (65000 on ext4).
+def _link_shared_asset(source_file, target_file):
+    digest = _file_digest(source_file)
+    store_path = os.path.join(asset_store_dir(), digest[:2], digest)
+    if not os.path.exists(store_path):
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+        temp_path = "{0}.tmp-{1}".format(store_path, uuid.uuid4().hex[:8])
+        shutil.copy2(source_file, temp_path)
+        try:
+            # Another deploy may have stored the same content meanwhile, keep its inode.
+            os.link(temp_path, store_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+    try:
+        os.link(store_path, target_file)
+    except OSError:
+        return False
+    return True
+
+# Fills release_dir from build_dir. Template assets are linked from the shared store
+# and files identical to the previous release are hard-linked, so only changed
+# output is written to disk.
+def _populate_release(build_dir, release_dir, previous_release, assets):
+    copied = linked = shared = copied_bytes = 0
+    for root, dirs, files in os.walk(build_dir):
+        relative_root = os.path.relpath(root, build_dir)
+        target_root = os.path.normpath(os.path.join(release_dir, relative_root))
+        os.makedirs(target_root, exist_ok=True)
+        for name in files:
+            source_file = os.path.join(root, name)
+            target_file = os.path.join(target_root, name)
+            asset_size = assets.get(os.path.normpath(os.path.join(relative_root, name)))
+            if asset_size is not None and os.path.getsize(source_file) == asset_size \
+                    and _link_shared_asset(source_file, target_file):
+                shared += 1
+                continue
+            if previous_release:
+                previous_file = os.path.normpath(os.path.join(previous_release, relative_root, name))
+                if os.path.isfile(previous_file) and filecmp.cmp(source_file, previous_file, shallow=False):
+                    try:
+                        os.link(previous_file, target_file)
+                        linked += 1
+                        continue
+                    except OSError:
+                        pass
+            shutil.copy2(source_file, target_file)
+            copied += 1
+            copied_bytes += os.path.getsize(target_file)
+    metrics.BUILD_FILES_WRITTEN.inc(copied, step="deploy")
+    metrics.BUILD_BYTES_COPIED.inc(copied_bytes, step="deploy")
+    return copied, linked, shared
+
+# Points the public site path at release_dir with an atomic rename.
+def _swap_symlink(directory_id, release_dir):
+    path = site_path(directory_id)
+    if os.path.isdir(path) and not os.path.islink(path):
+        # A site deployed before releases existed. Keep it as the oldest release.
+        legacy_release = os.path.join(site_releases_dir(directory_id), "00000000000000-legacy")
+        os.rename(path, legacy_release)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_link = "{0}.tmp-{1}".format(path, uuid.uuid4().hex[:8])
+    os.symlink(release_dir, temp_link)
+    os.replace(temp_link, path)
+
+# Deploys build_dir as the new live release. Pass the template it was built from to
+# share its static assets with the other sites.
+def deploy_release(build_dir, directory_id, template_home=None):
+    logger.info('Starting deploying build folder as a new release')
+    previous_release = current_release(directory_id)
+    release_dir = _new_release_path(directory_id)
+    assets = _template_assets(template_home) if template_home else {}
+    os.makedirs(release_dir)
+    try:
+        copied, linked, shared = _populate_release(build_dir, release_dir, previous_release, assets)
+        _swap_symlink(directory_id, release_dir)
+    except Exception:
+        shutil.rmtree(release_dir, ignore_errors=True)
+        raise
+    logger.info('Done deploying release {0} ({1} files copied, {2} unchanged files linked, {3} shared assets linked)'
+        .format(release_dir, copied, linked, shared))
+    schedule_cleanup(directory_id)
+    return release_dir
+
+# Switches the site back to the release before the current one.
+def rollback_release(directory_id):
+    current = current_release(directory_id)
+    releases = list_releases(directory_id)
+    older = [release for release in releases if release < current] if current else []
+    if not older:
+        return None
+    _swap_symlink(directory_id, older[-1])
+    logger.info('Rolled back {0} to {1}'.format(directory_id, older[-1]))
+    return older[-1]
+
+# Removes all but the newest KEEP_RELEASES releases. The live release is never removed.
+def cleanup_releases(directory_id):
+    current = current_release(directory_id)
+    releases = list_releases(directory_id)
+    removed = 0
+    for release in releases[:max(len(releases) - KEEP_RELEASES, 0)]:
+        if release == current:
+            continue
+        shutil.rmtree(release, ignore_errors=True)
+        removed += 1
+    if removed:
+        logger.info('Removed {0} old releases of {1}'.format(removed, directory_id))
+        prune_asset_store()
+    return removed
+
+def _stored_assets():
+    for root, dirs, files in os.walk(asset_store_dir()):
+        for name in files:
+            if ".tmp-" not in name:
+                path = os.path.join(root, name)
+                yield path, os.lstat(path)
+
+# Removes stored assets that no release links to any more. The link count changes the
+# inode's ctime, so ASSET_MIN_AGE protects assets a deploy is linking right now.
+def prune_asset_store():
+    removed = 0
+    for path, stat in _stored_assets():
+        if stat.st_nlink == 1 and time.time() - stat.st_ctime > ASSET_MIN_AGE:
+            os.remove(path)
+            removed += 1
+    return removed
+
+# bytes_saved counts every release file linked to a stored asset, beyond the first,
+# as a copy that is not on disk.
+def asset_report():
+    report = {"stored_files": 0, "stored_bytes": 0, "release_links": 0, "bytes_saved": 0}
+    for path, stat in _stored_assets():
+        report["stored_files"] += 1
+        report["stored_bytes"] += stat.st_size
+        report["release_links"] += stat.st_nlink - 1
+        report["bytes_saved"] += stat.st_size * max(stat.st_nlink - 2, 0)
+    return report
+
+def schedule_cleanup(directory_id):
+    thread = threading.Thread(target=cleanup_releases, args=(directory_id,), daemon=True)
+    thread.start()
+    return thread
+
+if __name__ == '__main__':
+    # python deploy.py assets
+    if sys.argv[1:] == ["assets"]:
+        report = asset_report()
+        print("{0} shared assets ({1:.1f} MB) linked from {2} release files, {3:.1f} MB saved".format(
+            report["stored_files"], report["stored_bytes"] / 1048576.0, report["release_links"], report["bytes_saved"] / 1048576.0))
+        sys.exit(0)
+    # python deploy.py rollback <directory_id>
+    if len(sys.argv) != 3 or sys.argv[1] != "rollback":
+        print("Usage: python deploy.py rollback <directory_id> | python deploy.py assets")
+        sys.exit(1)
+    logging.basicConfig(format='%(asctime)s [%(levelname)s]: %(message)s', level=logging.INFO)
+    if rollback_release(sys.argv[2]) is None:
+        print("No previous release to roll back to")
+        sys.exit(1)
@@ -0,0 +1,365 @@
+# Prometheus-style counters, gauges and histograms shared by the uwsgi workers.
+#
+# Each process keeps its metrics in memory and writes them to
+# METRICS_DIR/<pid>-<start time>.json every METRICS_FLUSH_INTERVAL seconds, the start
+# time telling apart processes that were given the same pid. GET /metrics reads the
+# files of every process and adds them up, so a scrape sees the totals of the whole
+# server whichever worker answers it. The counters and histograms of processes that
+# have exited are folded into METRICS_DIR/archived.json, so the totals never go
+# backwards when uwsgi recycles a worker. Gauges only count processes that are alive.
+# METRICS_DIR must belong to the app user, and scripts and benchmarks should point
+# it somewhere else so their totals do not end up in the server's archive.
+import os
+import json
+import time
+import fcntl
+import bisect
+import atexit
+import threading
+import contextlib
+import logging
+
+from decouple import config
+
+import app_dirs
+
+logger = logging.getLogger()
+
+METRICS_DIR = config('METRICS_DIR', default='') or app_dirs.cache_path("metrics")
+FLUSH_INTERVAL = config('METRICS_FLUSH_INTERVAL', default=5, cast=float)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Seconds. Builds range from a few milliseconds (cache hits) to a minute (large blogs).
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ARCHIVE_NAME = "archived.json"
+
+_metrics = {}
+_lock = threading.Lock()
+# Values recorded before a fork belong to the parent, see _check_process.
+_pid = os.getpid()
+_flusher_pid = None
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError("{0} takes the labels {1}, got {2}".format(self.name, self.labels, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _add(self, amount, labels):
+        key = self._key(labels)
+        with _lock:
+            _check_process()
+            self._values[key] = self._values.get(key, 0) + amount
+        _start_flusher()
+
+    def definition(self):
+        return {"kind": self.kind, "help": self.help, "labels": list(self.labels)}
+
+    def samples(self):
+        return [[list(key), value] for key, value in self._values.items()]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        self._add(amount, labels)
+
+    # The sum over all label values recorded by this process.
+    def total(self):
+        with _lock:
+            _check_process()
+            return sum(self._values.values())
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        self._add(amount, labels)
+
+    def dec(self, amount=1, **labels):
+        self._add(-amount, labels)
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    # Bucket counts are stored per bucket and only made cumulative when rendered.
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            _check_process()
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0, "count": 0}
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+        _start_flusher()
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def definition(self):
+        return dict(super(Histogram, self).definition(), buckets=list(self.buckets))
+
+    def samples(self):
+        return [[list(key), {"buckets": list(series["buckets"]), "sum": series["sum"], "count": series["count"]}]
+            for key, series in self._values.items()]
+
+
+def _register(metric):
+    with _lock:
+        return _metrics.setdefault(metric.name, metric)
+
+def counter(name, help, labels=()):
+    return _register(Counter(name, help, labels))
+
+def gauge(name, help, labels=()):
+    return _register(Gauge(name, help, labels))
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, help, labels, buckets))
+
+# A forked worker starts from zero, the parent reports what it recorded itself.
+# Called with _lock held.
+def _check_process():
+    global _pid
+    if _pid != os.getpid():
+        _pid = os.getpid()
+        for metric in _metrics.values():
+            metric._values = {}
+
+def _start_flusher():
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True).start()
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception:
+            logger.exception("Could not write the metrics of process {0}".format(os.getpid()))
+
+# Start time of a process in clock ticks since boot, or None if there is no such
+# process (or no /proc to ask).
+def _process_start(pid):
+    try:
+        with open("/proc/{0}/stat".format(pid)) as file:
+            # The command name before the fields may contain spaces and parentheses.
+            return file.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+def _file_name(pid):
+    return "{0}-{1}.json".format(pid, _process_start(pid) or 0)
+
+# Writes the metrics of this process to its file in METRICS_DIR.
+def flush():
+    with _lock:
+        _check_process()
+        snapshot = dict((metric.name, dict(metric.definition(), samples=metric.samples()))
+            for metric in _metrics.values() if metric._values)
+    if not snapshot:
+        return
+    app_dirs.private_dir(METRICS_DIR)
+    path = os.path.join(METRICS_DIR, _file_name(os.getpid()))
+    with open(path + ".tmp", 'w') as file:
+        json.dump(snapshot, file)
+    os.replace(path + ".tmp", path)
+
+atexit.register(flush)
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# True if the process that wrote the file is still running. Without /proc (start
+# time 0) a reused pid cannot be told apart.
+def _writer_alive(name):
+    pid, _, start = name[:-len(".json")].partition("-")
+    if not start or start == "0":
+        return _process_alive(int(pid))
+    return _process_start(pid) == start
+
+def _process_files():
+    try:
+        names = sorted(os.listdir(METRICS_DIR))
+    except FileNotFoundError:
+        return []
+    return [name for name in names if name.endswith(".json") and name != ARCHIVE_NAME]
+
+def _read_json(name):
+    try:
+        with open(os.path.join(METRICS_DIR, name)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+# Adds a process snapshot to merged, {name: definition with "samples": {key: value}}.
+def _merge(merged, snapshot, gauges=True):
+    for metric_name, metric in snapshot.items():
+        if metric["kind"] == "gauge" and not gauges:
+            continue
+        target = merged.setdefault(metric_name, dict(metric, samples={}))
+        # Files written before a deploy changed a definition are skipped.
+        if target["labels"] != metric["labels"] or target.get("buckets") != metric.get("buckets"):
+            continue
+        for key, value in metric["samples"]:
+            key = tuple(key)
+            if metric["kind"] == "histogram":
+                series = target["samples"].setdefault(key, {"buckets": [0] * len(metric["buckets"]), "sum": 0, "count": 0})
+                series["buckets"] = [a + b for a, b in zip(series["buckets"], value["buckets"])]
+                series["sum"] += value["sum"]
+                series["count"] += value["count"]
+            else:
+                target["samples"][key] = target["samples"].get(key, 0) + value
+
+# Folds the counters and histograms of exited processes into the archive and deletes
+# their files. The archive lists the files it already holds, in case a fold stopped
+# between writing it and deleting them.
+def _archive_exited():
+    exited = [name for name in _process_files() if not _writer_alive(name)]
+    if not exited:
+        return
+    with open(os.path.join(METRICS_DIR, ".archive.lock"), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        archive = _read_json(ARCHIVE_NAME) or {"metrics": {}, "folded": []}
+        merged = {}
+        folded = [name for name in archive["folded"] if os.path.exists(os.path.join(METRICS_DIR, name))]
+        for name in exited:
+            if name in folded:
+                continue
+            snapshot = _read_json(name)
+            if snapshot is None:
+                continue
+            _merge(merged, snapshot, gauges=False)
+            folded.append(name)
+        # After the exited processes, so their definitions win over older archived ones.
+        _merge(merged, archive["metrics"])
+        archive = {
+            "metrics": dict((metric_name, dict(metric, samples=[[list(key), value] for key, value in metric["samples"].items()]))
+                for metric_name, metric in merged.items()),
+            "folded": folded
+        }
+        path = os.path.join(METRICS_DIR, ARCHIVE_NAME)
+        with open(path + ".tmp", 'w') as file:
+            json.dump(archive, file)
+        os.replace(path + ".tmp", path)
+        for name in folded:
+            try:
+                os.remove(os.path.join(METRICS_DIR, name))
+            except FileNotFoundError:
+                pass
+
+# Sums the metric files of every process and the archive into
+# {name: definition with "samples": {key: value}}.
+def collect():
+    app_dirs.private_dir(METRICS_DIR)
+    flush()
+    try:
+        _archive_exited()
+    except OSError:
+        logger.exception("Could not archive the metrics of exited processes")
+    merged = {}
+    for name in _process_files():
+        snapshot = _read_json(name)
+        if snapshot is not None:
+            _merge(merged, snapshot, gauges=_writer_alive(name))
+    archive = _read_json(ARCHIVE_NAME)
+    if archive is not None:
+        _merge(merged, archive["metrics"])
+    return merged
+
+def _format_value(value):
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(name, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for name, value in pairs) + "}"
+
+# The metrics of all processes in the Prometheus text exposition format.
+def render():
+    lines = []
+    for name, metric in sorted(collect().items()):
+        lines.append("# HELP {0} {1}".format(name, metric["help"]))
+        lines.append("# TYPE {0} {1}".format(name, metric["kind"]))
+        for key, value in sorted(metric["samples"].items()):
+            if metric["kind"] != "histogram":
+                lines.append("{0}{1} {2}".format(name, _format_labels(metric["labels"], key), _format_value(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(metric["buckets"], value["buckets"]):
+                cumulative += count
+                lines.append("{0}_bucket{1} {2}".format(name,
+                    _format_labels(metric["labels"], key, [("le", _format_value(float(bound)))]), cumulative))
+            lines.append("{0}_bucket{1} {2}".format(name, _format_labels(metric["labels"], key, [("le", "+Inf")]), value["count"]))
+            lines.append("{0}_sum{1} {2}".format(name, _format_labels(metric["labels"], key), _format_value(float(value["sum"]))))
+            lines.append("{0}_count{1} {2}".format(name, _format_labels(metric["labels"], key), value["count"]))
+    return "\n".join(lines) + "\n"
+
+
+# Build metrics, recorded by app.py, build_jobs, workspaces, deploy and profile_renderer.
+BUILD_STAGE_SECONDS = histogram("voicemake_build_stage_duration_seconds",
+    "Time spent in each stage of a site build", ["stage"])
+BUILD_SECONDS = histogram("voicemake_build_duration_seconds",
+    "Time to build and deploy a site", ["kind", "result"])
+BUILDS_IN_FLIGHT = gauge("voicemake_builds_in_flight", "Site builds currently running")
+BUILD_CACHE = counter("voicemake_build_cache_total",
+    "Builds whose hugo run and deploy were skipped (hit) or not (miss)", ["result"])
+BUILD_FILES_WRITTEN = counter("voicemake_build_files_written_total",
+    "Files written by a build step", ["step"])
+BUILD_BYTES_COPIED = counter("voicemake_build_bytes_copied_total",
+    "Bytes copied by a build step", ["step"])
+HUGO_RUNS = counter("voicemake_hugo_runs_total", "Hugo runs by exit status", ["exit_status"])
+
+# Request metrics, recorded by accounting.py.
+REQUEST_SECONDS = histogram("voicemake_request_duration_seconds",
+    "API request latency", ["endpoint", "method", "status"])
+REQUEST_DB_QUERIES = histogram("voicemake_request_db_queries",
+    "SQL statements run by one API request", ["endpoint"], buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100))
+REQUEST_DB_ROWS = counter("voicemake_request_db_rows_fetched_total", "Rows fetched by API requests", ["endpoint"])
+REQUEST_DB_CONNECTIONS = counter("voicemake_request_db_connections_opened_total",
+    "New MySQL connections opened while serving API requests", ["endpoint"])
+REQUEST_DEPENDENCY_SECONDS = counter("voicemake_request_dependency_seconds_total",
+    "Time API requests spent in MySQL, subprocesses and Twilio", ["endpoint", "dependency"])
+FLAGGED_REQUESTS = counter("voicemake_flagged_requests_total",
+    "Requests logged as slow, with many statements or with a repeated statement", ["endpoint", "reason"])
+DEPENDENCY_CALL_SECONDS = histogram("voicemake_dependency_call_duration_seconds",
+    "Duration of single MySQL statements, connects, subprocesses and Twilio calls", ["dependency"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
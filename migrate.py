@@ -0,0 +1,70 @@
+# Applies the versioned schema changes in db/migrations/ in order.
+#
+#   python migrate.py [--status]
+#
+# db/migrations.sql creates the base schema. Every later change is a numbered file
+# in db/migrations/ (0001_name.sql, 0002_name.sql, ...). Applied versions are
+# recorded in the schema_migration table, so running the command again only
+# applies the files this database has not seen yet.
+import os
+import sys
+import argparse
+
+import db_pool
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "db", "migrations")
+
+
+def list_migrations():
+    return sorted(name for name in os.listdir(MIGRATIONS_DIR) if name.endswith(".sql"))
+
+# Splits a migration file into statements, dropping "--" comment lines.
+def read_statements(path):
+    with open(path) as file:
+        lines = [line for line in file if not line.strip().startswith("--")]
+    return [statement.strip() for statement in "".join(lines).split(";") if statement.strip()]
+
+def applied_versions(db):
+    cursor = db.cursor()
+    cursor.execute("CREATE TABLE IF NOT EXISTS schema_migration (version VARCHAR(200) NOT NULL, \
+        applied_at datetime NOT NULL DEFAULT now(), PRIMARY KEY(version))")
+    cursor.execute("SELECT version FROM schema_migration")
+    versions = set(record[0] for record in cursor.fetchall())
+    cursor.close()
+    return versions
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply pending schema migrations")
+    parser.add_argument("--status", action="store_true", help="list the migrations and whether they are applied")
+    args = parser.parse_args()
+
+    db = db_pool._connect()
+    try:
+        applied = applied_versions(db)
+        pending = [name for name in list_migrations() if name not in applied]
+
+        if args.status:
+            for name in list_migrations():
+                print("{0} {1}".format("applied" if name in applied else "pending", name))
+            return
+
+        for name in pending:
+            print("Applying {0}".format(name))
+            cursor = db.cursor()
+            # MySQL commits DDL statements implicitly, so a failed file stops the run
+            # with its earlier statements applied. Fix the file or the schema and rerun.
+            for statement in read_statements(os.path.join(MIGRATIONS_DIR, name)):
+                try:
+                    cursor.execute(statement)
+                except Exception as e:
+                    print("Failed in {0}: {1}\n{2}".format(name, e, statement))
+                    sys.exit(1)
+            cursor.execute("INSERT INTO schema_migration (version) VALUES (%s)", (name,))
+            db.commit()
+            cursor.close()
+        print("{0} migrations applied, database is up to date".format(len(pending)))
+    finally:
+        db.close()
+
+if __name__ == '__main__':
+    main()
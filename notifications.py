@@ -0,0 +1,163 @@
+# Outbound SMS queue.
+#
+# send_sms() only puts the message on an in-process queue and returns. A small
+# pool of worker threads (SMS_WORKERS) sends the messages through one long-lived
+# transport client, retries failures with exponential backoff and spaces out
+# messages to the same number by at least SMS_MIN_INTERVAL_PER_NUMBER seconds.
+#
+# SMS_TRANSPORT=fake swaps Twilio for an in-memory transport that records the
+# messages, so the whole path can be load-tested without network access.
+import os
+import time
+import heapq
+import random
+import itertools
+import threading
+import logging
+
+from decouple import config
+
+import accounting
+
+logger = logging.getLogger()
+
+WORKER_COUNT = config('SMS_WORKERS', default=2, cast=int)
+MAX_ATTEMPTS = config('SMS_MAX_ATTEMPTS', default=5, cast=int)
+RETRY_BASE_DELAY = config('SMS_RETRY_BASE_DELAY', default=1, cast=float)
+MIN_INTERVAL_PER_NUMBER = config('SMS_MIN_INTERVAL_PER_NUMBER', default=1, cast=float)
+MAX_QUEUED = config('SMS_QUEUE_MAX', default=10000, cast=int)
+
+
+class TwilioTransport(object):
+    def __init__(self):
+        from twilio.rest import Client
+        self.client = Client(config('TWILIO_ACCOUNT_SID'), config('TWILIO_AUTH_TOKEN'))
+        self.from_phone = config('TWILIO_FROM_PHONE')
+
+    def send(self, to, body):
+        with accounting.track("twilio"):
+            message = self.client.messages.create(body=body, from_=self.from_phone, to=to)
+        return message.sid
+
+
+class FakeTransport(object):
+    def __init__(self, latency=0, failure_rate=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send(self, to, body):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise Exception("Fake transport failure")
+        with self._lock:
+            self.sent.append((to, body))
+            return "fake-{0}".format(len(self.sent))
+
+
+def _create_transport():
+    if config('SMS_TRANSPORT', default='twilio') == 'fake':
+        return FakeTransport(latency=config('SMS_FAKE_LATENCY', default=0, cast=float),
+            failure_rate=config('SMS_FAKE_FAILURE_RATE', default=0, cast=float))
+    return TwilioTransport()
+
+
+class SmsQueue(object):
+    def __init__(self, transport_factory=_create_transport, workers=WORKER_COUNT):
+        self.transport_factory = transport_factory
+        self.worker_count = workers
+        self.transport = None
+        self._scheduled = []
+        self._sequence = itertools.count()
+        self._last_sent = {}
+        self._condition = threading.Condition()
+        self._pid = None
+        self._counters = {"queued": 0, "sent": 0, "retried": 0, "failed": 0, "throttled": 0, "dropped": 0}
+
+    # Starts the transport and worker threads in this process. Threads do not survive
+    # a fork, so uwsgi workers each start their own on first use.
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._condition:
+            if self._pid == os.getpid():
+                return
+            self.transport = self.transport_factory()
+            self._scheduled = []
+            for i in range(self.worker_count):
+                threading.Thread(target=self._worker_loop, name="sms-worker-{0}".format(i), daemon=True).start()
+            self._pid = os.getpid()
+
+    def send(self, to, body):
+        self._ensure_started()
+        with self._condition:
+            if len(self._scheduled) >= MAX_QUEUED:
+                self._counters["dropped"] += 1
+                logger.error("SMS queue is full, dropping message to {0}".format(to))
+                return False
+            self._schedule(time.monotonic(), {"to": to, "body": body, "attempts": 0})
+            self._counters["queued"] += 1
+        return True
+
+    # Callers hold self._condition.
+    def _schedule(self, due, message):
+        heapq.heappush(self._scheduled, (due, next(self._sequence), message))
+        self._condition.notify()
+
+    def _next_message(self):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if self._scheduled and self._scheduled[0][0] <= now:
+                    message = heapq.heappop(self._scheduled)[2]
+                    # Hold messages to a number that was just sent to.
+                    ready_at = self._last_sent.get(message["to"], 0) + MIN_INTERVAL_PER_NUMBER
+                    if ready_at > now:
+                        self._counters["throttled"] += 1
+                        self._schedule(ready_at, message)
+                        continue
+                    if len(self._last_sent) > 10000:
+                        self._last_sent = dict((to, sent) for to, sent in self._last_sent.items()
+                            if sent + MIN_INTERVAL_PER_NUMBER > now)
+                    self._last_sent[message["to"]] = now
+                    return message
+                timeout = self._scheduled[0][0] - now if self._scheduled else None
+                self._condition.wait(timeout)
+
+    def _worker_loop(self):
+        while True:
+            message = self._next_message()
+            message["attempts"] += 1
+            try:
+                sid = self.transport.send(message["to"], message["body"])
+                logger.info("Sent SMS {0} to {1}".format(sid, message["to"]))
+                with self._condition:
+                    self._counters["sent"] += 1
+            except Exception as e:
+                with self._condition:
+                    if message["attempts"] < MAX_ATTEMPTS:
+                        delay = RETRY_BASE_DELAY * 2 ** (message["attempts"] - 1)
+                        logger.warning("Sending SMS to {0} failed ({1}), retrying in {2}s".format(message["to"], e, delay))
+                        self._counters["retried"] += 1
+                        self._schedule(time.monotonic() + delay, message)
+                    else:
+                        logger.error("Giving up sending SMS to {0} after {1} attempts: {2}".format(
+                            message["to"], message["attempts"], e))
+                        self._counters["failed"] += 1
+
+    def stats(self):
+        with self._condition:
+            output = dict(self._counters)
+            output["pending"] = len(self._scheduled)
+        return output
+
+
+sms_queue = SmsQueue()
+
+def send_sms(to, body):
+    return sms_queue.send(to, body)
+
+def stats():
+    return sms_queue.stats()
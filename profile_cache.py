@@ -0,0 +1,143 @@
+# Read-through cache for the per-user profile data read by app.py.
+#
+# Entries are keyed by "<namespace>:<user_id>" and every write helper calls
+# invalidate(user_id), which drops all namespaces for that user. Values are
+# stored as JSON so callers always get their own copy (the build helpers modify
+# the profile dict they are given).
+#
+# PROFILE_CACHE_BACKEND selects where entries live:
+#   local - an in-process TTL/LRU cache. Each uwsgi worker has its own copy, so a
+#           write in one worker is only seen by the others once their entry expires.
+#   redis - a shared Redis cache (needs the redis package and PROFILE_CACHE_REDIS_URL),
+#           so an invalidation is seen by every worker at once.
+#   none  - no caching.
+import json
+import time
+import threading
+import functools
+from collections import OrderedDict
+
+from decouple import config
+
+NAMESPACES = ("directory", "blog_posts", "full_profile")
+
+
+class LocalBackend(object):
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def size(self):
+        return len(self._entries)
+
+
+class RedisBackend(object):
+    def __init__(self, url, ttl):
+        import redis
+        self.ttl = ttl
+        self.evictions = 0
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self.client.get("profile-cache:" + key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value):
+        self.client.set("profile-cache:" + key, value, ex=int(self.ttl))
+
+    def delete(self, keys):
+        self.client.delete(*["profile-cache:" + key for key in keys])
+
+    def size(self):
+        return None
+
+
+class ProfileCache(object):
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    # Returns the cached value or calls loader() and caches its result.
+    # None results are not cached, so a missing row is always looked up again.
+    def get_or_load(self, namespace, user_id, loader):
+        if self.backend is None:
+            return loader()
+        key = "{0}:{1}".format(namespace, user_id)
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return json.loads(value)
+        self.misses += 1
+        result = loader()
+        if result is not None:
+            self.backend.set(key, json.dumps(result))
+        return result
+
+    def invalidate(self, user_id):
+        if self.backend is not None:
+            self.backend.delete(["{0}:{1}".format(namespace, user_id) for namespace in NAMESPACES])
+
+    def stats(self):
+        return {
+            "backend": type(self.backend).__name__ if self.backend else None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.backend.evictions if self.backend else 0,
+            "entries": self.backend.size() if self.backend else 0
+        }
+
+
+def _create_cache():
+    backend_name = config('PROFILE_CACHE_BACKEND', default='local')
+    ttl = config('PROFILE_CACHE_TTL', default=30, cast=float)
+    if backend_name == 'redis':
+        return ProfileCache(RedisBackend(config('PROFILE_CACHE_REDIS_URL'), ttl))
+    if backend_name == 'local':
+        return ProfileCache(LocalBackend(ttl, config('PROFILE_CACHE_MAX_ENTRIES', default=1000, cast=int)))
+    return ProfileCache(None)
+
+cache = _create_cache()
+
+# Decorator for helpers that take user_id as their first argument.
+def cached(namespace):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(user_id, *args, **kwargs):
+            return cache.get_or_load(namespace, user_id, lambda: function(user_id, *args, **kwargs))
+        return wrapper
+    return decorator
+
+def invalidate(user_id):
+    cache.invalidate(user_id)
+
+def stats():
+    return cache.stats()
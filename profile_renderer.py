@@ -0,0 +1,362 @@
+# In-process renderer for profile-only sites.
+#
+# Between users a profile site only differs in the handful of values app.py writes
+# into config.toml, aboutinfo.yml and skillsinfo.yml. Once per template version the
+# theme is built with hugo from a profile of marker values, and the output is kept
+# as static files plus templates with a slot wherever a marker (or its title, upper
+# or lower case form) ended up. Rendering a profile then writes those files
+# straight into the build directory, with no workspace sync and no hugo process.
+#
+# The compiled renderer is only used if it reproduces hugo's output byte for byte for
+# every profile in FIXTURES. Otherwise it is disabled for that template version and
+# profile builds keep using hugo. Profiles with values outside SAFE_VALUE, which hugo
+# might escape or typeset, or longer than any fixture value, always use hugo.
+#
+# Compiled renderers are shared by the processes through PROFILE_RENDERER_DIR and
+# stored as JSON. A renderer directory is only read if it belongs to the app user
+# and nobody else can write to it.
+#
+#   python profile_renderer.py verify    # compile for LOCAL_TEMPLATE_HOME and report
+import os
+import re
+import sys
+import json
+import base64
+import hashlib
+import shutil
+import tempfile
+import threading
+import logging
+
+from decouple import config
+
+import app_dirs
+import metrics
+import workspaces
+
+logger = logging.getLogger()
+
+ENABLED = config('PROFILE_FAST_RENDER', default=True, cast=bool)
+
+SLOTS = ("directory_id", "first_name", "last_name", "email", "description", "profession", "current_employer",
+    "skill_0", "skill_1", "skill_2")
+TRANSFORMS = {
+    "": lambda value: value,
+    "title": str.title,
+    "upper": str.upper,
+    "lower": str.lower,
+}
+
+# Words of letters or of digits, separated by a space (optionally after a comma or
+# period) or a hyphen, so neither HTML escaping nor markdown typesetting changes them.
+_WORD = r"(?:[^\W\d_]+|\d+)"
+SAFE_VALUE = re.compile(r"^{0}(?:(?:[.,]? |-){0})*\.?$".format(_WORD))
+SAFE_EMAIL = re.compile(r"^[A-Za-z0-9.+-]+@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)+$")
+
+# Column sizes from db/migrations.sql. Hugo's output is only verified for values up to
+# the longest fixture value of each slot, so the last fixture fills every column.
+COLUMN_LENGTHS = {"directory_id": 100, "first_name": 100, "last_name": 100, "email": 200, "description": 500,
+    "profession": 100, "current_employer": 200, "skill": 200}
+
+# Repeats text up to length characters, ending on a letter so it stays within SAFE_VALUE.
+def _long_value(text, length):
+    value = (text * (length // len(text) + 1))[:length].rstrip(" ,.-")
+    return value + "x" * (length - len(value))
+
+FIXTURES = [
+    {"directory_id": "jane-doe", "first_name": "jane", "last_name": "doe", "email": "jane@example.com",
+        "description": "I build web apps, APIs and data pipelines.", "profession": "Software Engineer",
+        "current_employer": "Example Labs", "top_skills": ["Python", "Machine Learning", "SQL"]},
+    {"directory_id": "mary-ann-smith-2", "first_name": "mary-ann", "last_name": "smith", "email": "mary.ann+site@example.org",
+        "description": "Teacher", "profession": "Teacher", "current_employer": "Lincoln High",
+        "top_skills": ["Algebra", "Public Speaking", "Chess"]},
+    {"directory_id": "jose-nunez", "first_name": "josé", "last_name": "núñez", "email": "jose@example.es",
+        "description": "Diseño y desarrollo web, desde 2010.", "profession": "Diseñador", "current_employer": "Estudio 42",
+        "top_skills": ["Figma", "CSS", "Go"]},
+    {"directory_id": _long_value("long-directory-id-", COLUMN_LENGTHS["directory_id"]),
+        "first_name": _long_value("Maximiliana ", COLUMN_LENGTHS["first_name"]),
+        "last_name": _long_value("von-Lengthen ", COLUMN_LENGTHS["last_name"]),
+        "email": _long_value("long.address", COLUMN_LENGTHS["email"] - len("@example.com")) + "@example.com",
+        "description": _long_value("I build web apps, APIs and data pipelines. Since 2010, mostly in Python. ",
+            COLUMN_LENGTHS["description"]),
+        "profession": _long_value("Senior Software Engineer ", COLUMN_LENGTHS["profession"]),
+        "current_employer": _long_value("Example Labs and Partners ", COLUMN_LENGTHS["current_employer"]),
+        "top_skills": [_long_value(skill, COLUMN_LENGTHS["skill"]) for skill in ("Machine Learning ", "Data-Engineering ", "SQL ")]},
+]
+
+_renderers = {}
+_lock = threading.Lock()
+
+
+def _marker(index):
+    return "Zqvm" + chr(ord("A") + index) + "kqZ"
+
+def _marker_profile():
+    values = dict((slot, _marker(index)) for index, slot in enumerate(SLOTS))
+    return _profile_from_values(values)
+
+def _profile_from_values(values):
+    return {
+        "user_id": "profile-renderer",
+        "directory_id": values["directory_id"],
+        "first_name": values["first_name"],
+        "last_name": values["last_name"],
+        "email": values["email"],
+        "description": values["description"],
+        "profession": values["profession"],
+        "current_employer": values["current_employer"],
+        "profile_pic": None,
+        "top_skills": [values["skill_0"], values["skill_1"], values["skill_2"]]
+    }
+
+def _slot_values(user_profile, skills):
+    values = dict((slot, user_profile.get(slot)) for slot in SLOTS[:7])
+    values.update(skill_0=skills[0], skill_1=skills[1], skill_2=skills[2])
+    return values
+
+# Returns the slot values of a profile, or None if it has to be built with hugo.
+def profile_values(user_profile):
+    skills = user_profile.get("top_skills") or []
+    if user_profile.get("profile_pic") or len(skills) < 3:
+        return None
+    values = _slot_values(user_profile, skills)
+    for slot, value in values.items():
+        pattern = SAFE_EMAIL if slot == "email" else SAFE_VALUE
+        if not isinstance(value, str) or not pattern.match(value) or len(value) > _VERIFIED_LENGTHS[slot]:
+            return None
+    return values
+
+# Longer values might be truncated or wrapped by the theme, those profiles use hugo.
+_VERIFIED_LENGTHS = dict((slot, max(len(_slot_values(fixture, fixture["top_skills"])[slot]) for fixture in FIXTURES))
+    for slot in SLOTS)
+
+
+class ProfileRenderer(object):
+    # static_dir holds the output files that are the same for every profile,
+    # templates maps the other output paths to a list of bytes and (slot, transform) parts.
+    def __init__(self, static_dir, templates):
+        self.static_dir = static_dir
+        self.templates = templates
+
+    def render(self, values, build_dir):
+        if os.path.isdir(build_dir):
+            shutil.rmtree(build_dir)
+        for root, dirs, files in os.walk(self.static_dir):
+            target_root = os.path.normpath(os.path.join(build_dir, os.path.relpath(root, self.static_dir)))
+            os.makedirs(target_root, exist_ok=True)
+            for name in files:
+                try:
+                    os.link(os.path.join(root, name), os.path.join(target_root, name))
+                except OSError:
+                    shutil.copy2(os.path.join(root, name), os.path.join(target_root, name))
+                    metrics.BUILD_BYTES_COPIED.inc(os.path.getsize(os.path.join(target_root, name)), step="render")
+        metrics.BUILD_FILES_WRITTEN.inc(len(self.templates), step="render")
+        for relative_path, parts in self.templates.items():
+            file_path = os.path.join(build_dir, relative_path)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, 'wb') as file:
+                file.write(b"".join(part if isinstance(part, bytes)
+                    else TRANSFORMS[part[1]](values[part[0]]).encode('utf-8') for part in parts))
+
+
+# Turns the hugo output of the marker profile in output_dir into templates and moves
+# what is left into static_dir. Returns the templates, or None if a marker shows up
+# in a form no slot can reproduce.
+def _extract_templates(output_dir, static_dir):
+    variants = {}
+    for index, slot in enumerate(SLOTS):
+        for name, transform in TRANSFORMS.items():
+            variants[transform(_marker(index)).encode('utf-8')] = (slot, name)
+    pattern = re.compile(b"|".join(re.escape(variant) for variant in variants))
+
+    templates = {}
+    for root, dirs, files in os.walk(output_dir):
+        for name in files:
+            file_path = os.path.join(root, name)
+            with open(file_path, 'rb') as file:
+                content = file.read()
+            parts = []
+            position = 0
+            for match in pattern.finditer(content):
+                parts.append(content[position:match.start()])
+                parts.append(variants[match.group(0)])
+                position = match.end()
+            parts.append(content[position:])
+            if any(b"zqvm" in part.lower() for part in parts if isinstance(part, bytes)):
+                logger.warning('Profile renderer: a profile value is transformed in {0}'.format(file_path))
+                return None
+            if len(parts) > 1:
+                templates[os.path.relpath(file_path, output_dir)] = [part for part in parts if part != b""]
+                os.remove(file_path)
+    shutil.copytree(output_dir, static_dir, symlinks=True)
+    return templates
+
+# Returns the first difference between two directory trees, or None if they are identical.
+def _compare_trees(expected_dir, actual_dir):
+    def listing(top):
+        return sorted(os.path.relpath(os.path.join(root, name), top)
+            for root, dirs, files in os.walk(top) for name in files)
+    expected_files = listing(expected_dir)
+    actual_files = listing(actual_dir)
+    if expected_files != actual_files:
+        return "file list differs: {0}".format(sorted(set(expected_files) ^ set(actual_files))[:5])
+    for relative_path in expected_files:
+        with open(os.path.join(expected_dir, relative_path), 'rb') as expected:
+            with open(os.path.join(actual_dir, relative_path), 'rb') as actual:
+                if expected.read() != actual.read():
+                    return "{0} differs".format(relative_path)
+    return None
+
+# Builds the marker profile and the fixtures with hugo into a scratch directory and,
+# if the fixtures render identically, moves the compiled renderer to target_dir.
+def _compile(template_home, target_dir, generate_source, run_hugo):
+    work_dir = tempfile.mkdtemp(prefix=workspaces.RENDERER_PREFIX, dir=workspaces.RENDERER_ROOT)
+    try:
+        source_dir = os.path.join(work_dir, "source")
+        shutil.copytree(template_home, source_dir, symlinks=True)
+        generate_source(_marker_profile(), source_dir)
+        run_hugo(source_dir, os.path.join(work_dir, "output"))
+
+        compiled_dir = os.path.join(work_dir, "compiled")
+        os.makedirs(compiled_dir, mode=0o700)
+        templates = _extract_templates(os.path.join(work_dir, "output"), os.path.join(compiled_dir, "static"))
+        problem = "a profile value is transformed by the theme" if templates is None else None
+
+        if problem is None:
+            renderer = ProfileRenderer(os.path.join(compiled_dir, "static"), templates)
+            for fixture in FIXTURES:
+                generate_source(dict(fixture, profile_pic=None), source_dir)
+                run_hugo(source_dir, os.path.join(work_dir, "expected"))
+                renderer.render(profile_values(fixture), os.path.join(work_dir, "actual"))
+                difference = _compare_trees(os.path.join(work_dir, "expected"), os.path.join(work_dir, "actual"))
+                if difference:
+                    problem = "fixture {0}: {1}".format(fixture["directory_id"], difference)
+                    break
+
+        if problem is None:
+            with open(os.path.join(compiled_dir, "templates.json"), 'w') as file:
+                json.dump(_dump_templates(templates), file)
+            logger.info('Profile renderer compiled: {0} templated files'.format(len(templates)))
+        else:
+            shutil.rmtree(compiled_dir)
+            os.makedirs(compiled_dir, mode=0o700)
+            with open(os.path.join(compiled_dir, "disabled"), 'w') as file:
+                file.write(problem)
+            logger.warning('Profile renderer disabled for {0}: {1}'.format(template_home, problem))
+        os.rename(compiled_dir, target_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+# Templates as JSON: literal parts base64 encoded, slots by name and transform.
+def _dump_templates(templates):
+    return dict((relative_path, [{"bytes": base64.b64encode(part).decode('ascii')} if isinstance(part, bytes)
+        else {"slot": part[0], "transform": part[1]} for part in parts]) for relative_path, parts in templates.items())
+
+def _parse_templates(data):
+    templates = {}
+    for relative_path, parts in data.items():
+        if os.path.isabs(relative_path) or ".." in relative_path.split(os.sep):
+            raise ValueError("template path outside the site: {0}".format(relative_path))
+        templates[relative_path] = []
+        for part in parts:
+            if "bytes" in part:
+                templates[relative_path].append(base64.b64decode(part["bytes"], validate=True))
+            elif part.get("slot") in SLOTS and part.get("transform") in TRANSFORMS:
+                templates[relative_path].append((part["slot"], part["transform"]))
+            else:
+                raise ValueError("unknown template part in {0}".format(relative_path))
+    return templates
+
+# Returns (found, renderer). A renderer disabled for this template version, or one
+# that cannot be trusted, is (True, None).
+def _load(target_dir):
+    try:
+        if not app_dirs.owned(target_dir):
+            logger.warning('Profile renderer {0} is not owned by the app user, using hugo'.format(target_dir))
+            return True, None
+        if os.path.exists(os.path.join(target_dir, "disabled")):
+            return True, None
+        templates_path = os.path.join(target_dir, "templates.json")
+        if not app_dirs.owned(templates_path):
+            logger.warning('Profile renderer {0} is not owned by the app user, using hugo'.format(templates_path))
+            return True, None
+        with open(templates_path, 'r') as file:
+            return True, ProfileRenderer(os.path.join(target_dir, "static"), _parse_templates(json.load(file)))
+    except ValueError as exception:
+        logger.warning('Profile renderer {0} is unreadable, using hugo: {1}'.format(target_dir, exception))
+        return True, None
+    except OSError:
+        return False, None
+
+# Creates PROFILE_RENDERER_DIR for the app user only. Returns False if it exists
+# but someone else could have put files in it.
+def _prepare_root():
+    try:
+        app_dirs.private_dir(workspaces.RENDERER_ROOT)
+    except PermissionError as exception:
+        logger.warning('{0}, profiles use hugo'.format(exception))
+        return False
+    return True
+
+# Identifies everything the compiled output depends on: the template, the hugo binary
+# and the module that generates the source files.
+def _renderer_version(template_home, generate_source):
+    inputs = [workspaces.template_version(template_home)]
+    for path in (config('HUGO_BIN', default='/usr/local/bin/hugo'), sys.modules[generate_source.__module__].__file__):
+        try:
+            stat = os.stat(path)
+            inputs.append("{0}:{1}:{2}".format(path, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            inputs.append(path)
+    return hashlib.sha1("\n".join(inputs).encode('utf-8')).hexdigest()[:12]
+
+# The renderer for the current template, compiled on first use and shared with the other
+# processes through PROFILE_RENDERER_DIR. Returns None if profiles must be built with hugo.
+def get_renderer(template_home, generate_source, run_hugo):
+    version = _renderer_version(template_home, generate_source)
+    with _lock:
+        # The workspace sweeper may have removed an old renderer this process still had.
+        if version in _renderers and (_renderers[version] is None or os.path.isdir(_renderers[version].static_dir)):
+            return _renderers[version]
+        if not _prepare_root():
+            _renderers[version] = None
+            return None
+        target_dir = os.path.join(workspaces.RENDERER_ROOT, workspaces.RENDERER_PREFIX + version)
+        found, renderer = _load(target_dir)
+        if not found:
+            with workspaces.site_lock(workspaces.RENDERER_PREFIX + version, root=workspaces.RENDERER_ROOT):
+                found, renderer = _load(target_dir)
+                if not found:
+                    try:
+                        _compile(template_home, target_dir, generate_source, run_hugo)
+                    except Exception:
+                        logger.exception('Could not compile the profile renderer, using hugo')
+                        _renderers[version] = None
+                        return None
+                    found, renderer = _load(target_dir)
+        _renderers[version] = renderer
+        return renderer
+
+# Renders a profile-only site into build_dir. Returns False if it has to be built with hugo.
+def render_profile(user_profile, build_dir, template_home, generate_source, run_hugo):
+    if not ENABLED:
+        return False
+    values = profile_values(user_profile)
+    if values is None:
+        return False
+    renderer = get_renderer(template_home, generate_source, run_hugo)
+    if renderer is None:
+        return False
+    renderer.render(values, build_dir)
+    return True
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ["verify"]:
+        print("Usage: python profile_renderer.py verify")
+        sys.exit(2)
+    import app
+    renderer = get_renderer(config('LOCAL_TEMPLATE_HOME'), app.generate_profile_source, app.build_hugo)
+    if renderer is None:
+        print("Profile renderer is disabled for this template, profile builds use hugo")
+        sys.exit(1)
+    print("Profile renderer matches hugo on {0} fixtures ({1} templated files)".format(len(FIXTURES), len(renderer.templates)))
@@ -0,0 +1,228 @@
+# On-demand sampling profiler and allocation snapshots for a live uwsgi worker.
+#
+# POST /debug/profile starts a session in the worker that answers it, for the next
+# `requests` requests that worker serves or for `seconds` seconds. A sampler thread
+# reads the stacks of the profiled threads every PROFILER_INTERVAL_MS with
+# sys._current_frames(), so no tracing hook slows the handlers down. With `requests`
+# only the threads serving those requests are sampled. With `seconds` every thread
+# is, build and SMS workers included. The stacks are written in the folded format
+# read by flamegraph.pl, speedscope and inferno to PROFILER_DIR.
+#
+# POST /debug/tracemalloc starts tracemalloc in the worker. GET then lists the source
+# lines holding the most allocated memory, and what grew since the previous GET.
+# DELETE stops it.
+#
+# Both endpoints are off unless PROFILER_SECRET is set, and every call must carry an
+# HMAC of its timestamp, method and path made with that secret:
+#
+#   python profiler.py sign POST /debug/profile
+import os
+import sys
+import hmac
+import time
+import hashlib
+import datetime
+import threading
+import tracemalloc
+import collections
+import logging
+
+from decouple import config
+from flask import request
+
+logger = logging.getLogger()
+
+SECRET = config('PROFILER_SECRET', default='')
+PROFILE_DIR = config('PROFILER_DIR', default='/tmp/voicemake-profiles')
+INTERVAL = config('PROFILER_INTERVAL_MS', default=5, cast=float) / 1000
+# Upper bound for any session, so a request count that is never reached does not sample forever.
+MAX_SECONDS = config('PROFILER_MAX_SECONDS', default=300, cast=float)
+# Signed headers older than this are refused.
+SIGNATURE_MAX_AGE = 300
+
+_session = None
+_last_session = None
+_lock = threading.Lock()
+_frame_names = {}
+_last_snapshot = None
+
+
+def sign(method, path, timestamp):
+    message = "{0}\n{1}\n{2}".format(timestamp, method.upper(), path).encode('utf-8')
+    return hmac.new(SECRET.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+def authorized():
+    if not SECRET:
+        return False
+    try:
+        timestamp = int(request.headers.get("X-Profiler-Timestamp", ""))
+    except ValueError:
+        return False
+    if abs(time.time() - timestamp) > SIGNATURE_MAX_AGE:
+        return False
+    return hmac.compare_digest(sign(request.method, request.path, timestamp),
+        request.headers.get("X-Profiler-Signature", ""))
+
+
+class Session(object):
+    def __init__(self, requests=None, seconds=None):
+        self.requests_left = requests
+        self.started_at = time.time()
+        self.deadline = time.monotonic() + min(seconds or MAX_SECONDS, MAX_SECONDS)
+        # Threads serving a profiled request, by ident, with the root frame name to use.
+        self.threads = {}
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.path = None
+        self.stopping = threading.Event()
+
+    def info(self):
+        return {
+            "pid": os.getpid(),
+            "mode": "seconds" if self.requests_left is None else "requests",
+            "requests_left": self.requests_left,
+            "started_at": datetime.datetime.fromtimestamp(self.started_at).isoformat(),
+            "samples": self.samples,
+            "distinct_stacks": len(self.stacks),
+            "path": self.path
+        }
+
+# "function (file:first line)", cached per code object.
+def _frame_name(code):
+    name = _frame_names.get(code)
+    if name is None:
+        name = "{0} ({1}:{2})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno).replace(";", ",")
+        _frame_names[code] = name
+    return name
+
+def _fold(root, frame):
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    names.append(root)
+    return ";".join(reversed(names))
+
+def _sample(session):
+    sampler = threading.get_ident()
+    while not session.stopping.wait(INTERVAL) and time.monotonic() < session.deadline:
+        frames = sys._current_frames()
+        with _lock:
+            if session.requests_left is None:
+                roots = dict((thread.ident, thread.name) for thread in threading.enumerate() if thread.ident != sampler)
+            else:
+                roots = dict(session.threads)
+        for ident, root in roots.items():
+            frame = frames.get(ident)
+            if frame is not None:
+                session.stacks[_fold(root, frame)] += 1
+        session.samples += 1
+    _finish(session)
+
+def _finish(session):
+    global _session, _last_session
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, "profile-{0}-{1}.folded".format(os.getpid(),
+        datetime.datetime.fromtimestamp(session.started_at).strftime("%Y%m%d-%H%M%S-%f")))
+    with open(path, 'w') as file:
+        for stack, count in session.stacks.most_common():
+            file.write("{0} {1}\n".format(stack, count))
+    session.path = path
+    with _lock:
+        if _session is session:
+            _session = None
+        _last_session = session
+    logger.info("Profile of {0} samples written to {1}".format(session.samples, path))
+
+# Starts a session in this process. Returns None if one is already running.
+def start(requests=None, seconds=None):
+    global _session
+    with _lock:
+        if _session is not None:
+            return None
+        _session = Session(requests, seconds)
+        session = _session
+    threading.Thread(target=_sample, args=(session,), name="profiler", daemon=True).start()
+    return session.info()
+
+def stop():
+    session = _session
+    if session is not None:
+        session.stopping.set()
+
+def status():
+    session = _session or _last_session
+    return session.info() if session else None
+
+# Registered with app.before_request. Claims one of the requests a session is waiting for.
+def start_request():
+    if _session is None:
+        return
+    with _lock:
+        session = _session
+        if session is None or not session.requests_left:
+            return
+        session.requests_left -= 1
+        session.threads[threading.get_ident()] = "{0} {1}".format(request.method, request.endpoint or request.path)
+
+# Registered with app.teardown_request. Ends the session after its last request.
+def finish_request(exception=None):
+    if _session is None:
+        return
+    with _lock:
+        session = _session
+        if session is None or session.threads.pop(threading.get_ident(), None) is None:
+            return
+        done = session.requests_left == 0 and not session.threads
+    if done:
+        session.stopping.set()
+
+
+def start_tracemalloc(frames=1):
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+def stop_tracemalloc():
+    global _last_snapshot
+    tracemalloc.stop()
+    _last_snapshot = None
+
+def _statistic(stat, size, count):
+    frame = stat.traceback[0]
+    return {"file": frame.filename, "line": frame.lineno, "size_kb": round(size / 1024, 1), "count": count}
+
+# Top source lines by allocated memory, and by growth since the previous report.
+# Returns None if tracemalloc is not running.
+def allocation_report(limit=20):
+    global _last_snapshot
+    if not tracemalloc.is_tracing():
+        return None
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+    report = {
+        "pid": os.getpid(),
+        "traced_kb": round(current / 1024, 1),
+        "peak_kb": round(peak / 1024, 1),
+        "top": [_statistic(stat, stat.size, stat.count) for stat in snapshot.statistics("lineno")[:limit]],
+        "growth": None
+    }
+    if _last_snapshot is not None:
+        report["growth"] = [_statistic(stat, stat.size_diff, stat.count_diff)
+            for stat in snapshot.compare_to(_last_snapshot, "lineno")[:limit] if stat.size_diff > 0]
+    _last_snapshot = snapshot
+    return report
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] != "sign":
+        print("Usage: python profiler.py sign METHOD PATH")
+        sys.exit(2)
+    if not SECRET:
+        print("PROFILER_SECRET is not set")
+        sys.exit(1)
+    timestamp = int(time.time())
+    print("X-Profiler-Timestamp: {0}".format(timestamp))
+    print("X-Profiler-Signature: {0}".format(sign(sys.argv[2], sys.argv[3], timestamp)))
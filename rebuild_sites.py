@@ -0,0 +1,100 @@
+# Rebuilds every user's site, e.g. after the theme under LOCAL_TEMPLATE_HOME changed.
+#
+#   python rebuild_sites.py [--processes 4] [--max-write-mb-per-sec 50] [--force]
+#
+# Profiles, skills and posts are loaded in bulk and the builds run in a bounded
+# process pool. Sites already built from the current template version are
+# skipped, so running the command again after a failure or an interruption
+# resumes with the sites that are left.
+import sys
+import time
+import argparse
+import logging
+import multiprocessing
+
+from decouple import config
+
+import app
+import deploy
+import metrics
+import workspaces
+
+
+# Runs in a pool process. Sleeps after the build so this process writes at most its
+# share of the --max-write-mb-per-sec budget. Only the bytes the build copied count,
+# files hard-linked from the previous release or the shared asset store are free.
+def _rebuild_site(task):
+    user_profile, blog_posts, max_bytes_per_sec = task
+    directory_id = user_profile["directory_id"]
+    copied_before = metrics.BUILD_BYTES_COPIED.total()
+    started = time.monotonic()
+    try:
+        app.buildSite(user_profile, blog_posts)
+    except Exception as e:
+        return directory_id, "failed", str(e), time.monotonic() - started
+    elapsed = time.monotonic() - started
+
+    if max_bytes_per_sec:
+        minimum_time = (metrics.BUILD_BYTES_COPIED.total() - copied_before) / max_bytes_per_sec
+        if minimum_time > elapsed:
+            time.sleep(minimum_time - elapsed)
+    return directory_id, "built", None, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild all user sites with the current template")
+    parser.add_argument("--processes", type=int, default=4, help="number of builds to run at once")
+    parser.add_argument("--max-write-mb-per-sec", type=float, default=0,
+        help="limit the rate at which built sites are written (0 for no limit)")
+    parser.add_argument("--force", action="store_true", help="rebuild sites already on the current template version")
+    args = parser.parse_args()
+    if args.processes < 1:
+        parser.error("--processes must be at least 1")
+
+    logging.getLogger().setLevel(logging.WARNING)
+    template_version = workspaces.template_version(config('LOCAL_TEMPLATE_HOME'))
+
+    sites = app.loadAllSitesForRebuild()
+    tasks = []
+    skipped = 0
+    # Each process gets an equal share of the write budget.
+    max_bytes_per_sec = args.max_write_mb_per_sec * 1024 * 1024 / args.processes
+    for user_profile, blog_posts in sites:
+        if not user_profile["top_skills"]:
+            print("skip {0}: missing top skills".format(user_profile["directory_id"]))
+            skipped += 1
+            continue
+        if not args.force and deploy.read_site_info(user_profile["directory_id"]).get("template_version") == template_version:
+            skipped += 1
+            continue
+        tasks.append((user_profile, blog_posts, max_bytes_per_sec))
+
+    print("Template version {0}: {1} sites, {2} to rebuild, {3} skipped".format(
+        template_version, len(sites), len(tasks), skipped))
+
+    failed = []
+    started = time.monotonic()
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        for done, (directory_id, status, error, elapsed) in enumerate(pool.imap_unordered(_rebuild_site, tasks), 1):
+            if status == "failed":
+                failed.append((directory_id, error))
+            rate = done / (time.monotonic() - started)
+            remaining = (len(tasks) - done) / rate if rate else 0
+            print("[{0}/{1}] {2} {3} in {4:.1f}s | {5:.2f} sites/s, ~{6:.0f}s left{7}".format(
+                done, len(tasks), status, directory_id, elapsed, rate, remaining,
+                ": " + error if error else ""))
+    finally:
+        pool.close()
+        pool.join()
+
+    total_time = time.monotonic() - started
+    print("Rebuilt {0} sites in {1:.1f}s ({2:.2f} sites/s), {3} failed".format(
+        len(tasks) - len(failed), total_time, len(tasks) / total_time if total_time else 0, len(failed)))
+    if failed:
+        print("Run the command again to retry the failed sites:")
+        for directory_id, error in failed:
+            print("  {0}: {1}".format(directory_id, error))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,392 @@
+# Persistent per-user Hugo source workspaces and transient build outputs.
+#
+# Each site keeps its source tree under WORKSPACE_ROOT between builds. Before a
+# build only the template files that changed since the last sync (by size or
+# mtime) are copied in, and workspaces that have been idle the longest are
+# evicted when everything under the roots goes over WORKSPACE_DISK_BUDGET_MB.
+#
+# Hugo writes a site's output to BUILD_ROOT (WORKSPACE_ROOT unless set, point it
+# at a tmpfs such as /dev/shm to keep build I/O in memory). The output is removed
+# once the build is deployed. A sweeper thread in each process (one at a time,
+# every WORKSPACE_SWEEP_INTERVAL seconds) removes build outputs and profile
+# renderer directories left behind by crashed builds, and the lock files of
+# sites and renderers that have no directory left, and enforces the budget.
+# Compiled profile renderers live under PROFILE_RENDERER_DIR, a directory only the
+# app user can write to.
+import os
+import json
+import time
+import fcntl
+import hashlib
+import shutil
+import threading
+import logging
+
+from decouple import config
+
+import app_dirs
+import metrics
+
+logger = logging.getLogger()
+
+WORKSPACE_ROOT = config('WORKSPACE_ROOT', default='/tmp')
+BUILD_ROOT = config('BUILD_ROOT', default='') or WORKSPACE_ROOT
+RENDERER_ROOT = config('PROFILE_RENDERER_DIR', default='') or app_dirs.cache_path("profile-renderer")
+DISK_BUDGET_MB = config('WORKSPACE_DISK_BUDGET_MB', default=2048, cast=int)
+SWEEP_INTERVAL = config('WORKSPACE_SWEEP_INTERVAL', default=600, cast=float)
+# How long a template scan is trusted before the template tree is walked again.
+TEMPLATE_RESCAN_INTERVAL = config('TEMPLATE_RESCAN_INTERVAL', default=60, cast=float)
+
+MANIFEST_NAME = ".workspace.json"
+SOURCE_SUFFIX = "-hugo-source"
+BUILD_SUFFIX = "-hugo-build"
+RENDERER_PREFIX = "profile-renderer-"
+# Compiled profile renderers kept besides the one in use, for processes that have
+# not noticed a template change yet.
+KEEP_RENDERERS = 2
+# Never evict a workspace used this recently, it may belong to a build in progress.
+MIN_IDLE_SECONDS = 600
+# Only check the disk budget this often per process.
+EVICTION_INTERVAL = 300
+
+_template_scans = {}
+_lock = threading.Lock()
+_last_eviction = 0
+_sweeper_pid = None
+
+
+def source_dir(directory_id):
+    return os.path.join(WORKSPACE_ROOT, directory_id + SOURCE_SUFFIX)
+
+def build_dir(directory_id):
+    return os.path.join(BUILD_ROOT, directory_id + BUILD_SUFFIX)
+
+# Deletes a site's build output. Called once the build is deployed or has failed.
+def remove_build_dir(directory_id):
+    shutil.rmtree(build_dir(directory_id), ignore_errors=True)
+
+# Returns {relative path: [size, mtime_ns]} for every file in the template and
+# "dir" for every directory, so empty template directories are recreated too.
+def scan_template(template_home, force=False):
+    with _lock:
+        cached = _template_scans.get(template_home)
+        if cached and not force and time.monotonic() - cached[0] < TEMPLATE_RESCAN_INTERVAL:
+            return cached[1]
+
+    snapshot = {}
+    for root, dirs, files in os.walk(template_home):
+        relative_root = os.path.relpath(root, template_home)
+        if relative_root != ".":
+            snapshot[relative_root] = "dir"
+        for name in files:
+            stat = os.stat(os.path.join(root, name))
+            snapshot[os.path.normpath(os.path.join(relative_root, name))] = [stat.st_size, stat.st_mtime_ns]
+
+    with _lock:
+        _template_scans[template_home] = (time.monotonic(), snapshot)
+    return snapshot
+
+# A short digest of the template snapshot. Sites built from an older template have a different version.
+def template_version(template_home):
+    snapshot = scan_template(template_home)
+    return hashlib.sha1(json.dumps(snapshot, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+# True if file is still the one at path. A lock file may be deleted (see _unlock_file) after
+# another process opened it but before it got the lock, that process has to open it again.
+def _same_file(file, path):
+    try:
+        path_stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    file_stat = os.fstat(file.fileno())
+    return (path_stat.st_dev, path_stat.st_ino) == (file_stat.st_dev, file_stat.st_ino)
+
+# Takes the lock at path, waiting for it unless blocking is False. Returns the open
+# lock file, or None if someone else holds it.
+def _lock_file(path, blocking=True):
+    while True:
+        file = open(path, 'a')
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return None
+        if _same_file(file, path):
+            return file
+        file.close()
+
+# Releases a lock taken with _lock_file. With remove the lock file is deleted first, while
+# it is still held, once the directory it protects is gone.
+def _unlock_file(file, path, remove=False):
+    if remove:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    fcntl.flock(file, fcntl.LOCK_UN)
+    file.close()
+
+# Exclusive lock on one site's workspace, held for the whole build so two processes
+# never build the same site at the same time.
+class site_lock(object):
+    def __init__(self, directory_id, root=WORKSPACE_ROOT):
+        self.root = root
+        self.path = os.path.join(root, directory_id + ".lock")
+
+    def __enter__(self):
+        os.makedirs(self.root, exist_ok=True)
+        self.file = _lock_file(self.path)
+        return self
+
+    def __exit__(self, *exc_info):
+        _unlock_file(self.file, self.path)
+
+# True if a build holds the site lock of directory_id right now.
+def _site_locked(directory_id):
+    path = os.path.join(WORKSPACE_ROOT, directory_id + ".lock")
+    if not os.path.exists(path):
+        return False
+    file = _lock_file(path, blocking=False)
+    if file is None:
+        return True
+    _unlock_file(file, path)
+    return False
+
+# Deletes the lock files under root that no running build holds and whose directory is
+# gone (has_directory(name) is False), e.g. of sites that are only ever rendered in-process.
+def _remove_unused_locks(root, has_directory):
+    removed = 0
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        if not name.endswith(".lock") or name.startswith(".") or has_directory(name[:-len(".lock")]):
+            continue
+        path = os.path.join(root, name)
+        file = _lock_file(path, blocking=False)
+        if file is None:
+            continue
+        # Checked again under the lock, a build may have created the directory meanwhile.
+        unused = not has_directory(name[:-len(".lock")])
+        _unlock_file(file, path, remove=unused)
+        removed += unused
+    return removed
+
+def _tree_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+def _idle(path):
+    try:
+        return time.time() - os.stat(path).st_mtime >= MIN_IDLE_SECONDS
+    except OSError:
+        return False
+
+def _list_dirs(root, match):
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(root, name) for name in sorted(names) if match(name) and os.path.isdir(os.path.join(root, name))]
+
+def _source_workspaces():
+    workspaces = []
+    for workspace in _list_dirs(WORKSPACE_ROOT, lambda name: name.endswith(SOURCE_SUFFIX)):
+        manifest = _read_manifest(workspace)
+        workspaces.append((manifest.get("last_used", 0), manifest.get("size", 0), workspace))
+    return workspaces
+
+# Bytes and directory counts under the roots. Source workspaces are counted from their
+# manifests, build outputs and profile renderers are walked.
+def disk_usage():
+    workspaces = _source_workspaces()
+    build_dirs = _list_dirs(BUILD_ROOT, lambda name: name.endswith(BUILD_SUFFIX))
+    renderer_dirs = _list_dirs(RENDERER_ROOT, lambda name: name.startswith(RENDERER_PREFIX))
+    usage = {
+        "source_workspaces": {"count": len(workspaces), "bytes": sum(size for _, size, _ in workspaces)},
+        "build_outputs": {"count": len(build_dirs), "bytes": sum(_tree_size(path) for path in build_dirs)},
+        "profile_renderers": {"count": len(renderer_dirs), "bytes": sum(_tree_size(path) for path in renderer_dirs)},
+        "budget_bytes": DISK_BUDGET_MB * 1024 * 1024
+    }
+    usage["total_bytes"] = sum(usage[kind]["bytes"] for kind in ("source_workspaces", "build_outputs", "profile_renderers"))
+    return usage
+
+def _read_manifest(workspace):
+    try:
+        with open(os.path.join(workspace, MANIFEST_NAME), 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def _write_manifest(workspace, manifest):
+    manifest_path = os.path.join(workspace, MANIFEST_NAME)
+    with open(manifest_path + ".tmp", 'w') as file:
+        json.dump(manifest, file)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+# Brings the workspace for directory_id in line with the template and returns its path.
+# Only template files that were added or changed since the last sync are copied.
+def prepare_source_workspace(template_home, directory_id):
+    workspace = source_dir(directory_id)
+    snapshot = scan_template(template_home)
+    manifest = _read_manifest(workspace)
+    synced = manifest.get("template_files", {}) if manifest.get("template_home") == template_home else {}
+
+    os.makedirs(workspace, exist_ok=True)
+    copied = copied_bytes = 0
+    for relative_path, stat in snapshot.items():
+        if synced.get(relative_path) == stat:
+            continue
+        target = os.path.join(workspace, relative_path)
+        if stat == "dir":
+            os.makedirs(target, exist_ok=True)
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy2(os.path.join(template_home, relative_path), target)
+        copied += 1
+        copied_bytes += stat[0]
+
+    removed = 0
+    for relative_path, stat in synced.items():
+        if relative_path in snapshot:
+            continue
+        target = os.path.join(workspace, relative_path)
+        if stat == "dir":
+            shutil.rmtree(target, ignore_errors=True)
+        elif os.path.exists(target):
+            os.remove(target)
+        removed += 1
+
+    _write_manifest(workspace, {
+        "template_home": template_home,
+        "template_files": snapshot,
+        "size": sum(stat[0] for stat in snapshot.values() if stat != "dir"),
+        "last_used": time.time()
+    })
+    metrics.BUILD_FILES_WRITTEN.inc(copied, step="sync_template")
+    metrics.BUILD_BYTES_COPIED.inc(copied_bytes, step="sync_template")
+    logger.info('Workspace {0} ready ({1} template files copied, {2} removed)'.format(workspace, copied, removed))
+
+    evict_idle_workspaces(keep=workspace)
+    return workspace
+
+# Removes one workspace and its lock file under its site lock. Returns False if a build
+# holds the lock or used the workspace since it was picked. The manifest goes first,
+# so a build that finds a half-removed tree syncs the whole template again.
+def _evict_workspace(workspace):
+    directory_id = os.path.basename(workspace)[:-len(SOURCE_SUFFIX)]
+    lock_path = os.path.join(WORKSPACE_ROOT, directory_id + ".lock")
+    lock_file = _lock_file(lock_path, blocking=False)
+    if lock_file is None:
+        return False
+    evicted = False
+    try:
+        if time.time() - _read_manifest(workspace).get("last_used", 0) >= MIN_IDLE_SECONDS:
+            logger.info('Evicting idle workspace {0}'.format(workspace))
+            try:
+                os.remove(os.path.join(workspace, MANIFEST_NAME))
+            except FileNotFoundError:
+                pass
+            shutil.rmtree(workspace, ignore_errors=True)
+            evicted = True
+    finally:
+        _unlock_file(lock_file, lock_path, remove=evicted and not os.path.isdir(build_dir(directory_id)))
+    return evicted
+
+# Removes the least recently used workspaces until the total size fits the disk budget.
+def evict_idle_workspaces(keep=None, force=False):
+    global _last_eviction
+    if not force and time.monotonic() - _last_eviction < EVICTION_INTERVAL:
+        return 0
+    _last_eviction = time.monotonic()
+
+    usage = disk_usage()
+    budget = usage["budget_bytes"]
+    total = usage["total_bytes"]
+    evicted = 0
+    for last_used, size, workspace in sorted(_source_workspaces()):
+        if total <= budget:
+            break
+        if workspace == keep or time.time() - last_used < MIN_IDLE_SECONDS:
+            continue
+        if _evict_workspace(workspace):
+            total -= size
+            evicted += 1
+    if total > budget:
+        logger.warning('Workspaces use {0} MB, over the {1} MB budget, and nothing else is idle'
+            .format(total // (1024 * 1024), DISK_BUDGET_MB))
+    return evicted
+
+# Removes what crashed builds left behind, then enforces the disk budget:
+# build outputs of sites no build is running for, half-compiled profile renderers
+# and compiled ones older than the newest KEEP_RENDERERS. Only one process sweeps
+# at a time, the others return None.
+def sweep():
+    os.makedirs(WORKSPACE_ROOT, exist_ok=True)
+    with open(os.path.join(WORKSPACE_ROOT, ".sweep.lock"), 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        removed = {"build_outputs": 0, "profile_renderers": 0, "source_workspaces": 0}
+
+        for path in _list_dirs(BUILD_ROOT, lambda name: name.endswith(BUILD_SUFFIX)):
+            directory_id = os.path.basename(path)[:-len(BUILD_SUFFIX)]
+            if _idle(path) and not _site_locked(directory_id):
+                logger.info('Removing orphaned build output {0}'.format(path))
+                shutil.rmtree(path, ignore_errors=True)
+                removed["build_outputs"] += 1
+
+        compiled = []
+        for path in _list_dirs(RENDERER_ROOT, lambda name: name.startswith(RENDERER_PREFIX)):
+            if os.path.exists(os.path.join(path, "templates.json")) or os.path.exists(os.path.join(path, "disabled")):
+                compiled.append((os.stat(path).st_mtime, path))
+            elif _idle(path):
+                logger.info('Removing unfinished profile renderer {0}'.format(path))
+                shutil.rmtree(path, ignore_errors=True)
+                removed["profile_renderers"] += 1
+        for mtime, path in sorted(compiled, reverse=True)[KEEP_RENDERERS + 1:]:
+            if not _idle(path):
+                continue
+            renderer_lock_path = path + ".lock"
+            renderer_lock = _lock_file(renderer_lock_path, blocking=False)
+            if renderer_lock is None:
+                continue
+            logger.info('Removing old profile renderer {0}'.format(path))
+            shutil.rmtree(path, ignore_errors=True)
+            _unlock_file(renderer_lock, renderer_lock_path, remove=True)
+            removed["profile_renderers"] += 1
+
+        removed["source_workspaces"] = evict_idle_workspaces(force=True)
+        removed["lock_files"] = _remove_unused_locks(WORKSPACE_ROOT,
+            lambda directory_id: os.path.isdir(source_dir(directory_id)) or os.path.isdir(build_dir(directory_id)))
+        removed["lock_files"] += _remove_unused_locks(RENDERER_ROOT,
+            lambda name: os.path.isdir(os.path.join(RENDERER_ROOT, name)))
+    return removed
+
+def _sweep_loop():
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        try:
+            sweep()
+        except Exception:
+            logger.exception('Workspace sweep failed')
+
+# Starts the sweeper thread of this process. Safe to call repeatedly, it is
+# restarted after a fork like the build workers.
+def start_sweeper():
+    global _sweeper_pid
+    if _sweeper_pid == os.getpid():
+        return
+    with _lock:
+        if _sweeper_pid == os.getpid():
+            return
+        _sweeper_pid = os.getpid()
+    threading.Thread(target=_sweep_loop, name="workspace-sweeper", daemon=True).start()